@@ -0,0 +1,233 @@
+"""
+    Created on Oct 18 2026
+
+    Description: Persistent library of master calibrations for the SPARC4 pipeline
+
+    Laboratório Nacional de Astrofísica - LNA/MCTI
+    """
+
+__version__ = "1.0"
+
+__copyright__ = """
+    Copyright (c) ...  All rights reserved.
+    """
+
+import os
+import json
+from contextlib import contextmanager
+from bisect import bisect_left
+from datetime import datetime
+
+try :
+    import fcntl
+except ImportError :
+    fcntl = None
+
+
+def get_key(channel, caltype, detector_mode_key) :
+    """ SPARC4 pipeline module to get the library key of a master calibration
+    Parameters
+    ----------
+    channel : int
+        SPARC4 channel
+    caltype : str
+        type of master calibration, e.g. 'MasterZero', 'MasterDomeFlat'
+    detector_mode_key : str
+        detector mode name, as returned by sparc4_db.get_detector_modes_observed
+
+    Returns
+    -------
+    key : str
+        library key
+    """
+    return "s4c{}{}:{}".format(channel, detector_mode_key, caltype)
+
+
+def night_to_mjd(night) :
+    """ SPARC4 pipeline module to get the modified julian day of a night directory name (YYYYMMDD)
+    Parameters
+    ----------
+    night : str
+        night directory name
+
+    Returns
+    -------
+    mjd : int
+        modified julian day at 0h UT of the night date, or None if night is not a date
+    """
+    try :
+        date = datetime.strptime(str(night), "%Y%m%d")
+    except :
+        return None
+    return (date - datetime(1858, 11, 17)).days
+
+
+class CalibrationLibrary :
+    """ SPARC4 pipeline class to index master calibrations by channel, detector mode and night
+
+    The index is a JSON file in the library directory. Masters are only referenced
+    by path, so lookups never read their data. Additions are merged into the index
+    on disk under a file lock, so channels reduced in parallel can share a library.
+
+    Parameters
+    ----------
+    dirname : str
+        library directory
+    """
+
+    def __init__(self, dirname) :
+        self.dirname = dirname
+        self.filename = os.path.join(dirname, "calib_library.json")
+        # key -> list of entries sorted by MJD
+        self.entries = {}
+        # key -> list of MJDs of entries, to bisect
+        self._mjds = {}
+        # (key, signature) -> entry
+        self._signatures = {}
+
+        if not os.path.exists(dirname) :
+            os.makedirs(dirname)
+
+        self._load()
+
+    def _load(self) :
+        """ Read the index from disk and rebuild the lookup tables """
+        self.entries, self._mjds, self._signatures = {}, {}, {}
+        if os.path.exists(self.filename) :
+            try :
+                with open(self.filename, "r") as f :
+                    self.entries = json.load(f)
+            except :
+                print("WARNING: could not read calibration library {}, starting a new one ...".format(self.filename))
+                self.entries = {}
+
+        for key in self.entries.keys() :
+            self._index(key)
+
+    @contextmanager
+    def _locked(self) :
+        """ Hold an exclusive lock on the library, where supported, while the index is updated """
+        with open(self.filename + ".lock", "w") as lock :
+            if fcntl is not None :
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try :
+                yield
+            finally :
+                if fcntl is not None :
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _index(self, key) :
+        """ Sort the entries of a key and update its lookup tables """
+        self.entries[key].sort(key=lambda entry: entry["MJD"])
+        self._mjds[key] = [entry["MJD"] for entry in self.entries[key]]
+        for entry in self.entries[key] :
+            self._signatures[(key, entry["SIGNATURE"])] = entry
+
+    def _save(self) :
+        """ Write the index atomically, so an interrupted run never leaves a broken file """
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as f :
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_filename, self.filename)
+
+    def add(self, key, night, filename, signature, ninputs=0) :
+        """ SPARC4 pipeline module to add a master calibration to the library
+        Parameters
+        ----------
+        key : str
+            library key, see get_key
+        night : str
+            night directory name (YYYYMMDD)
+        filename : str
+            master calibration file path
+        signature : str
+            provenance hash of the inputs and parameters, see sparc4_provenance.get_hash
+        ninputs : int, optional
+            number of input images
+
+        Returns
+        -------
+        entry : dict
+            library entry, or None if night is not a date
+        """
+        mjd = night_to_mjd(night)
+        if mjd is None :
+            print("WARNING: night {} is not a date (YYYYMMDD), master {} not added to the calibration library".format(night, filename))
+            return None
+
+        filename = os.path.abspath(filename)
+        entry = {"NIGHT": str(night), "MJD": mjd, "FILE": filename, "SIGNATURE": signature, "NINPUTS": int(ninputs)}
+
+        with self._locked() :
+            # merge with entries added by other processes since the index was read
+            self._load()
+
+            # replace any previous entry of the same master file
+            entries = [e for e in self.entries.get(key, []) if e["FILE"] != filename]
+            for e in self.entries.get(key, []) :
+                if e["FILE"] == filename :
+                    self._signatures.pop((key, e["SIGNATURE"]), None)
+            entries.append(entry)
+            self.entries[key] = entries
+            self._index(key)
+            self._save()
+
+        return entry
+
+    def find_matching(self, key, signature) :
+        """ SPARC4 pipeline module to find an existing master built from the same inputs
+        Parameters
+        ----------
+        key : str
+            library key, see get_key
+        signature : str
+            provenance hash of the inputs and parameters, see sparc4_provenance.get_hash
+
+        Returns
+        -------
+        filename : str
+            master calibration file path, or None if not found
+        """
+        entry = self._signatures.get((key, signature))
+        if entry is not None and os.path.exists(entry["FILE"]) :
+            return entry["FILE"]
+        return None
+
+    def find_nearest(self, key, night, window=30) :
+        """ SPARC4 pipeline module to find the master calibration nearest to a night
+        Parameters
+        ----------
+        key : str
+            library key, see get_key
+        night : str
+            night directory name (YYYYMMDD)
+        window : float, optional
+            maximum number of days between the night and the master night
+
+        Returns
+        -------
+        filename : str
+            master calibration file path, or None if not found
+        """
+        mjd = night_to_mjd(night)
+        if mjd is None or key not in self._mjds :
+            return None
+
+        entries, mjds = self.entries[key], self._mjds[key]
+
+        # walk out from the insertion point, taking the closest existing master on either side
+        right = bisect_left(mjds, mjd)
+        left = right - 1
+        while left >= 0 or right < len(mjds) :
+            dleft = mjd - mjds[left] if left >= 0 else float("inf")
+            dright = mjds[right] - mjd if right < len(mjds) else float("inf")
+            if min(dleft, dright) > window :
+                break
+            if dright <= dleft :
+                entry, right = entries[right], right + 1
+            else :
+                entry, left = entries[left], left - 1
+            if os.path.exists(entry["FILE"]) :
+                return entry["FILE"]
+
+        return None
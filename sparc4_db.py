@@ -15,12 +15,338 @@ __copyright__ = """
     """
 
 import os, sys
-from astropy.table import Table
+import time
+import json
+import sqlite3
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from astropy.table import Table, vstack
 from astropy.io import fits
 import numpy as np
 from copy import deepcopy
 
-def create_db_from_observations(filelist, dbkeys=[], include_img_statistics=True, include_only_fullframe=True, output="") :
+def _get_file_identity(filename) :
+    """ SPARC4 pipeline module to get the identity of a file on disk
+    Parameters
+    ----------
+    filename : str
+        input file name
+
+    Returns
+    -------
+    size, mtime : int, float
+        file size in bytes and time of last modification
+    """
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime
+
+
+def _get_skipped_filename(output) :
+    """ Get the file name that lists the files skipped by a db, next to the db file """
+    return os.path.splitext(output)[0] + "_skipped.json"
+
+
+def _load_skipped_files(output, include_only_fullframe) :
+    """ Load the identities of the files skipped by a previous ingestion into a db, if made with the same selection """
+    try :
+        with open(_get_skipped_filename(output), "r") as f :
+            skipped = json.load(f)
+        if skipped["INCLUDE_ONLY_FULLFRAME"] == include_only_fullframe :
+            return {filename: tuple(identity) for filename, identity in skipped["FILES"].items()}
+    except :
+        pass
+    return {}
+
+
+def _save_skipped_files(output, include_only_fullframe, skipped) :
+    """ Save the identities of the files skipped by the ingestion into a db """
+    filename = _get_skipped_filename(output)
+    try :
+        with open(filename + ".tmp", "w") as f :
+            json.dump({"INCLUDE_ONLY_FULLFRAME": include_only_fullframe, "FILES": skipped}, f, indent=1, sort_keys=True)
+        os.replace(filename + ".tmp", filename)
+    except :
+        print("WARNING: could not save list of skipped files {}".format(filename))
+
+
+def _get_scaled_values(raw, bscale=1, bzero=0, blank=None) :
+    """ SPARC4 pipeline module to get the valid physical values of raw FITS image data
+    Parameters
+    ----------
+    raw : numpy.ndarray
+        raw (unscaled) image data
+    bscale, bzero : float, optional
+        FITS scaling, where value = bscale * raw + bzero
+    blank : int, optional
+        raw value of undefined pixels in integer images
+
+    Returns
+    -------
+    values : numpy.ndarray
+        flattened float array of finite scaled values
+    """
+    raw = np.asarray(raw).ravel()
+    if blank is not None :
+        raw = raw[raw != blank]
+    values = raw * float(bscale) + float(bzero)
+    return values[np.isfinite(values)]
+
+
+def _get_binned_fwhm(binned, binning, saturated, npeaks=5, box=5) :
+    """ SPARC4 pipeline module to estimate the FWHM of the brightest sources in a binned image
+    Parameters
+    ----------
+    binned : numpy.ndarray
+        image binned by binning x binning pixels
+    binning : int
+        binning factor
+    saturated : numpy.ndarray
+        boolean mask of binned pixels containing saturated pixels
+    npeaks : int, optional
+        maximum number of sources
+    box : int, optional
+        half size of the box (binned pixels) to calculate the second moments of each source
+
+    Returns
+    -------
+    fwhm : float
+        median FWHM of the sources (unbinned pixels), NaN if no source is found
+    """
+    from scipy.ndimage import maximum_filter
+
+    bkg = np.nanmedian(binned)
+    noise = 1.4826 * np.nanmedian(np.abs(binned - bkg))
+    img = np.nan_to_num(binned - bkg)
+
+    # local maxima well above the background, away from borders and saturated pixels
+    peaks = (img == maximum_filter(img, size=2*box+1)) & (img > 10 * noise) & ~saturated
+    peaks[:box], peaks[-box:], peaks[:, :box], peaks[:, -box:] = False, False, False, False
+    ys, xs = np.nonzero(peaks)
+    order = np.argsort(img[ys, xs])[::-1][:npeaks]
+
+    yy, xx = np.mgrid[-box:box+1, -box:box+1]
+    fwhms = []
+    for y, x in zip(ys[order], xs[order]) :
+        cutout = np.clip(img[y-box:y+box+1, x-box:x+box+1], 0, None)
+        flux = np.sum(cutout)
+        if flux <= 0 :
+            continue
+        x0, y0 = np.sum(xx * cutout) / flux, np.sum(yy * cutout) / flux
+        var = (np.sum((xx - x0)**2 * cutout) + np.sum((yy - y0)**2 * cutout)) / (2 * flux)
+        # remove the variance of the binning box itself
+        var = var - 1 / 12
+        if var > 0 :
+            fwhms.append(2.3548 * np.sqrt(var) * binning)
+
+    if len(fwhms) == 0 :
+        return np.nan
+    return float(np.median(fwhms))
+
+
+def get_image_statistics(filename, ext=0, chunk_rows=64, nbins=65536, saturation_limit=None, fwhm_binning=0) :
+    """ SPARC4 pipeline module to calculate image statistics in a single
+    streaming pass over row chunks of a memory mapped image.
+
+    Max, min, mean and standard deviation are exact. The median is exact for
+    integer data (e.g. 16-bit raw frames), where it is obtained from a
+    histogram of all integer values. For floating point data, a second pass
+    fills a histogram of nbins between min and max, and the median is
+    interpolated within the bin, so its error is less than (max - min) / nbins.
+
+    Quality statistics used to select frames for the stack are calculated in
+    the same pass: the peak (max of unsaturated values minus the median), the
+    fraction of saturated values and, optionally, the FWHM of the brightest
+    sources measured on an image binned while it is read.
+
+    Parameters
+    ----------
+    filename : str
+        input image file name
+    ext : int, optional
+        FITS extension containing the image data
+    chunk_rows : int, optional
+        number of image rows read at a time
+    nbins : int, optional
+        number of histogram bins to calculate the median of floating point data
+    saturation_limit : float, optional
+        values above or equal this limit are saturated. If None, no value is saturated
+    fwhm_binning : int, optional
+        binning factor of the image to measure the FWHM, 0 to skip the FWHM
+
+    Returns
+    -------
+    stats : dict
+        image statistics with keys "MAX", "MIN", "MEAN", "MEDIAN", "STDDEV", "PEAK", "SATFRAC" and "FWHM"
+    """
+    stats = {"MAX": np.nan, "MIN": np.nan, "MEAN": np.nan, "MEDIAN": np.nan, "STDDEV": np.nan, "PEAK": np.nan, "SATFRAC": np.nan, "FWHM": np.nan}
+
+    if saturation_limit is None :
+        saturation_limit = np.inf
+
+    # chunks must hold whole binning boxes
+    if fwhm_binning > 1 :
+        chunk_rows = max(fwhm_binning, chunk_rows - chunk_rows % fwhm_binning)
+    binned_rows, saturated_rows = [], []
+
+    # read raw values and apply the scaling ourselves, so the image stays memory mapped
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as hdul :
+        hdu = hdul[ext]
+        hdr = hdu.header
+        nrows = hdr["NAXIS2"]
+
+        bitpix, bscale, bzero = hdr["BITPIX"], hdr.get("BSCALE", 1), hdr.get("BZERO", 0)
+        blank = hdr.get("BLANK", None) if bitpix > 0 else None
+
+        # integer images have a bounded set of values, so we can histogram all of them
+        integer_data = bitpix in [8, 16] and bscale == 1 and float(bzero).is_integer()
+        counts, offset = None, 0
+        if integer_data :
+            offset = int(bzero) if bitpix == 8 else int(bzero) - 32768
+            counts = np.zeros(256 if bitpix == 8 else 65536, dtype=np.int64)
+
+        n, mean, m2 = 0, 0., 0.
+        vmin, vmax = np.inf, -np.inf
+        nsat, vmax_unsat = 0, -np.inf
+
+        for i in range(0, nrows, chunk_rows) :
+            raw = hdu.section[i:i+chunk_rows]
+            values = _get_scaled_values(raw, bscale, bzero, blank)
+
+            if fwhm_binning > 1 and raw.ndim == 2 and raw.shape[0] >= fwhm_binning :
+                # bin the chunk, with undefined pixels as NaN
+                chunk = np.asarray(raw, dtype=float) * float(bscale) + float(bzero)
+                if blank is not None :
+                    chunk[raw == blank] = np.nan
+                ny, nx = (chunk.shape[0] // fwhm_binning) * fwhm_binning, (chunk.shape[1] // fwhm_binning) * fwhm_binning
+                boxes = chunk[:ny, :nx].reshape(ny // fwhm_binning, fwhm_binning, nx // fwhm_binning, fwhm_binning)
+                binned_rows.append(np.nanmean(boxes, axis=(1, 3)))
+                saturated_rows.append(np.nanmax(boxes, axis=(1, 3)) >= saturation_limit)
+
+            nb = len(values)
+            if nb == 0 :
+                continue
+
+            unsaturated = values[values < saturation_limit]
+            nsat += nb - len(unsaturated)
+            if len(unsaturated) :
+                vmax_unsat = max(vmax_unsat, unsaturated.max())
+
+            if integer_data :
+                counts += np.bincount(values.astype(np.int64) - offset, minlength=len(counts))
+
+            # merge moments of current chunk with the accumulated ones (Chan et al.)
+            meanb = values.mean()
+            m2b = np.sum((values - meanb)**2)
+            delta = meanb - mean
+            mean += delta * nb / (n + nb)
+            m2 += m2b + delta * delta * n * nb / (n + nb)
+            n += nb
+
+            vmin = min(vmin, values.min())
+            vmax = max(vmax, values.max())
+
+        if n == 0 :
+            return stats
+
+        if not integer_data :
+            # second pass to fill a histogram between min and max
+            counts = np.zeros(nbins, dtype=np.int64)
+            if vmax > vmin :
+                for i in range(0, nrows, chunk_rows) :
+                    values = _get_scaled_values(hdu.section[i:i+chunk_rows], bscale, bzero, blank)
+                    counts += np.histogram(values, bins=nbins, range=(vmin, vmax))[0]
+
+    def histogram_median(counts, n) :
+        # locate the two central ranks in the cumulative histogram
+        cumcounts = np.cumsum(counts)
+        central_bins = np.searchsorted(cumcounts, [(n - 1) // 2, n // 2], side="right")
+
+        if integer_data :
+            return np.mean(central_bins) + offset
+        elif vmax > vmin :
+            binwidth = (vmax - vmin) / nbins
+            central_values = []
+            for k, b in zip([(n - 1) // 2, n // 2], central_bins) :
+                below = cumcounts[b-1] if b > 0 else 0
+                central_values.append(vmin + binwidth * (b + (k - below + 0.5) / counts[b]))
+            return np.mean(central_values)
+        return vmin
+
+    median = histogram_median(counts, n)
+
+    stats["MAX"] = vmax
+    stats["MIN"] = vmin
+    stats["MEAN"] = mean
+    stats["MEDIAN"] = median
+    stats["STDDEV"] = np.sqrt(m2 / n)
+
+    if np.isfinite(vmax_unsat) :
+        # the peak is relative to the median of unsaturated values, from the same histogram without saturated bins
+        unsat_median = median
+        if nsat :
+            if integer_data :
+                first_saturated_bin = max(0, int(np.ceil(saturation_limit)) - offset)
+            else :
+                first_saturated_bin = max(0, int(np.ceil((saturation_limit - vmin) / ((vmax - vmin) / nbins))))
+            unsat_counts = counts.copy()
+            unsat_counts[first_saturated_bin:] = 0
+            unsat_median = histogram_median(unsat_counts, n - nsat)
+        stats["PEAK"] = vmax_unsat - unsat_median
+    stats["SATFRAC"] = nsat / n
+
+    if len(binned_rows) :
+        stats["FWHM"] = _get_binned_fwhm(np.vstack(binned_rows), fwhm_binning, np.vstack(saturated_rows))
+
+    return stats
+
+
+def _get_db_row(filename, dbkeys=[], include_img_statistics=True, include_only_fullframe=True, saturation_limit=None, fwhm_binning=0) :
+    """ SPARC4 pipeline module to read the database entries of a single observation
+    Parameters
+    ----------
+    filename : str
+        input file name
+    dbkeys : list, optional
+        input list of header keywords to include in database
+    include_img_statistics : bool, optional
+        boolean to include image statistics in the database
+    include_only_fullframe : bool, optional
+        boolean to skip images that are not full frame (1024x1024)
+    saturation_limit : float, optional
+        saturation limit for the quality statistics, see get_image_statistics
+    fwhm_binning : int, optional
+        binning factor to measure the FWHM, 0 to skip it, see get_image_statistics
+
+    Returns
+    -------
+    row : dict
+        database entries of the observation, or None if the file must be skipped
+    """
+    try :
+        # read only the primary header block, not the image data
+        hdr = fits.getheader(filename, 0)
+
+        if include_only_fullframe :
+            if hdr["NAXIS1"] != 1024 or hdr["NAXIS2"] != 1024 :
+                return None
+    except :
+        print("Skipping image file {}".format(filename))
+        return None
+
+    row = {}
+    row["FILE"] = filename
+    row["FILESIZE"], row["MTIME"] = _get_file_identity(filename)
+
+    if include_img_statistics :
+        row.update(get_image_statistics(filename, 0, saturation_limit=saturation_limit, fwhm_binning=fwhm_binning))
+
+    for key in dbkeys :
+        row[key] = hdr[key]
+
+    return row
+
+
+def create_db_from_observations(filelist, dbkeys=[], include_img_statistics=True, include_only_fullframe=True, output="", nthreads=8, nprocesses=1, incremental=False, saturation_limit=None, fwhm_binning=0) :
     """ SPARC4 pipeline module to create a database of observations
     Parameters
     ----------
@@ -32,7 +358,22 @@ def create_db_from_observations(filelist, dbkeys=[], include_img_statistics=True
         boolean to include image statistics in the database (slower)
     output : str, optional
         output db FITS file name
-        
+    nthreads : int, optional
+        number of threads to read the header blocks in parallel
+    nprocesses : int, optional
+        number of processes to calculate image statistics in parallel.
+        Only used when include_img_statistics=True and nprocesses > 1
+    incremental : bool, optional
+        update an existing output db: only new or changed files (size and
+        modification time) are ingested and rows of deleted files are dropped.
+        Files rejected by a previous ingestion (not full frame or unreadable) are
+        listed in a *_skipped.json file next to the output, and are not read
+        again while unchanged
+    saturation_limit : float, optional
+        saturation limit for the PEAK and SATFRAC statistics
+    fwhm_binning : int, optional
+        binning factor to measure the FWHM column, 0 to skip the FWHM column
+
     Returns
     -------
     tbl : astropy.table
@@ -41,6 +382,8 @@ def create_db_from_observations(filelist, dbkeys=[], include_img_statistics=True
     tbldata = {}
     
     tbldata["FILE"] = []
+    tbldata["FILESIZE"] = []
+    tbldata["MTIME"] = []
     
     if include_img_statistics :
         tbldata["MAX"] = []
@@ -48,43 +391,100 @@ def create_db_from_observations(filelist, dbkeys=[], include_img_statistics=True
         tbldata["MEAN"] = []
         tbldata["MEDIAN"] = []
         tbldata["STDDEV"] = []
+        # quality statistics to select frames for the stack
+        tbldata["PEAK"] = []
+        tbldata["SATFRAC"] = []
+        if fwhm_binning > 1 :
+            tbldata["FWHM"] = []
 
     for key in dbkeys :
         tbldata[key] = []
 
-    for i in range(len(filelist)) :
-
-        try :
-            # open fits file
-            hdul = fits.open(filelist[i])
-            hdr = hdul[0].header
+    starttime = time.time()
 
-            if include_only_fullframe :
-                if hdr["NAXIS1"] != 1024 or hdr["NAXIS2"] != 1024 :
-                    continue
-        except :
-            print("Skipping image file {}".format(filelist[i]))
-            continue
+    # load previous db and select the rows that are still valid
+    previous, files_to_ingest = None, filelist
+    identities, skipped = {}, {}
+    if incremental and output != "" and os.path.exists(output) :
+        previous = create_db_from_file(output)
+        previous.convert_bytestring_to_unicode()
 
-        tbldata["FILE"].append(filelist[i])
-
-        if include_img_statistics :
-            tbldata["MAX"].append(np.nanmax(hdul[0].data))
-            tbldata["MIN"].append(np.nanmin(hdul[0].data))
-            tbldata["MEAN"].append(np.nanmean(hdul[0].data))
-            tbldata["MEDIAN"].append(np.nanmedian(hdul[0].data))
-            tbldata["STDDEV"].append(np.nanstd(hdul[0].data))
+        if previous.colnames != list(tbldata.keys()) :
+            print("Database {} has different columns, rebuilding it from scratch".format(output))
+            previous = None
         else :
-            hdr =  fits.getheader(filelist[i],0)
+            identities = {}
+            for filename in filelist :
+                if os.path.exists(filename) :
+                    identities[filename] = _get_file_identity(filename)
+
+            keep = np.full(len(previous), False)
+            for i in range(len(previous)) :
+                filename = previous["FILE"][i]
+                if filename in identities :
+                    size, mtime = identities[filename]
+                    keep[i] = (previous["FILESIZE"][i] == size) and (previous["MTIME"][i] == mtime)
+
+            ndropped = len(previous) - np.count_nonzero(keep)
+            previous = previous[keep]
+
+            # files rejected before are skipped while unchanged
+            for filename, identity in _load_skipped_files(output, include_only_fullframe).items() :
+                if filename in identities and identities[filename] == identity :
+                    skipped[filename] = identity
+
+            known_files = set(previous["FILE"]) | set(skipped.keys())
+            files_to_ingest = [filename for filename in filelist if filename not in known_files]
+
+            print("Incremental database update: {} files unchanged, {} files skipped, {} files to ingest, {} rows dropped".format(len(previous), len(skipped), len(files_to_ingest), ndropped))
+
+    # header-only reads are I/O bound so threads are enough, whereas the
+    # statistics path is CPU bound and may be sent to a pool of processes
+    if include_img_statistics and nprocesses > 1 :
+        executor = ProcessPoolExecutor(max_workers=nprocesses)
+    else :
+        executor = ThreadPoolExecutor(max_workers=max(1, nthreads))
+
+    # map keeps the order of the input file list
+    with executor :
+        rows = list(executor.map(_get_db_row, files_to_ingest,
+                                 repeat(dbkeys),
+                                 repeat(include_img_statistics),
+                                 repeat(include_only_fullframe),
+                                 repeat(saturation_limit),
+                                 repeat(fwhm_binning)))
+
+    for filename, row in zip(files_to_ingest, rows) :
+        if row is None :
+            # record rejected files, so they are not read again while unchanged
+            try :
+                skipped[filename] = identities[filename] if filename in identities else _get_file_identity(filename)
+            except :
+                pass
+            continue
+        for key in tbldata.keys() :
+            tbldata[key].append(row[key])
 
-        for key in dbkeys :
-            tbldata[key].append(hdr[key])
+    elapsed = time.time() - starttime
+    rate = len(files_to_ingest) / elapsed if elapsed > 0 else 0.
+    print("Database ingestion: {} of {} files in {:.2f} s ({:.1f} files/s)".format(len(tbldata["FILE"]), len(files_to_ingest), elapsed, rate))
 
     # initialize dict as data container
     tbl = Table(tbldata)
+
+    if previous is not None :
+        if len(tbl) :
+            tbl = vstack([previous, tbl])
+        else :
+            tbl = previous
+
+        # keep rows in the same order as in the input file list
+        position = {filename: i for i, filename in enumerate(filelist)}
+        tbl = tbl[np.argsort([position[filename] for filename in tbl["FILE"]], kind="stable")]
     
     if output != "" :
         tbl.write(output, overwrite=True)
+        _save_skipped_files(output, include_only_fullframe, skipped)
         
     return tbl
 
@@ -105,12 +505,304 @@ def create_db_from_file (db_filename) :
     return tbl
 
 
+class NightIndex :
+    """ SPARC4 pipeline class to index a night database table for fast selections
+
+    The group indices of each column (and of each set of detector mode keywords)
+    are computed once, on first use, and queries return sorted arrays of row
+    indices without copying the table. The input table must not be changed
+    after the index is created.
+
+    Parameters
+    ----------
+    tbl : astropy.table
+        input database table
+    """
+
+    def __init__(self, tbl) :
+        self.tbl = tbl
+        self._columns = {}
+        self._groups = {}
+        self._all_rows = np.arange(len(tbl))
+
+    def __len__(self) :
+        return len(self.tbl)
+
+    def column(self, key) :
+        """ Get a database column as a numpy array, with byte strings decoded """
+        if key not in self._columns :
+            values = np.asarray(self.tbl[key])
+            if values.dtype.kind == 'S' :
+                values = np.char.decode(values)
+            self._columns[key] = values
+        return self._columns[key]
+
+    def groups(self, key) :
+        """ Get a dict of sorted row indices for each value of a column
+
+        Parameters
+        ----------
+        key : str or tuple
+            column name, or tuple of column names to group by the combination of values
+        """
+        if key not in self._groups :
+            groups = {}
+            if isinstance(key, tuple) :
+                values = zip(*[self.column(k).tolist() for k in key])
+                for i, value in enumerate(values) :
+                    groups.setdefault(value, []).append(i)
+                groups = {value: np.array(rows, dtype=int) for value, rows in groups.items()}
+            elif len(self) :
+                uniq, inverse = np.unique(self.column(key), return_inverse=True)
+                inverse = inverse.ravel()
+                order = np.argsort(inverse, kind='stable')
+                bounds = np.cumsum(np.bincount(inverse, minlength=len(uniq)))[:-1]
+                groups = dict(zip(uniq.tolist(), np.split(order, bounds)))
+            self._groups[key] = groups
+        return self._groups[key]
+
+    def rows(self, key, value) :
+        """ Get sorted row indices where column key (or tuple of keys) is equal to value """
+        return self.groups(key).get(value, np.array([], dtype=int))
+
+    def select(self, object_id=None, obstype=None, inst_mode=None, polar_mode=None, calwheel_mode=None, detector_mode=None, rows=None) :
+        """ Get sorted row indices of the entries matching all given selections
+
+        Parameters
+        ----------
+        object_id, obstype, inst_mode, polar_mode, calwheel_mode : str, optional
+            values of OBJECT, OBSTYPE, INSTMODE, WPSEL and CALW to select
+        detector_mode : dict, optional
+            to select observations of a given detector mode
+        rows : numpy.ndarray, optional
+            sorted row indices to start the selection from
+
+        Returns
+        -------
+        rows : numpy.ndarray
+            sorted row indices
+        """
+        selections = [rows]
+        for key, value in [("OBJECT", object_id), ("OBSTYPE", obstype), ("INSTMODE", inst_mode), ("WPSEL", polar_mode), ("CALW", calwheel_mode)] :
+            if value != None :
+                selections.append(self.rows(key, value))
+        if detector_mode != None and len(detector_mode) :
+            keys = tuple(detector_mode.keys())
+            selections.append(self.rows(keys, tuple(detector_mode[key] for key in keys)))
+
+        selections = [sel for sel in selections if sel is not None]
+        if len(selections) == 0 :
+            return self._all_rows
+
+        # intersect the smallest selections first
+        selections.sort(key=len)
+        rows = selections[0]
+        for sel in selections[1:] :
+            if len(rows) == 0 :
+                break
+            rows = np.intersect1d(rows, sel, assume_unique=True)
+        return rows
+
+    def unique(self, key, rows) :
+        """ Get a table of the unique values of a column within the selected rows """
+        values = np.unique(self.column(key)[rows])
+        return Table([values], names=[key])
+
+    def subset(self, **selection) :
+        """ Get a new index over a copy of the selected rows, see NightIndex.select """
+        return NightIndex(self.tbl[self.select(**selection)])
+
+
+def _to_sql_value(value) :
+    """ Convert numpy scalars and byte strings to python types accepted by sqlite3 """
+    if isinstance(value, (bytes, np.bytes_)) :
+        return value.decode()
+    if isinstance(value, np.generic) :
+        return value.item()
+    return value
+
+
+def _get_sql_type(dtype) :
+    """ Get the SQLite column type to store a numpy data type """
+    if dtype.kind in ['b', 'i', 'u'] :
+        return "INTEGER"
+    elif dtype.kind == 'f' :
+        return "REAL"
+    return "TEXT"
+
+
+class SQLiteDB :
+    """ SPARC4 pipeline class to store night databases of all channels in a single SQLite file
+
+    Each database entry is stored with its CHANNEL and NIGHT, so observations can be
+    selected across nights and channels with indexed SQL queries. A scoped instance
+    (see SQLiteDB.scope) can be passed to the get_* selection functions in place
+    of the night database table.
+
+    Parameters
+    ----------
+    db_filename : str
+        SQLite database file path
+    channel : int, optional
+        to restrict queries to a given channel
+    night : str, optional
+        to restrict queries to a given night directory name
+    """
+
+    table_name = "observations"
+
+    def __init__(self, db_filename, channel=None, night=None, connection=None) :
+        self.db_filename = db_filename
+        self.channel = channel
+        self.night = night
+        self.connection = connection
+        if self.connection is None :
+            self.connection = sqlite3.connect(db_filename, timeout=60)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS {} (FILE TEXT PRIMARY KEY, CHANNEL INTEGER, NIGHT TEXT)'.format(self.table_name))
+            self.connection.execute('CREATE INDEX IF NOT EXISTS idx_CHANNEL_NIGHT ON {} (CHANNEL, NIGHT)'.format(self.table_name))
+            self.connection.execute('CREATE INDEX IF NOT EXISTS idx_NIGHT ON {} (NIGHT)'.format(self.table_name))
+            self.connection.commit()
+
+    def scope(self, channel=None, night=None) :
+        """ Get a new instance sharing this connection with queries restricted to a channel and/or night """
+        return SQLiteDB(self.db_filename, channel=channel, night=night, connection=self.connection)
+
+    def columns(self) :
+        """ Get the list of stored columns """
+        return [row[1] for row in self.connection.execute('PRAGMA table_info({})'.format(self.table_name))]
+
+    def ingest(self, tbl, channel, night, index_keys=[]) :
+        """ Replace all entries of a channel and night with the rows of a night database table
+
+        Parameters
+        ----------
+        tbl : astropy.table
+            night database table, as created by create_db_from_observations
+        channel : int
+            SPARC4 channel number
+        night : str
+            night directory name
+        index_keys : list, optional
+            list of columns to index, e.g. DB_KEYS
+
+        Returns
+        -------
+        db : SQLiteDB
+            instance scoped to the ingested channel and night
+        """
+        existing = self.columns()
+        colnames = [key for key in tbl.colnames if key not in ["CHANNEL", "NIGHT"]]
+
+        with self.connection :
+            for key in colnames :
+                if key not in existing :
+                    self.connection.execute('ALTER TABLE {} ADD COLUMN "{}" {}'.format(self.table_name, key, _get_sql_type(tbl[key].dtype)))
+            for key in index_keys :
+                if key in colnames :
+                    self.connection.execute('CREATE INDEX IF NOT EXISTS "idx_{}" ON {} ("{}")'.format(key.replace("-","_"), self.table_name, key))
+
+            self.connection.execute('DELETE FROM {} WHERE CHANNEL = ? AND NIGHT = ?'.format(self.table_name), (int(channel), str(night)))
+
+            values = [np.asarray(tbl[key]) for key in colnames]
+            rows = ([int(channel), str(night)] + [_to_sql_value(v[i]) for v in values] for i in range(len(tbl)))
+            query = 'INSERT OR REPLACE INTO {} (CHANNEL, NIGHT, {}) VALUES ({})'.format(self.table_name, ", ".join(['"{}"'.format(key) for key in colnames]), ", ".join(["?"] * (len(colnames) + 2)))
+            self.connection.executemany(query, rows)
+
+        return self.scope(channel=channel, night=night)
+
+    def _where(self, object_id=None, obstype=None, inst_mode=None, polar_mode=None, calwheel_mode=None, detector_mode=None, skyflat=False) :
+        """ Build the WHERE clause and its parameters for a selection within the current scope """
+        clauses, params = [], []
+
+        selection = [("CHANNEL", self.channel), ("NIGHT", self.night), ("OBJECT", object_id), ("OBSTYPE", obstype), ("INSTMODE", inst_mode), ("WPSEL", polar_mode), ("CALW", calwheel_mode)]
+        if detector_mode != None :
+            selection += list(detector_mode.items())
+
+        for key, value in selection :
+            if value != None :
+                clauses.append('"{}" = ?'.format(key))
+                params.append(_to_sql_value(value))
+
+        if skyflat :
+            clauses.append('("OBSTYPE" IN (?, ?) OR "OBJECT" IN (?, ?))')
+            params += ['SFLAT', 'SKYFLAT', 'SFLAT', 'SKYFLAT']
+
+        where = ""
+        if len(clauses) :
+            where = " WHERE " + " AND ".join(clauses)
+
+        return where, params
+
+    def query(self, columns, order_by="rowid", **selection) :
+        """ Get a list of tuples with the values of columns for the selected entries, see SQLiteDB._where """
+        where, params = self._where(**selection)
+        query = 'SELECT {} FROM {}{} ORDER BY {}'.format(", ".join(['"{}"'.format(key) for key in columns]), self.table_name, where, order_by)
+        return self.connection.execute(query, params).fetchall()
+
+    def file_list(self, **selection) :
+        """ Get the list of files for the selected entries """
+        return [row[0] for row in self.query(["FILE"], **selection)]
+
+    def unique(self, key, **selection) :
+        """ Get a table of the unique values of a column within the selected entries """
+        where, params = self._where(**selection)
+        query = 'SELECT DISTINCT "{}" FROM {}{} ORDER BY "{}"'.format(key, self.table_name, where, key)
+        values = [row[0] for row in self.connection.execute(query, params)]
+        return Table([np.array(values)], names=[key])
+
+    def unique_rows(self, keys, with_counts=False, **selection) :
+        """ Get a list of tuples of unique values of columns, in order of first appearance, optionally ending with the number of entries """
+        where, params = self._where(**selection)
+        columns = ", ".join(['"{}"'.format(key) for key in keys])
+        counts = ", COUNT(*)" if with_counts else ""
+        query = 'SELECT {}{} FROM {}{} GROUP BY {} ORDER BY MIN(rowid)'.format(columns, counts, self.table_name, where, columns)
+        return self.connection.execute(query, params).fetchall()
+
+    def nights(self, **selection) :
+        """ Get a table with the number of files per night and channel for the selected entries """
+        where, params = self._where(**selection)
+        query = 'SELECT NIGHT, CHANNEL, COUNT(*) FROM {}{} GROUP BY NIGHT, CHANNEL ORDER BY NIGHT, CHANNEL'.format(self.table_name, where)
+        rows = self.connection.execute(query, params).fetchall()
+        return Table(rows=rows, names=["NIGHT", "CHANNEL", "NFILES"], dtype=[str, int, int])
+
+    def to_table(self, **selection) :
+        """ Get the selected entries as a night database table, i.e., without CHANNEL and NIGHT columns """
+        columns = [key for key in self.columns() if key not in ["CHANNEL", "NIGHT"]]
+        rows = self.query(columns, **selection)
+        if len(rows) == 0 :
+            return Table(names=columns)
+        return Table(rows=rows, names=columns)
+
+    def export_fits(self, output, **selection) :
+        """ Save the selected entries (usually a single channel and night) to a FITS database file """
+        tbl = self.to_table(**selection)
+        tbl.write(output, overwrite=True)
+        return tbl
+
+
+def get_night_index(tbl) :
+    """ SPARC4 pipeline module to get an index for a night database
+    Parameters
+    ----------
+    tbl : astropy.table, NightIndex or SQLiteDB
+        input database table, its index, or a SQLite database scoped to a night
+
+    Returns
+    -------
+    index : NightIndex
+        index of the database, which is the input itself if it is already indexed
+    """
+    if isinstance(tbl, NightIndex) :
+        return tbl
+    return NightIndex(tbl)
+
+
 def get_targets_observed(tbl, inst_mode=None, polar_mode=None, calwheel_mode=None, detector_mode=None) :
     """ SPARC4 pipeline module to get targets observed
     Parameters
     ----------
-    tbl : tbl : astropy.table
-        input database table
+    tbl : astropy.table, NightIndex or SQLiteDB
+        input database table, its index, or a SQLite database scoped to a night
     inst_mode : str, optional
         to select observations of a given instrument mode
     polar_mode : str, optional
@@ -125,60 +817,98 @@ def get_targets_observed(tbl, inst_mode=None, polar_mode=None, calwheel_mode=Non
     targets : astropy.table
         objects observed detected in database
     """
-    tbl = tbl[tbl["OBSTYPE"] == "OBJECT"]
-
-    if detector_mode != None :
-        for key in detector_mode.keys() :
-            tbl = tbl[tbl[key] == detector_mode[key]]
-
-    if polar_mode != None :
-        tbl = tbl[tbl['WPSEL'] == polar_mode]
+    if isinstance(tbl, SQLiteDB) :
+        return tbl.unique("OBJECT", obstype="OBJECT", inst_mode=inst_mode, polar_mode=polar_mode, calwheel_mode=calwheel_mode, detector_mode=detector_mode)
 
-    if inst_mode != None :
-        tbl = tbl[tbl['INSTMODE'] == inst_mode]
+    index = get_night_index(tbl)
 
-    if calwheel_mode != None :
-        tbl = tbl[tbl['CALW'] == calwheel_mode]
+    rows = index.select(obstype="OBJECT", inst_mode=inst_mode, polar_mode=polar_mode, calwheel_mode=calwheel_mode, detector_mode=detector_mode)
 
-    targets = tbl.group_by("OBJECT").groups.keys
+    targets = index.unique("OBJECT", rows)
 
     return targets
 
 
-def get_detector_modes_observed(tbl, science_only=True, detector_keys=None) :
+def get_detector_modes_observed(tbl, science_only=True, detector_keys=None, return_counts=False, return_indices=False) :
 
     """ SPARC4 pipeline module to get detector modes observed
     Parameters
     ----------
-    tbl : tbl : astropy.table
-        input database table
+    tbl : astropy.table, NightIndex or SQLiteDB
+        input database table, its index, or a SQLite database scoped to a night
     science_only : bool, optional
         to consider only science data in mode selection
     detector_keys : list, optional
         list of keywords to match detector modes
+    return_counts : bool, optional
+        to also return the number of database rows in each mode
+    return_indices : bool, optional
+        to also return the indices of database rows in each mode
 
     Returns
     -------
     modes : dict
-        dictionary with detector mdes detected in database
+        dictionary with detector mdes detected in database, in order of first appearance
+    counts : dict, optional
+        number of rows for each mode name, only returned if return_counts is True
+    indices : dict, optional
+        sorted row indices (in the input table) for each mode name, only returned if return_indices is True
     """
 
     #detector_keys = ["VBIN", "HBIN", "INITLIN", "INITCOL", "FINALLIN", "FINALCOL", "VCLKAMP", "CCDSERN", "VSHIFT", "PREAMP", "READRATE", "EMMODE", "EMGAIN"]
 
-    modes = {}
-    
-    if science_only :
-        tbl = tbl[tbl["OBSTYPE"] == "OBJECT"]
-    
-    for i in range(len(tbl)) :
-        mode_name, detector_mode = "", {}
-        for key in detector_keys :
-            mode_name += "_{}".format(str(tbl[key][i]).replace(" ",""))
-            detector_mode[key] = tbl[key][i]
-        if mode_name not in modes.keys() :
-            modes[mode_name] = detector_mode
+    modes, counts, indices = {}, {}, {}
 
-    return modes
+    if isinstance(tbl, SQLiteDB) and not return_indices :
+        for values in tbl.unique_rows(detector_keys, obstype="OBJECT" if science_only else None, with_counts=True) :
+            mode_name = "".join(["_{}".format(str(v).replace(" ","")) for v in values[:-1]])
+            if mode_name not in modes.keys() :
+                modes[mode_name] = dict(zip(detector_keys, values[:-1]))
+            counts[mode_name] = counts.get(mode_name, 0) + values[-1]
+    else :
+        if isinstance(tbl, SQLiteDB) :
+            # row indices refer to the night database table of the current scope
+            tbl = tbl.to_table()
+
+        index = get_night_index(tbl)
+
+        rows = index.select()
+        if science_only :
+            rows = index.select(obstype="OBJECT")
+
+        if len(rows) :
+            # find unique combinations of detector keywords
+            records = np.rec.fromarrays([index.column(key)[rows] for key in detector_keys], names=[str(i) for i in range(len(detector_keys))])
+            uniq, first, inverse, nrows = np.unique(records, return_index=True, return_inverse=True, return_counts=True)
+            inverse = inverse.ravel()
+
+            # group row indices by mode
+            groups = []
+            if return_indices :
+                order = np.argsort(inverse, kind='stable')
+                groups = np.split(rows[order], np.cumsum(nrows)[:-1])
+
+            # loop over modes in order of first appearance
+            for m in np.argsort(first) :
+                mode_name, detector_mode = "", {}
+                for i, key in enumerate(detector_keys) :
+                    mode_name += "_{}".format(str(uniq[m][i]).replace(" ",""))
+                    detector_mode[key] = uniq[m][i]
+                if mode_name not in modes.keys() :
+                    modes[mode_name] = detector_mode
+                counts[mode_name] = counts.get(mode_name, 0) + int(nrows[m])
+                if return_indices :
+                    indices[mode_name] = np.sort(np.concatenate([indices.get(mode_name, np.array([], dtype=int)), groups[m]]))
+
+    output = [modes]
+    if return_counts :
+        output.append(counts)
+    if return_indices :
+        output.append(indices)
+
+    if len(output) == 1 :
+        return modes
+    return tuple(output)
 
 
 def get_inst_modes_observed(tbl, science_only=True) :
@@ -186,8 +916,8 @@ def get_inst_modes_observed(tbl, science_only=True) :
     """ SPARC4 pipeline module to get instrument modes observed
     Parameters
     ----------
-    tbl : tbl : astropy.table
-        input database table
+    tbl : astropy.table, NightIndex or SQLiteDB
+        input database table, its index, or a SQLite database scoped to a night
     science_only : bool, optional
         to consider only science data in mode selection
     Returns
@@ -196,10 +926,16 @@ def get_inst_modes_observed(tbl, science_only=True) :
         instrument modes detected in database
     """
 
+    if isinstance(tbl, SQLiteDB) :
+        return tbl.unique("INSTMODE", obstype="OBJECT" if science_only else None)
+
+    index = get_night_index(tbl)
+
+    rows = index.select()
     if science_only :
-        tbl = tbl[tbl["OBSTYPE"] == "OBJECT"]
+        rows = index.select(obstype="OBJECT")
 
-    inst_modes = tbl.group_by("INSTMODE").groups.keys
+    inst_modes = index.unique("INSTMODE", rows)
 
     return inst_modes
 
@@ -209,8 +945,8 @@ def get_polar_modes_observed(tbl, science_only=True) :
     """ SPARC4 pipeline module to get polarimetry modes observed
     Parameters
     ----------
-    tbl : tbl : astropy.table
-        input database table
+    tbl : astropy.table, NightIndex or SQLiteDB
+        input database table, its index, or a SQLite database scoped to a night
     science_only : bool, optional
         to consider only science data in mode selection
     Returns
@@ -219,12 +955,17 @@ def get_polar_modes_observed(tbl, science_only=True) :
         polarimetry modes detected in database
     """
 
+    if isinstance(tbl, SQLiteDB) :
+        return tbl.unique("WPSEL", obstype="OBJECT" if science_only else None, inst_mode="POLAR")
+
+    index = get_night_index(tbl)
+
     if science_only :
-        tbl = tbl[(tbl["OBSTYPE"] == "OBJECT") & (tbl["INSTMODE"] == "POLAR")]
+        rows = index.select(obstype="OBJECT", inst_mode="POLAR")
     else :
-        tbl = tbl[tbl["INSTMODE"] == "POLAR"]
+        rows = index.select(inst_mode="POLAR")
 
-    polar_modes = tbl.group_by("WPSEL").groups.keys
+    polar_modes = index.unique("WPSEL", rows)
 
     return polar_modes
 
@@ -234,8 +975,8 @@ def get_calib_wheel_modes(tbl, science_only=True, polar_only=True) :
     """ SPARC4 pipeline module to get calibration wheel modes observed
     Parameters
     ----------
-    tbl : tbl : astropy.table
-        input database table
+    tbl : astropy.table, NightIndex or SQLiteDB
+        input database table, its index, or a SQLite database scoped to a night
     science_only : bool, optional
         to consider only science data for mode selection
     polar_only : bool, optional
@@ -247,13 +988,14 @@ def get_calib_wheel_modes(tbl, science_only=True, polar_only=True) :
         calibration wheel modes detected in database
     """
 
-    if science_only :
-        tbl = tbl[tbl["OBSTYPE"] == "OBJECT"]
+    if isinstance(tbl, SQLiteDB) :
+        return tbl.unique("CALW", obstype="OBJECT" if science_only else None, inst_mode="POLAR" if polar_only else None)
+
+    index = get_night_index(tbl)
 
-    if polar_only :
-        tbl = tbl[tbl["INSTMODE"] == "POLAR"]
+    rows = index.select(obstype="OBJECT" if science_only else None, inst_mode="POLAR" if polar_only else None)
 
-    calwheel_modes = tbl.group_by("CALW").groups.keys
+    calwheel_modes = index.unique("CALW", rows)
 
     return calwheel_modes
 
@@ -263,8 +1005,8 @@ def get_file_list(tbl, object_id=None, inst_mode=None, polar_mode=None, obstype=
     """ SPARC4 pipeline module to get a list of files selected from database
     Parameters
     ----------
-    tbl : tbl : astropy.table
-        input database table
+    tbl : astropy.table, NightIndex or SQLiteDB
+        input database table, its index, or a SQLite database scoped to a night
     object_id : str, optional
         to select observations of a given object_id
     inst_mode : str, optional
@@ -288,42 +1030,133 @@ def get_file_list(tbl, object_id=None, inst_mode=None, polar_mode=None, obstype=
 
     #tbl, inst_mode="PHOT", polar_mode="NONE", obstype="ZERO", detector_mode={"PREAMP": "Gain 2","READRATE": 1,"EMMODE": 'Conventional',"EMGAIN": 2}
     
-    if object_id != None :
-        tbl = tbl[tbl["OBJECT"] == object_id]
+    if (obstype != None) and (obstype not in ["ZERO","FLAT","OBJECT"]) :
+        obstype = None
+
+    if isinstance(tbl, SQLiteDB) :
+        return tbl.file_list(object_id=object_id, obstype=obstype, inst_mode=inst_mode, polar_mode=polar_mode, calwheel_mode=calwheel_mode, detector_mode=detector_mode, skyflat=skyflat)
+
+    index = get_night_index(tbl)
 
+    rows = None
     if skyflat :
-        tbl = tbl[(tbl["OBSTYPE"] == 'SFLAT') | (tbl["OBSTYPE"] == 'SKYFLAT') | (tbl["OBJECT"] == 'SFLAT') | (tbl["OBJECT"] == 'SKYFLAT')]
+        rows = np.unique(np.concatenate([index.rows(key, value) for key in ["OBSTYPE", "OBJECT"] for value in ['SFLAT', 'SKYFLAT']]))
 
-    if (obstype != None) and (obstype in ["ZERO","FLAT","OBJECT"]) :
-        tbl = tbl[tbl["OBSTYPE"] == obstype]
+    rows = index.select(object_id=object_id, obstype=obstype, inst_mode=inst_mode, polar_mode=polar_mode, calwheel_mode=calwheel_mode, detector_mode=detector_mode, rows=rows)
 
-    if detector_mode != None :
-        for key in detector_mode.keys() :
-            tbl = tbl[tbl[key] == detector_mode[key]]
+    files = index.column("FILE")
+    outlist = [str(files[i]) for i in rows]
 
-    if polar_mode != None :
-        tbl = tbl[tbl['WPSEL'] == polar_mode]
+    return outlist
 
-    if inst_mode != None :
-        tbl = tbl[tbl['INSTMODE'] == inst_mode]
 
-    if calwheel_mode != None :
-        tbl = tbl[tbl['CALW'] == calwheel_mode]
+def get_frame_quality(tbl, files) :
 
-    outlist = []
-    for i in range(len(tbl)) :
-        outlist.append(str(tbl["FILE"][i]))
-    
-    return outlist
+    """ SPARC4 pipeline module to get the quality statistics of frames from the database
+    Parameters
+    ----------
+    tbl : astropy.table, NightIndex or SQLiteDB
+        input database table, its index, or a SQLite database scoped to a night
+    files : list
+        list of files
+
+    Returns
+    -------
+    quality : dict
+        quality statistics of each file: {"PEAK": array, "SATFRAC": array, "FWHM": array}, in the order of
+        the input files, where FWHM is NaN if not in the database. None if the database has no quality statistics
+        or any file is not in the database
+    """
+    keys = ["PEAK", "SATFRAC", "FWHM"]
+
+    if isinstance(tbl, SQLiteDB) :
+        available = tbl.columns()
+        if "PEAK" not in available or "SATFRAC" not in available :
+            return None
+        columns = ["FILE"] + [key for key in keys if key in available]
+        rows = {row[0]: row[1:] for row in tbl.query(columns)}
+    else :
+        index = get_night_index(tbl)
+        if "PEAK" not in index.tbl.colnames or "SATFRAC" not in index.tbl.colnames :
+            return None
+        columns = ["FILE"] + [key for key in keys if key in index.tbl.colnames]
+        rows = {row[0]: row[1:] for row in zip(*[index.column(key).tolist() for key in columns])}
+
+    if not all(f in rows for f in files) :
+        return None
+
+    quality = {}
+    for k, key in enumerate(columns[1:]) :
+        quality[key] = np.array([rows[f][k] for f in files], dtype=float)
+    if "FWHM" not in quality :
+        quality["FWHM"] = np.full(len(files), np.nan)
+
+    return quality
+
+
+def segment_polar_sequences(wppos, times=None, npositions=None, drop_incomplete=False, verbose=False) :
 
+    """ SPARC4 pipeline module to split a series of waveplate positions into polar sequences
 
-def get_polar_sequences(tbl, object_id, detector_mode, polar_mode, calwheel_mode=None) :
+    A new sequence starts whenever the waveplate position decreases with respect to
+    the previous exposure.
+
+    Parameters
+    ----------
+    wppos : array_like
+        waveplate positions (WPPOS) of each exposure
+    times : array_like, optional
+        time of each exposure (e.g. DATE-OBS) to sort exposures before splitting
+    npositions : int, optional
+        number of waveplate positions of a complete sequence
+    drop_incomplete : bool, optional
+        to drop sequences without exactly one exposure per waveplate position
+    verbose : bool, optional
+        turn on verbose
+
+    Returns
+    -------
+    sequences : list of numpy.ndarray
+        indices of the input exposures in each sequence
+    complete : numpy.ndarray
+        boolean array flagging complete sequences (all True if npositions is None)
+    """
+
+    wppos = np.asarray(wppos)
+
+    order = np.arange(len(wppos))
+    if times is not None :
+        order = np.argsort(np.asarray(times), kind='stable')
+
+    if len(order) == 0 :
+        return [], np.array([], dtype=bool)
+
+    # a decrease of waveplate position starts a new sequence
+    breaks = np.flatnonzero(np.diff(wppos[order]) < 0) + 1
+    sequences = np.split(order, breaks)
+
+    complete = np.full(len(sequences), True)
+    if npositions != None :
+        for i in range(len(sequences)) :
+            positions = wppos[sequences[i]]
+            complete[i] = len(positions) == npositions and len(np.unique(positions)) == npositions
+            if verbose and not complete[i] :
+                print("WARNING: polar sequence {} of {} is incomplete: {} exposures for {} waveplate positions".format(i+1, len(sequences), len(positions), npositions))
+
+    if drop_incomplete :
+        sequences = [sequences[i] for i in range(len(sequences)) if complete[i]]
+        complete = complete[complete]
+
+    return sequences, complete
+
+
+def get_polar_sequences(tbl, object_id, detector_mode, polar_mode, calwheel_mode=None, npositions=None, drop_incomplete=False, verbose=False) :
 
     """ SPARC4 pipeline module to get polar sequences within a given mode
     Parameters
     ----------
-    tbl : tbl : astropy.table
-        input database table
+    tbl : astropy.table, NightIndex or SQLiteDB
+        input database table, its index, or a SQLite database scoped to a night
     object_id : str
         to select observations of a given object ID
     detector_mode : {}
@@ -332,7 +1165,12 @@ def get_polar_sequences(tbl, object_id, detector_mode, polar_mode, calwheel_mode
         to select observations of a given polarimetric mode
     calwheel_mode : str, optional
         to select observations of a given calibration wheel position mode
-
+    npositions : int, optional
+        number of waveplate positions of a complete sequence, to validate sequences
+    drop_incomplete : bool, optional
+        to drop incomplete sequences
+    verbose : bool, optional
+        turn on verbose
 
     Returns
     -------
@@ -340,39 +1178,50 @@ def get_polar_sequences(tbl, object_id, detector_mode, polar_mode, calwheel_mode
         lists of sequences of files
     """
     
-    tbl = tbl[tbl['INSTMODE'] == 'POLAR']
-    tbl = tbl[tbl["OBJECT"] == object_id]
-    tbl = tbl[tbl["OBSTYPE"] == "OBJECT"]
-    for key in detector_mode.keys() :
-        tbl = tbl[tbl[key] == detector_mode[key]]
-    tbl = tbl[tbl['WPSEL'] == polar_mode]
-
-    if calwheel_mode != None :
-        tbl = tbl[tbl['CALW'] == calwheel_mode]
-
-    tbl.sort("DATE-OBS")
-
-    sequences = []
-    #print("******** START NEW SEQUENCE *********")
-
-    if len(tbl["WPPOS"]) :
-        prev_pos = deepcopy(tbl["WPPOS"][0])
-        seq = []
-
-        for i in range(len(tbl)) :
-            current_pos = tbl["WPPOS"][i]
-            
-            #print(i, tbl["FILE"][i], tbl["WPPOS"][i], current_pos, prev_pos)
-            
-            if current_pos < prev_pos :
-                sequences.append(seq)
-                seq = []
-                #print("******** START NEW SEQUENCE *********")
-
-            seq.append(tbl["FILE"][i])
-            prev_pos = current_pos
-
-            if i == len(tbl) - 1 :
-                sequences.append(seq)
-
-    return sequences
+    if isinstance(tbl, SQLiteDB) :
+        rows = tbl.query(["FILE", "WPPOS"], order_by='"DATE-OBS", rowid', object_id=object_id, obstype="OBJECT", inst_mode='POLAR', polar_mode=polar_mode, calwheel_mode=calwheel_mode, detector_mode=detector_mode)
+        files = np.array([row[0] for row in rows])
+        wppos = np.array([row[1] for row in rows])
+    else :
+        index = get_night_index(tbl)
+
+        rows = index.select(object_id=object_id, obstype="OBJECT", inst_mode='POLAR', polar_mode=polar_mode, calwheel_mode=calwheel_mode, detector_mode=detector_mode)
+
+        # sort selected rows by time
+        rows = rows[np.argsort(index.column("DATE-OBS")[rows], kind='stable')]
+
+        wppos, files = index.column("WPPOS")[rows], index.column("FILE")[rows]
+
+    sequences, complete = segment_polar_sequences(wppos, npositions=npositions, drop_incomplete=drop_incomplete, verbose=verbose)
+
+    return [files[seq].tolist() for seq in sequences]
+
+
+def get_nights_observed(db, object_id=None, inst_mode=None, polar_mode=None, obstype="OBJECT", channel=None) :
+
+    """ SPARC4 pipeline module to get the nights where a given selection was observed
+    Parameters
+    ----------
+    db : SQLiteDB
+        SQLite database with entries of many nights and channels
+    object_id : str, optional
+        to select observations of a given object ID
+    inst_mode : str, optional
+        to select observations of a given instrument mode
+    polar_mode : str, optional
+        to select observations of a given polarimetric mode
+    obstype : str, optional
+        to select observations of a given type
+    channel : int, optional
+        to select observations of a given channel
+
+    Returns
+    -------
+    nights : astropy.table
+        table with columns NIGHT, CHANNEL and NFILES
+    """
+
+    if channel != None :
+        db = db.scope(channel=channel, night=db.night)
+
+    return db.nights(object_id=object_id, obstype=obstype, inst_mode=inst_mode, polar_mode=polar_mode)
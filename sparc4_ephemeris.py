@@ -0,0 +1,199 @@
+"""
+    Created on Oct 18 2026
+
+    Description: Ephemeris interpolation cache for the time keywords of the SPARC4 pipeline
+
+    Laboratório Nacional de Astrofísica - LNA/MCTI
+    """
+
+__version__ = "1.0"
+
+__copyright__ = """
+    Copyright (c) ...  All rights reserved.
+    """
+
+import os
+import threading
+
+import numpy as np
+from scipy.interpolate import CubicSpline
+import astropy.units as u
+from astropy.io import fits
+from astropy.time import Time
+from astropy.coordinates import AltAz
+
+# grids of light travel times and cos(zenith distance), one per target coordinates, location and julian day
+_grids = {}
+_lock = threading.Lock()
+_state = {"enabled": False, "filename": "", "tolerance": 1e-6, "airmass_tolerance": 1e-5}
+
+# airmass range where the interpolation error of airmass is checked
+_AIRMASS_RANGE = (1., 5.)
+# initial and minimum grid steps in units of day
+_INITIAL_STEP = 1 / 288
+_MIN_STEP = 1 / 86400
+
+
+def enable_cache(filename="", tolerance=1e-6, airmass_tolerance=1e-5) :
+    """ SPARC4 pipeline module to enable the ephemeris cache
+    Parameters
+    ----------
+    filename : str, optional
+        FITS file to load the cache from and to save new grids to. If empty, the cache is kept in memory only
+    tolerance : float, optional
+        maximum interpolation error of light travel times (s)
+    airmass_tolerance : float, optional
+        maximum interpolation error of airmass
+    """
+    with _lock :
+        _state["enabled"] = True
+        _state["tolerance"] = tolerance
+        _state["airmass_tolerance"] = airmass_tolerance
+        _state["filename"] = filename
+        _grids.clear()
+        if filename != "" and os.path.exists(filename) :
+            _load(filename)
+
+
+def disable_cache() :
+    """ SPARC4 pipeline module to disable the ephemeris cache """
+    with _lock :
+        _state["enabled"] = False
+        _state["filename"] = ""
+        _grids.clear()
+
+
+def is_enabled() :
+    """ SPARC4 pipeline module to check whether the ephemeris cache is enabled """
+    return _state["enabled"]
+
+
+def _get_key(source, location, day) :
+    """ Get the grid key for a target, an observatory location and a julian day number """
+    lon, lat, height = location.to_geodetic()
+    return "{:.7f}:{:.7f}:{:.7f}:{:.7f}:{:.1f}:{:d}".format(source.ra.deg, source.dec.deg, lon.deg, lat.deg, height.to_value(u.m), int(day))
+
+
+def _compute(jd, source, location) :
+    """ Calculate barycentric and heliocentric light travel times (day) and cos(zenith distance) at given UTC julian dates """
+    obstime = Time(jd, format='jd', scale='utc', location=location)
+    ltt_bary = obstime.light_travel_time(source).jd
+    ltt_helio = obstime.light_travel_time(source, 'heliocentric').jd
+    # interpolate 1/airmass, which is smooth, while airmass diverges at the horizon
+    cosz = 1 / source.transform_to(AltAz(obstime=obstime, location=location)).secz.value
+    return np.array([ltt_bary, ltt_helio, cosz])
+
+
+def _interpolation_errors(jd, values, midjd, midvalues) :
+    """ Get the errors of the cubic spline interpolation of a grid at its midpoints """
+    interp = CubicSpline(jd, values, axis=1)(midjd)
+    ltt_error = np.max(np.abs(midvalues[:2] - interp[:2])) * 86400
+
+    airmass_error = 0.
+    airmass = 1 / midvalues[2]
+    in_range = (airmass >= _AIRMASS_RANGE[0]) & (airmass <= _AIRMASS_RANGE[1])
+    if np.any(in_range) :
+        airmass_error = np.max(np.abs(airmass[in_range] - 1 / interp[2][in_range]))
+
+    return ltt_error, airmass_error
+
+
+def _build_grid(source, location, day) :
+    """ Build a grid over a julian day, halving the step until the interpolation errors are within tolerances """
+    step = _INITIAL_STEP
+    jd = day + np.arange(0, 1 + step / 2, step)
+    values = _compute(jd, source, location)
+
+    while True :
+        midjd = (jd[:-1] + jd[1:]) / 2
+        midvalues = _compute(midjd, source, location)
+
+        ltt_error, airmass_error = _interpolation_errors(jd, values, midjd, midvalues)
+        if (ltt_error <= _state["tolerance"] and airmass_error <= _state["airmass_tolerance"]) or step / 2 < _MIN_STEP :
+            break
+
+        # midpoints become new grid nodes
+        newjd = np.empty(len(jd) + len(midjd))
+        newjd[0::2], newjd[1::2] = jd, midjd
+        newvalues = np.empty((3, len(newjd)))
+        newvalues[:, 0::2], newvalues[:, 1::2] = values, midvalues
+        jd, values, step = newjd, newvalues, step / 2
+
+    return jd, values, CubicSpline(jd, values, axis=1)
+
+
+def get_time_corrections(jd, source, location) :
+    """ SPARC4 pipeline module to get light travel times and airmass interpolated from the ephemeris cache
+    Parameters
+    ----------
+    jd : float or numpy.ndarray
+        UTC julian dates
+    source : astropy.coordinates.SkyCoord
+        target coordinates
+    location : astropy.coordinates.EarthLocation
+        observatory location
+
+    Returns
+    -------
+    ltt_bary, ltt_helio : numpy.ndarray
+        barycentric and heliocentric light travel times (day)
+    airmass : numpy.ndarray
+        airmass
+    """
+    jd = np.atleast_1d(np.asarray(jd, dtype=float))
+    days = np.floor(jd)
+
+    ltt_bary, ltt_helio, airmass = np.empty_like(jd), np.empty_like(jd), np.empty_like(jd)
+
+    for day in np.unique(days) :
+        key = _get_key(source, location, day)
+
+        with _lock :
+            grid = _grids.get(key)
+
+        if grid is None :
+            grid = _build_grid(source, location, day)
+            with _lock :
+                _grids[key] = grid
+                if _state["filename"] != "" :
+                    _save(_state["filename"])
+
+        sel = days == day
+        interp = grid[2](jd[sel])
+        ltt_bary[sel], ltt_helio[sel], airmass[sel] = interp[0], interp[1], 1 / interp[2]
+
+    return ltt_bary, ltt_helio, airmass
+
+
+def _load(filename) :
+    """ Load grids saved with the current or tighter tolerances """
+    try :
+        with fits.open(filename) as hdul :
+            for hdu in hdul[1:] :
+                hdr = hdu.header
+                if hdr["LTTTOL"] > _state["tolerance"] or hdr["AIRMTOL"] > _state["airmass_tolerance"] :
+                    continue
+                jd = np.array(hdu.data["JD"])
+                values = np.array([hdu.data["LTTBARY"], hdu.data["LTTHELIO"], hdu.data["COSZ"]])
+                _grids[hdr["GRIDKEY"]] = (jd, values, CubicSpline(jd, values, axis=1))
+    except :
+        print("WARNING: could not read ephemeris cache file {}, ignoring ...".format(filename))
+
+
+def _save(filename) :
+    """ Save all grids to a FITS file, one table extension per grid """
+    hdus = [fits.PrimaryHDU()]
+    for key, (jd, values, spline) in _grids.items() :
+        hdu = fits.BinTableHDU.from_columns([fits.Column(name="JD", format="D", array=jd),
+                                             fits.Column(name="LTTBARY", format="D", array=values[0]),
+                                             fits.Column(name="LTTHELIO", format="D", array=values[1]),
+                                             fits.Column(name="COSZ", format="D", array=values[2])])
+        # RA:DEC:LON:LAT:ALT:JDAY of grid
+        hdu.header.set("GRIDKEY", key)
+        hdu.header.set("LTTTOL", _state["tolerance"], "[s] light travel time interpolation tolerance")
+        hdu.header.set("AIRMTOL", _state["airmass_tolerance"], "airmass interpolation tolerance")
+        hdus.append(hdu)
+    try :
+        fits.HDUList(hdus).writeto(filename, overwrite=True)
+    except :
+        print("WARNING: could not save ephemeris cache file {}".format(filename))
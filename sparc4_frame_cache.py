@@ -0,0 +1,180 @@
+"""
+    Created on Oct 18 2026
+
+    Description: Disk cache of calibrated frames of the SPARC4 pipeline
+
+    Laboratório Nacional de Astrofísica - LNA/MCTI
+    """
+
+__version__ = "1.0"
+
+__copyright__ = """
+    Copyright (c) ...  All rights reserved.
+    """
+
+import os
+import json
+
+import numpy as np
+import astropy.units as u
+from astropop.framedata import FrameData
+
+import sparc4_provenance as s4prov
+
+
+def get_key(filename, bias_file="", flat_file="", **params) :
+    """ SPARC4 pipeline module to get the cache key of a calibrated frame
+
+    The key depends on the identity (name, size and modification time) of the raw
+    frame and of the master calibrations, and on the calibration parameters, so a
+    cached frame is never used after any of them changes.
+
+    Parameters
+    ----------
+    filename : str
+        raw frame file path
+    bias_file : str, optional
+        master bias file path
+    flat_file : str, optional
+        master flat file path
+    params : dict
+        calibration parameters, e.g. gain, cosmics
+
+    Returns
+    -------
+    key : str
+        hex digest
+    """
+    return s4prov.get_hash([filename, bias_file, flat_file], params)
+
+
+def _paths(cache_dir, key) :
+    """ Get the data, mask and metadata file paths of a cached frame """
+    base = os.path.join(cache_dir, key)
+    return base + ".npy", base + "_mask.npy", base + ".json"
+
+
+def load(cache_dir, key, header=None, dtype=None) :
+    """ SPARC4 pipeline module to load a calibrated frame from the cache
+    Parameters
+    ----------
+    cache_dir : str
+        cache directory
+    key : str
+        cache key, see get_key
+    header : astropy.io.fits.Header, optional
+        header of the frame
+    dtype : numpy.dtype, optional
+        required data type, None for the type of the cached frame. Frames cached with another type are not loaded
+
+    Returns
+    -------
+    frame : astropop.framedata.FrameData
+        calibrated frame with data and uncertainty memory mapped from the cache, or None if not cached
+    """
+    data_file, mask_file, meta_file = _paths(cache_dir, key)
+
+    try :
+        with open(meta_file, "r") as f :
+            meta = json.load(f)
+        cube = np.load(data_file, mmap_mode='r')
+        mask = np.load(mask_file) if meta["MASK"] else None
+    except :
+        return None
+
+    if dtype is not None and cube.dtype != np.dtype(dtype) :
+        return None
+
+    # mark as recently used for eviction
+    for filename in (data_file, meta_file) :
+        os.utime(filename)
+
+    return FrameData(cube[0], unit=u.Unit(meta["UNIT"]), dtype=cube.dtype, uncertainty=cube[1], mask=mask, header=header)
+
+
+def save(cache_dir, key, frame, dtype=np.float32) :
+    """ SPARC4 pipeline module to save a calibrated frame to the cache
+    Parameters
+    ----------
+    cache_dir : str
+        cache directory
+    key : str
+        cache key, see get_key
+    frame : astropop.framedata.FrameData
+        calibrated frame
+    dtype : numpy.dtype, optional
+        data type to store data and uncertainty
+    """
+    data_file, mask_file, meta_file = _paths(cache_dir, key)
+
+    cube = np.empty((2,) + frame.shape, dtype=dtype)
+    cube[0] = frame.data
+    cube[1] = frame.get_uncertainty(return_none=False)
+
+    mask = frame.mask
+    has_mask = mask is not None and bool(np.any(mask))
+
+    # files are written to temporary names and renamed, so readers never see partial frames.
+    # The metadata is written last, so a frame is only loaded when all its files exist
+    pid = os.getpid()
+    try :
+        if not os.path.exists(cache_dir) :
+            os.makedirs(cache_dir, exist_ok=True)
+        with open("{}.{}.tmp".format(data_file, pid), "wb") as f :
+            np.save(f, cube)
+        os.replace("{}.{}.tmp".format(data_file, pid), data_file)
+        if has_mask :
+            with open("{}.{}.tmp".format(mask_file, pid), "wb") as f :
+                np.save(f, np.asarray(mask, dtype=bool))
+            os.replace("{}.{}.tmp".format(mask_file, pid), mask_file)
+        with open("{}.{}.tmp".format(meta_file, pid), "w") as f :
+            json.dump({"UNIT": str(frame.unit), "MASK": has_mask}, f)
+        os.replace("{}.{}.tmp".format(meta_file, pid), meta_file)
+    except :
+        print("WARNING: could not save calibrated frame to cache {}".format(cache_dir))
+
+
+def evict(cache_dir, max_size) :
+    """ SPARC4 pipeline module to bound the disk use of the cache, removing least recently used frames first
+    Parameters
+    ----------
+    cache_dir : str
+        cache directory
+    max_size : float
+        maximum size of the cache (GB)
+
+    Returns
+    -------
+    nremoved : int
+        number of frames removed from the cache
+    """
+    if not os.path.exists(cache_dir) :
+        return 0
+
+    # group files by key, with total size and time of last use
+    frames = {}
+    for entry in os.scandir(cache_dir) :
+        if not entry.is_file() or entry.name.endswith(".tmp") :
+            continue
+        key = entry.name.split(".")[0].replace("_mask", "")
+        st = entry.stat()
+        size, mtime = frames.get(key, (0, 0))
+        frames[key] = (size + st.st_size, max(mtime, st.st_mtime))
+
+    total = sum(size for size, mtime in frames.values())
+    max_bytes = max_size * 1024**3
+
+    nremoved = 0
+    for key in sorted(frames.keys(), key=lambda k: frames[k][1]) :
+        if total <= max_bytes :
+            break
+        for filename in _paths(cache_dir, key) :
+            if os.path.exists(filename) :
+                os.remove(filename)
+        total -= frames[key][0]
+        nremoved += 1
+
+    if nremoved :
+        print("Removed {} calibrated frames from cache {} to keep it under {} GB".format(nremoved, cache_dir, max_size))
+
+    return nremoved
@@ -0,0 +1,105 @@
+"""
+    Created on Oct 18 2026
+
+    Description: Process-wide cache of FITS headers for the SPARC4 pipeline
+
+    Laboratório Nacional de Astrofísica - LNA/MCTI
+    """
+
+__version__ = "1.0"
+
+__copyright__ = """
+    Copyright (c) ...  All rights reserved.
+    """
+
+import os
+import threading
+from collections import OrderedDict
+
+from astropy.io import fits
+
+# cached headers, from least to most recently used
+_cache = OrderedDict()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "maxsize": 4096}
+
+
+def _get_key(filename, ext=0) :
+    """ Get the cache key of a header, which changes whenever the file is modified """
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_mtime_ns, st.st_size, ext)
+
+
+def getheader(filename, ext=0, copy=True) :
+    """ SPARC4 pipeline module to get a FITS header through the header cache
+    Parameters
+    ----------
+    filename : str
+        FITS file path
+    ext : int or str, optional
+        FITS extension index or name
+    copy : bool, optional
+        to return a copy of the cached header, set to False only for read-only access
+
+    Returns
+    -------
+    hdr : astropy.io.fits.Header
+        FITS header
+    """
+    key = _get_key(filename, ext)
+
+    with _lock :
+        hdr = _cache.get(key)
+        if hdr is not None :
+            _cache.move_to_end(key)
+            _stats["hits"] += 1
+
+    if hdr is None :
+        hdr = fits.getheader(filename, ext)
+        with _lock :
+            _stats["misses"] += 1
+            _cache[key] = hdr
+            _cache.move_to_end(key)
+            while len(_cache) > _stats["maxsize"] :
+                _cache.popitem(last=False)
+
+    if copy :
+        return hdr.copy()
+    return hdr
+
+
+def set_cache_size(maxsize) :
+    """ SPARC4 pipeline module to set the maximum number of cached headers
+    Parameters
+    ----------
+    maxsize : int
+        maximum number of headers kept in cache
+    """
+    with _lock :
+        _stats["maxsize"] = max(0, int(maxsize))
+        while len(_cache) > _stats["maxsize"] :
+            _cache.popitem(last=False)
+
+
+def clear_cache() :
+    """ SPARC4 pipeline module to remove all cached headers and reset counters """
+    with _lock :
+        _cache.clear()
+        _stats["hits"], _stats["misses"] = 0, 0
+
+
+def cache_info() :
+    """ SPARC4 pipeline module to get the header cache statistics
+    Returns
+    -------
+    info : dict
+        number of hits, misses, cached headers and maximum cache size
+    """
+    with _lock :
+        return {"hits": _stats["hits"], "misses": _stats["misses"], "size": len(_cache), "maxsize": _stats["maxsize"]}
+
+
+def print_cache_info() :
+    """ SPARC4 pipeline module to print the header cache statistics """
+    info = cache_info()
+    print("Header cache: {} hits, {} misses, {} headers cached (max {})".format(info["hits"], info["misses"], info["size"], info["maxsize"]))
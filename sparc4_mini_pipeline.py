@@ -14,6 +14,8 @@
     python sparc4_mini_pipeline.py --nightdir=20230604 --datadir=/Volumes/Samsung_T5/Data/SPARC4/comissioning_jun23/ --reducedir=/Volumes/Samsung_T5/Data/SPARC4/comissioning_jun23/reduced -v
     
     python sparc4_mini_pipeline.py --nightdir=20230606 --datadir=/Volumes/Samsung_T5/Data/SPARC4/standards --reducedir=/Volumes/Samsung_T5/Data/SPARC4/standards/reduced -v
+
+    python sparc4_mini_pipeline.py --nightdir=20230503 --jobs=4 -v
     """
 
 __version__ = "1.0"
@@ -23,46 +25,51 @@ __copyright__ = """
     """
 
 import os,sys
+import time
+from copy import deepcopy
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from optparse import OptionParser
 
 import sparc4_product_plots as s4plt
 import sparc4_pipeline_lib as s4pipelib
 import sparc4_utils as s4utils
 import sparc4_db as s4db
+import sparc4_header_cache as s4hc
+import sparc4_ephemeris as s4eph
+import sparc4_calib_library as s4cl
 
 import numpy as np
 
 sparc4_pipeline_dir = os.path.dirname(__file__)
 calibdb_dir = os.path.join(sparc4_pipeline_dir,"calibdb/")
 
-parser = OptionParser()
-parser.add_option("-d", "--datadir", dest="datadir", help="data directory",type='string',default="")
-parser.add_option("-r", "--reducedir", dest="reducedir", help="Reduced data directory",type='string',default="")
-parser.add_option("-c", "--channels", dest="channels", help="SPARC4 channels: e.g '1,3,4' ",type='string',default="1,2,3,4")
-parser.add_option("-a", "--nightdir", dest="nightdir", help="Name of night directory common to all channels",type='string',default="")
-parser.add_option("-f", action="store_true", dest="force", help="Force reduction", default=False)
-parser.add_option("-p", action="store_true", dest="plot", help="plot", default=False)
-parser.add_option("-v", action="store_true", dest="verbose", help="verbose", default=False)
-
-try:
-    options,args = parser.parse_args(sys.argv[1:])
-except:
-    print("Error: check usage with  -h sparc4_mini_pipeline.py")
-    sys.exit(1)
-
-match_frames = True
-fit_zero_of_wppos = True
-
-# initialize pipeline parameters
-p = s4pipelib.init_s4_p(options.nightdir,
-                        options.datadir,
-                        options.reducedir,
-                        options.channels,
-                        print_report=options.verbose)
-
-# Run full reduction for selected channels
-for channel in p['SELECTED_CHANNELS'] :
-#for j in range(1,2) :
+def reduce_channel(p, channel, options, match_frames=True, fit_zero_of_wppos=True) :
+    """ SPARC4 pipeline module to run the full reduction of a night for one channel
+
+    Parameters
+    ----------
+    p : dict
+        dictionary with pipeline parameters, not shared with other channels
+    channel : int
+        SPARC4 channel
+    options : optparse.Values
+        command line options
+    match_frames : bool, optional
+        to match frames
+    fit_zero_of_wppos : bool, optional
+        to fit the zero of wave plate positions in polarimetric L4 mode
+
+    Returns
+    -------
+    p : dict
+        dictionary with pipeline parameters
+    """
+
+    # load library of master calibrations of all nights
+    calib_library = None
+    if p["USE_CALIB_LIBRARY"] :
+        calib_library = s4cl.CalibrationLibrary(p['calib_library_dir'])
 
     # set zero based index of current channel
     j = channel - 1
@@ -71,12 +78,23 @@ for channel in p['SELECTED_CHANNELS'] :
     ch_reduce_dir = p['ch_reduce_directories'][j]
     reduce_dir = p['reduce_directories'][j]
 
-    # if db doesn't exist create one
-    if not os.path.exists(p['s4db_files'][j]) or options.force:
-        db = s4db.create_db_from_observations(p['filelists'][j], p['DB_KEYS'], include_img_statistics=p["INCLUDE_IMG_STATISTICS"], include_only_fullframe=p["FULL_FRAMES_ONLY"], output=p['s4db_files'][j])
+    # if db doesn't exist create one, or update it with new frames in incremental mode
+    if not os.path.exists(p['s4db_files'][j]) or options.force or p["DB_INCREMENTAL"] :
+        db = s4db.create_db_from_observations(p['filelists'][j], p['DB_KEYS'], include_img_statistics=p["INCLUDE_IMG_STATISTICS"], include_only_fullframe=p["FULL_FRAMES_ONLY"], output=p['s4db_files'][j], nthreads=p["DB_NTHREADS"], nprocesses=p["DB_NPROCESSES"], saturation_limit=p["SATURATION_LIMIT"], fwhm_binning=p["DB_FWHM_BINNING"], incremental=p["DB_INCREMENTAL"] and not options.force)
     else :
         db = s4db.create_db_from_file(p['s4db_files'][j])
-        
+
+    if p["DB_BACKEND"] == 'sqlite' :
+        # store night database in the SQLite database and run selections as SQL queries
+        db = s4db.SQLiteDB(p['s4db_sqlite']).ingest(db, p['CHANNELS'][j], options.nightdir, index_keys=p['DB_KEYS'])
+    else :
+        # index database once for all selections below
+        db = s4db.NightIndex(db)
+
+    if p["USE_EPHEMERIS_CACHE"] :
+        # load (or start) ephemeris cache of this night to calculate time keywords
+        s4eph.enable_cache(p['s4ephem_files'][j], tolerance=p["EPHEMERIS_CACHE_TOLERANCE"], airmass_tolerance=p["EPHEMERIS_CACHE_AIRMASS_TOLERANCE"])
+
     # detect all detector modes
     detector_modes = s4db.get_detector_modes_observed(db, science_only=True, detector_keys=p["DETECTOR_MODE_KEYWORDS"])
 
@@ -86,7 +104,7 @@ for channel in p['SELECTED_CHANNELS'] :
         zero_list = s4db.get_file_list(db, obstype=p['BIAS_OBSTYPE_KEYVALUE'], detector_mode=detector_modes[key])
         # calculate master bias
         p["master_bias"] = "{}/{}_s4c{}{}_MasterZero.fits".format(reduce_dir,options.nightdir,p['CHANNELS'][j],key)
-        p = s4pipelib.run_master_calibration(p, inputlist=zero_list, output=p["master_bias"], obstype='bias', data_dir=data_dir, reduce_dir=reduce_dir, force=options.force)
+        p = s4pipelib.run_master_calibration(p, inputlist=zero_list, output=p["master_bias"], obstype='bias', data_dir=data_dir, reduce_dir=reduce_dir, force=options.force, library=calib_library, library_key=s4cl.get_key(p['CHANNELS'][j], "MasterZero", key), night=options.nightdir)
 
         # create a list of sky flats
         skyflat_list = s4db.get_file_list(db, detector_mode=detector_modes[key], skyflat=True)
@@ -99,7 +117,7 @@ for channel in p['SELECTED_CHANNELS'] :
         flat_list = s4db.get_file_list(db, obstype=p['FLAT_OBSTYPE_KEYVALUE'], detector_mode=detector_modes[key])
         # calculate master dome flat
         p["master_flat"] = "{}/{}_s4c{}{}_MasterDomeFlat.fits".format(reduce_dir,options.nightdir,p['CHANNELS'][j],key)
-        p = s4pipelib.run_master_calibration(p, inputlist=flat_list, output=p["master_flat"], obstype='flat', data_dir=data_dir, reduce_dir=reduce_dir, normalize=True, force=options.force)
+        p = s4pipelib.run_master_calibration(p, inputlist=flat_list, output=p["master_flat"], obstype='flat', data_dir=data_dir, reduce_dir=reduce_dir, normalize=True, force=options.force, library=calib_library, library_key=s4cl.get_key(p['CHANNELS'][j], "MasterDomeFlat", key), night=options.nightdir)
 
         # set astrometry ref image as the one for this channel
         p["ASTROM_REF_IMG"] = os.path.join(calibdb_dir,p["ASTROM_REF_IMGS"][j])
@@ -121,3 +139,87 @@ for channel in p['SELECTED_CHANNELS'] :
             p = s4pipelib.reduce_sci_data(db, p, j, p['INSTMODE_POLARIMETRY_KEYVALUE'], detector_modes[key], options.nightdir, reduce_dir, polar_mode=p['POLARIMETRY_L4_KEYVALUE'], fit_zero=fit_zero_of_wppos, detector_mode_key=key, match_frames=match_frames, force=options.force, verbose=options.verbose, plot=options.plot)
         except :
             print("WARNING: Could not reduce {}-{} mode detector mode {} ".format( p['INSTMODE_POLARIMETRY_KEYVALUE'],p['POLARIMETRY_L4_KEYVALUE'],key))
+
+    return p
+
+
+def run_channel_job(p, channel, options, logfile) :
+    """ SPARC4 pipeline module to reduce one channel in a separate process, with its output written to a log file
+
+    Returns
+    -------
+    channel, elapsed, status : int, float, bool
+        channel, time spent (s) and whether the reduction finished without errors
+    """
+    tini = time.time()
+    status = True
+    with open(logfile, "w") as log, redirect_stdout(log), redirect_stderr(log) :
+        try :
+            reduce_channel(p, channel, options)
+        except Exception as e :
+            print("ERROR: reduction of channel {} failed: {}".format(channel, e))
+            status = False
+        # print how many header reads were avoided by the header cache in this process
+        s4hc.print_cache_info()
+    return channel, time.time() - tini, status
+
+
+def main() :
+
+    parser = OptionParser()
+    parser.add_option("-d", "--datadir", dest="datadir", help="data directory",type='string',default="")
+    parser.add_option("-r", "--reducedir", dest="reducedir", help="Reduced data directory",type='string',default="")
+    parser.add_option("-c", "--channels", dest="channels", help="SPARC4 channels: e.g '1,3,4' ",type='string',default="1,2,3,4")
+    parser.add_option("-a", "--nightdir", dest="nightdir", help="Name of night directory common to all channels",type='string',default="")
+    parser.add_option("-j", "--jobs", "--parallel-channels", dest="jobs", help="Number of channels reduced at the same time, each in its own process",type='int',default=1)
+    parser.add_option("-f", action="store_true", dest="force", help="Force reduction", default=False)
+    parser.add_option("-p", action="store_true", dest="plot", help="plot", default=False)
+    parser.add_option("-v", action="store_true", dest="verbose", help="verbose", default=False)
+
+    try:
+        options,args = parser.parse_args(sys.argv[1:])
+    except:
+        print("Error: check usage with  -h sparc4_mini_pipeline.py")
+        sys.exit(1)
+
+    # initialize pipeline parameters
+    p = s4pipelib.init_s4_p(options.nightdir,
+                            options.datadir,
+                            options.reducedir,
+                            options.channels,
+                            print_report=options.verbose)
+
+    njobs = min(options.jobs, len(p['SELECTED_CHANNELS']))
+
+    if njobs > 1 and not options.plot :
+        # channels share nothing but the parameters, so each one is reduced in its own process with its own copy of them
+        print("Reducing channels {} in {} parallel jobs ... ".format(p['SELECTED_CHANNELS'], njobs))
+        tini = time.time()
+        with ProcessPoolExecutor(max_workers=njobs) as executor :
+            futures = {}
+            for channel in p['SELECTED_CHANNELS'] :
+                j = channel - 1
+                logfile = os.path.join(p['reduce_directories'][j], "{}_s4c{}_pipeline.log".format(options.nightdir, p['CHANNELS'][j]))
+                print("Started channel {} -> log: {}".format(channel, logfile))
+                futures[executor.submit(run_channel_job, deepcopy(p), channel, options, logfile)] = logfile
+
+            # report channels as they finish
+            for k, future in enumerate(as_completed(futures)) :
+                channel, elapsed, status = future.result()
+                print("Finished channel {} ({} of {}) in {:.1f} s, {} -> log: {}".format(channel, k+1, len(futures), elapsed, "OK" if status else "FAILED", futures[future]))
+
+        print("All channels reduced in {:.1f} s".format(time.time() - tini))
+    else :
+        if njobs > 1 :
+            print("WARNING: plots are not supported with parallel channels, reducing channels one after another ...")
+
+        # Run full reduction for selected channels
+        for channel in p['SELECTED_CHANNELS'] :
+            p = reduce_channel(p, channel, options)
+
+        # print how many header reads were avoided by the header cache
+        s4hc.print_cache_info()
+
+
+if __name__ == "__main__" :
+    main()
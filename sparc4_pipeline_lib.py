@@ -15,12 +15,19 @@ __copyright__ = """
     """
 
 import os,sys
+import time
+import tempfile
+import warnings
 
 import sparc4_products as s4p
 import sparc4_product_plots as s4plt
 import sparc4_params
 import sparc4_utils as s4utils
 import sparc4_db as s4db
+import sparc4_header_cache as s4hc
+import sparc4_provenance as s4prov
+import sparc4_frame_cache as s4fc
+import sparc4_registration as s4reg
 
 import glob
 
@@ -32,6 +39,7 @@ from astropy.time import Time
 from astropy.modeling import models, fitting
 
 from astropop.file_collection import FitsFileGroup
+from astropop.framedata import FrameData, check_framedata
 # astropop used modules
 from astropop.image import imcombine, processing, imarith
 from astropop.photometry import background, starfind
@@ -50,6 +58,9 @@ from astropop.polarimetry import match_pairs, estimate_dxdy, SLSDualBeamPolarime
 from uncertainties import ufloat, umath
 
 from copy import deepcopy
+from itertools import repeat
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from astropy.coordinates import SkyCoord
 from astropop.astrometry import solve_astrometry_xy
@@ -58,6 +69,21 @@ from astropy.wcs.utils import proj_plane_pixel_scales
 
 from scipy import signal
 
+# pipeline parameters that affect the products of each stage, recorded in the provenance manifest
+CALIB_PROVENANCE_KEYS = ['CALIB_IMCOMBINE_METHOD', 'CALIB_CR_METHOD', 'CALIB_CR_NSIGMA', 'PRECISION', 'MASK_FORMAT']
+# only parameters loaded from the params file, radii derived from the stack are covered by hashing the stack itself
+PHOT_PROVENANCE_KEYS = ['TIME_KEY', 'SHIFT_ALGORITHM', 'MATCH_PAIRS_TOLERANCE', 'PLATE_SCALE', 'SEARCH_RADIUS', 'TWEAK_ORDER',
+                        'PHOT_THRESHOLD', 'PHOT_APERTURES', 'PHOT_FIXED_APERTURE', 'MULTI_APERTURES',
+                        'PHOT_APERTURE_N_X_FWHM', 'PHOT_SKYINNER_N_X_FWHM', 'PHOT_SKYOUTER_N_X_FWHM', 'PHOT_FIXED_R_ANNULUS',
+                        'PHOT_MIN_OFFSET_FOR_SKYINNERRADIUS', 'PHOT_MIN_OFFSET_FOR_SKYOUTERRADIUS', 'PRECISION',
+                        'CALIBRATION_KERNEL']
+STACK_PROVENANCE_KEYS = PHOT_PROVENANCE_KEYS + ['NFILES_FOR_STACK', 'SATURATION_LIMIT', 'SCI_STACK_METHOD', 'SCI_STACK_SIGMA_CLIP',
+                                                'STACK_SELECTION_METRIC', 'DB_FWHM_BINNING']
+# only recorded with the fft and catalog registration engines, so products registered by astropop keep their provenance
+REGISTRATION_PROVENANCE_KEYS = ['REGISTRATION_ENGINE', 'REGISTRATION_BINNING', 'REGISTRATION_UPSAMPLE_FACTOR',
+                                'CATALOG_MATCH_MAX_SHIFT', 'CATALOG_MATCH_TOLERANCE', 'CATALOG_MATCH_MIN_SOURCES']
+
+
 def init_s4_p(nightdir, datadir="", reducedir="", channels="", print_report=False) :
     """ Pipeline module to initialize SPARC4 parameters
     Parameters
@@ -82,6 +108,9 @@ def init_s4_p(nightdir, datadir="", reducedir="", channels="", print_report=Fals
     # load pipeline parameters
     p = sparc4_params.load_sparc4_parameters()
 
+    # set size of the header cache shared by all pipeline modules
+    s4hc.set_cache_size(p['HEADER_CACHE_SIZE'])
+
     if datadir != "" :
         p['ROOTDATADIR'] = datadir
 
@@ -107,8 +136,15 @@ def init_s4_p(nightdir, datadir="", reducedir="", channels="", print_report=Fals
     p['ch_reduce_directories'] = []
     p['reduce_directories'] = []
     p['s4db_files'] = []
+    p['s4ephem_files'] = []
     p['filelists'] = []
 
+    # library of master calibrations of all nights and channels
+    p['calib_library_dir'] = '{}/{}/'.format(p['ROOTREDUCEDIR'],p['CALIB_LIBRARY_DIRNAME'])
+
+    # database of all nights and channels when using the sqlite backend
+    p['s4db_sqlite'] = '{}/{}'.format(p['ROOTREDUCEDIR'],p['SQLITE_DB_FILENAME'])
+
     for j in range(len(p['CHANNELS'])) :
         # figure out directory structures
         ch_night_data_dir = '{}/sparc4acs{}/{}/'.format(p['ROOTDATADIR'],p['CHANNELS'][j],nightdir)
@@ -135,6 +171,9 @@ def init_s4_p(nightdir, datadir="", reducedir="", channels="", print_report=Fals
         
         p['s4db_files'].append(db_file)
 
+        # ephemeris cache is saved alongside the night database
+        p['s4ephem_files'].append(db_file.replace("_db.fits","_ephem.fits"))
+
     return p
 
 
@@ -144,8 +183,8 @@ def reduce_sci_data(db, p, channel_index, inst_mode, detector_mode, nightdir, re
 
     Parameters
     ----------
-    db : astropy.table
-        data base table
+    db : astropy.table, s4db.NightIndex or s4db.SQLiteDB
+        data base table, its index, or the SQLite database scoped to the night
     p : dict
         dictionary to store pipeline parameters
     channel_index : int
@@ -204,6 +243,9 @@ def reduce_sci_data(db, p, channel_index, inst_mode, detector_mode, nightdir, re
 
         sci_list = s4db.get_file_list(db, object_id=obj, inst_mode=inst_mode, polar_mode=polar_mode, obstype=p['OBJECT_OBSTYPE_KEYVALUE'], calwheel_mode=None, detector_mode=detector_mode)
 
+        # get quality statistics of the science frames stored in the database, to select frames for the stack without reading them
+        quality = s4db.get_frame_quality(db, sci_list)
+
         # run stack and reduce individual science images (produce *_proc.fits)
         p = stack_and_reduce_sci_images(p,
                                         sci_list,
@@ -214,7 +256,8 @@ def reduce_sci_data(db, p, channel_index, inst_mode, detector_mode, nightdir, re
                                         match_frames=match_frames,
                                         polarimetry=polarimetry,
                                         verbose=verbose,
-                                        plot=plot)
+                                        plot=plot,
+                                        quality=quality)
 
         # set suffix for output time series filename
         ts_suffix = "{}_s4c{}_{}{}".format(nightdir,p['CHANNELS'][channel_index],obj.replace(" ",""),polsuffix)
@@ -260,8 +303,19 @@ def reduce_sci_data(db, p, channel_index, inst_mode, detector_mode, nightdir, re
                 compute_k = False
                 zero = p['ZERO_OF_WAVEPLATE']
                 
-            # divide input list into a many sequences
-            pol_sequences = s4utils.select_polar_sequences(p['OBJECT_REDUCED_IMAGES'], sortlist=True, verbose=verbose)
+            npositions = p['POLARIMETRY_L2_NPOSITIONS']
+            if polar_mode == p['POLARIMETRY_L4_KEYVALUE'] :
+                npositions = p['POLARIMETRY_L4_NPOSITIONS']
+
+            # divide input list into many sequences using WPPOS and DATE-OBS from the database
+            raw_sequences = s4db.get_polar_sequences(db, obj, detector_mode, polar_mode, npositions=npositions, drop_incomplete=p['DROP_INCOMPLETE_POLAR_SEQUENCES'], verbose=verbose)
+
+            # map raw files into reduced files
+            reduced_images = set(p['OBJECT_REDUCED_IMAGES'])
+            pol_sequences = []
+            for seq in raw_sequences :
+                proc_seq = [os.path.join(reduce_dir, os.path.basename(f).replace(".fits","_proc.fits")) for f in seq]
+                pol_sequences.append([f for f in proc_seq if f in reduced_images])
 
             p['PolarProducts'] = []
             
@@ -303,7 +357,7 @@ def reduce_sci_data(db, p, channel_index, inst_mode, detector_mode, nightdir, re
     return p
 
 
-def run_master_calibration(p, inputlist=[], output="", obstype='bias', data_dir="./", reduce_dir="./", normalize=False, force=False) :
+def run_master_calibration(p, inputlist=[], output="", obstype='bias', data_dir="./", reduce_dir="./", normalize=False, force=False, library=None, library_key="", night="") :
     """ Pipeline module to run master calibration
 
     Parameters
@@ -322,6 +376,13 @@ def run_master_calibration(p, inputlist=[], output="", obstype='bias', data_dir=
         Boolean to decide whether or not to normalize the data
     force : bool, optional
         Boolean to decide whether or not to force reduction if a product already exists
+    library : sparc4_calib_library.CalibrationLibrary, optional
+        calibration library to fall back to the nearest master when there are no
+        input images, and to register new masters
+    library_key : str, optional
+        library key of this master, see sparc4_calib_library.get_key
+    night : str, optional
+        night directory name (YYYYMMDD), used for the library
 
     Returns
     -------
@@ -345,13 +406,33 @@ def run_master_calibration(p, inputlist=[], output="", obstype='bias', data_dir=
     # set master calib keyword in parameters
     p["master_{}".format(obstype)] = output
 
-    # Skip if product already exists and reduction is not forced
-    if os.path.exists(output) and not force :
+    if library is not None and inputlist == [] :
+        # no calibration images in this night, fall back to the nearest master in the library
+        window = p['CALIB_LIBRARY_BIAS_WINDOW'] if obstype == 'bias' else p['CALIB_LIBRARY_FLAT_WINDOW']
+        nearest = library.find_nearest(library_key, night, window=window)
+        if nearest is not None :
+            print("No {} images, using master {} from the calibration library".format(obstype, nearest))
+            p["master_{}".format(obstype)] = nearest
+        else :
+            print("WARNING: no {} images and no master {} within {} days in the calibration library".format(obstype, library_key, window))
         return p
 
     # set method to combine images
     method = p['CALIB_IMCOMBINE_METHOD']
 
+    # parameters that affect the master
+    prov_params = s4prov.get_params(p, CALIB_PROVENANCE_KEYS)
+    prov_params.update({'obstype': obstype, 'normalize': normalize})
+
+    # Skip if product is up to date with its inputs and parameters and reduction is not forced
+    if s4prov.is_up_to_date(output, inputlist, prov_params) and not force :
+        if library is not None :
+            # register masters built before the library was used
+            signature = s4prov.get_hash(inputlist, prov_params)
+            if library.find_matching(library_key, signature) is None :
+                library.add(library_key, night, output, signature, ninputs=len(inputlist))
+        return p
+
     if inputlist == [] :
         # select FITS files in the minidata directory and build database
         main_fg = FitsFileGroup(location=data_dir, fits_ext=p['CALIB_WILD_CARDS'], ext=0)
@@ -366,24 +447,33 @@ def run_master_calibration(p, inputlist=[], output="", obstype='bias', data_dir=
     # print total number of bias files selected
     print(f'{obstype} files: {len(filter_fg)}')
 
-    # get frames
-    frames = list(filter_fg.framedata(unit='adu', use_memmap_backend=p['USE_MEMMAP']))
-
     #extract gain from the first image
-    if float(frames[0].header['GAIN']) != 0 :
-        gain = float(frames[0].header['GAIN'])*u.electron/u.adu  # using quantities is better for safety
+    if float(s4hc.getheader(filter_fg.files[0],copy=False)['GAIN']) != 0 :
+        gain = float(s4hc.getheader(filter_fg.files[0],copy=False)['GAIN'])*u.electron/u.adu  # using quantities is better for safety
     else :
         gain = 3.3*u.electron/u.adu
     print('gain:', gain)
 
-    # Perform gain calibration
-    for i, frame in enumerate(frames):
-        print(f'processing frame {i+1} of {len(frames)}')
-        processing.cosmics_lacosmic(frame, inplace=True)
-        processing.gain_correct(frame, gain, inplace=True)
+    # set method to reject cosmic rays
+    cr_method = p['CALIB_CR_METHOD']
+    if cr_method not in ['lacosmic', 'sigclip'] :
+        print("CALIB_CR_METHOD={} not recognized, setting to default = lacosmic".format(cr_method))
+        cr_method = 'lacosmic'
+    if cr_method == 'sigclip' and len(filter_fg) < 10 :
+        print("WARNING: too few frames to reject cosmic rays by sigma clipping, using lacosmic ...")
+        cr_method = 'lacosmic'
 
-    # combine
-    master = imcombine(frames, method=method, use_memmap_backend=p['USE_MEMMAP'])
+    # clean cosmic rays (lacosmic only) and correct gain in parallel, frames are yielded in order
+    frames = calibrate_frames(p, filter_fg.files, gain, cosmics=(cr_method == 'lacosmic'))
+
+    # reject cosmic rays as high outliers across the stack of frames
+    sigma_clip = None
+    if cr_method == 'sigclip' :
+        sigma_clip = (None, p['CALIB_CR_NSIGMA'])
+
+    # combine in blocks of rows within a fixed memory limit
+    master, ncrrej = tiled_imcombine(frames, len(filter_fg), method=method, max_memory=p['CALIB_IMCOMBINE_MAX_MEMORY'], sigma_clip=sigma_clip, tmp_dir=reduce_dir, return_nrejected=True, dtype=np.float32 if p['PRECISION'] == 'float32' else np.float64)
+    print('Cosmic ray method: {}, rejected pixels: {}'.format(cr_method, ncrrej))
 
     # get statistics
     stats = master.statistics()
@@ -404,6 +494,8 @@ def run_master_calibration(p, inputlist=[], output="", obstype='bias', data_dir=
         'DRSINFO': ('astropop', 'data reduction software'),
         'DRSROUT': ('master image', 'data reduction routine'),
         'NORMALIZ': (normalize, 'normalized master'),
+        'CRMETHOD': (cr_method, 'cosmic ray rejection method'),
+        'NCRREJ': (ncrrej, 'number of pixels rejected by sigma clipping'),
         'NORMMEAN': (norm_mean_value.value,'normalization mean value in {}'.format(norm_mean_value.unit)),
         'MINVAL': (stats['min'].value,'minimum value in {}'.format(stats['min'].unit)),
         'MAXVAL': (stats['max'].value,'maximum value in {}'.format(stats['max'].unit)),
@@ -418,11 +510,358 @@ def run_master_calibration(p, inputlist=[], output="", obstype='bias', data_dir=
     mask_data=np.array(master.mask)
 
     # call function masteZero from sparc4_products to generate final product
-    mastercal = s4p.masterCalibration(filter_fg.files, img_data=img_data, err_data=err_data, mask_data=mask_data, info=info, filename=output)
+    mastercal = s4p.masterCalibration(filter_fg.files, img_data=img_data, err_data=err_data, mask_data=mask_data, info=info, filename=output, precision=p['PRECISION'], mask_format=p['MASK_FORMAT'])
+
+    # record inputs and parameters of the new master
+    s4prov.record(output, inputlist, prov_params)
+
+    if library is not None :
+        library.add(library_key, night, output, s4prov.get_hash(inputlist, prov_params), ninputs=len(filter_fg))
 
     return p
 
 
+def tiled_imcombine(frames, nframes, method='median', max_memory=512, sigma_clip=None, tmp_dir=None, return_nrejected=False, dtype=np.float64) :
+    """ Pipeline module to combine images in blocks of rows within a fixed memory limit
+
+    Frames are written one at a time into a memory mapped stack on disk, which
+    is then combined in blocks of rows. The combined data, uncertainty and mask
+    are the same as for astropop's imcombine.
+
+    Parameters
+    ----------
+    frames : iterable of astropop.framedata.FrameData
+        frames to combine, e.g. a generator that loads and calibrates each frame
+    nframes : int
+        number of frames
+    method : str, optional
+        combine method: 'median' or 'mean'
+    max_memory : float, optional
+        maximum memory (in MB) used by the combine buffers
+    sigma_clip : float or tuple, optional
+        threshold (or low and high thresholds) in units of sigma to reject pixels
+        from the median, with sigma calculated from the median absolute deviation
+        of each pixel. As the deviation of a few frames underestimates sigma, sigma
+        is never less than the noise of the block of rows, from the differences
+        between consecutive frames
+    tmp_dir : str, optional
+        directory to save the temporary stack
+    return_nrejected : bool, optional
+        to also return the number of pixels rejected by sigma clipping
+    dtype : numpy.dtype, optional
+        data type of the stack and of the combined frame, np.float32 halves memory and disk usage
+
+    Returns
+    -------
+    master : astropop.framedata.FrameData
+        combined frame
+    nrejected : int
+        number of rejected pixels, only if return_nrejected is True
+    """
+
+    if method not in ['median', 'mean'] :
+        raise ValueError("imcombine method {} not supported, use 'median' or 'mean'".format(method))
+
+    # create temporary file for the stack
+    fd, stack_file = tempfile.mkstemp(suffix=".npy", dir=tmp_dir)
+    os.close(fd)
+
+    try :
+        stack, unit = None, None
+        for i, frame in enumerate(frames) :
+            if stack is None :
+                unit = frame.unit
+                stack = np.lib.format.open_memmap(stack_file, mode='w+', dtype=dtype, shape=(nframes,) + frame.shape)
+            stack[i] = frame.data
+            if frame.mask is not None :
+                stack[i][np.asarray(frame.mask, dtype=bool)] = np.nan
+            del frame
+        stack.flush()
+
+        ny, nx = stack.shape[1:]
+        data = np.full((ny, nx), np.nan, dtype=dtype)
+        unct = np.zeros((ny, nx), dtype=dtype)
+        nrejected = 0
+
+        # number of rows per block, allowing for the temporary copies made by numpy (as in astropop)
+        copies = 4.5 if method == 'median' else 3
+        if sigma_clip is not None :
+            # differences between frames to estimate the noise
+            copies += 1
+        block_rows = int(max(1, np.floor(max_memory * 1024 * 1024 / (nframes * nx * stack.itemsize * copies))))
+
+        with warnings.catch_warnings() :
+            # all-NaN (masked) pixels are expected
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+
+            for y0 in range(0, ny, block_rows) :
+                block = np.array(stack[:, y0:y0+block_rows])
+
+                if sigma_clip is not None :
+                    slow, shigh = sigma_clip if np.ndim(sigma_clip) else (sigma_clip, sigma_clip)
+                    cen = np.nanmedian(block, axis=0)
+                    dev = 1.482602218505602 * np.nanmedian(np.abs(block - cen), axis=0)
+                    # noise floor from the differences between consecutive frames, robust to outliers and to level offsets
+                    diff = np.diff(block, axis=0)
+                    diff -= np.nanmedian(diff, axis=(1, 2), keepdims=True)
+                    floor = 1.482602218505602 * np.nanmedian(np.abs(diff)) / np.sqrt(2.)
+                    del diff
+                    dev = np.fmax(dev, floor)
+                    reject = np.zeros(block.shape, dtype=bool)
+                    if slow is not None :
+                        reject |= block < cen - slow * dev
+                    if shigh is not None :
+                        reject |= block > cen + shigh * dev
+                    block[reject] = np.nan
+                    nrejected += int(np.count_nonzero(reject))
+
+                n_no_mask = np.sum(np.isfinite(block), axis=0)
+                if method == 'median' :
+                    data[y0:y0+block_rows] = np.nanmedian(block, axis=0)
+                else :
+                    data[y0:y0+block_rows] = np.nanmean(block, axis=0)
+                # uncertainty = sigma/sqrt(n)
+                unct[y0:y0+block_rows] = np.nanstd(block, axis=0) / np.sqrt(n_no_mask)
+
+                del block
+
+        del stack
+    finally :
+        os.remove(stack_file)
+
+    master = FrameData(data, unit=unit, dtype=dtype, uncertainty=unct, mask=np.isnan(data))
+
+    if return_nrejected :
+        return master, nrejected
+    return master
+
+
+def _bounded_map(executor, func, args, lookahead) :
+    """ Map func over tuples of arguments in an executor, in order, with at most lookahead tasks in flight,
+    so that memory use does not grow with the number of tasks """
+    pending = deque()
+    for arg in args :
+        pending.append(executor.submit(func, *arg))
+        if len(pending) >= lookahead :
+            yield pending.popleft().result()
+    while len(pending) :
+        yield pending.popleft().result()
+
+
+# master calibrations shared read-only by all frames calibrated in a process
+_calib_masters = {}
+
+
+def _init_calibration_worker(bias_file="", flat_file="", kernel="astropop") :
+    """ Load master calibrations once per calibration process """
+    _calib_masters.clear()
+
+    for key, filename in [("bias", bias_file), ("flat", flat_file)] :
+        if filename != "" :
+            try :
+                _calib_masters[key] = s4p.getFrameFromMasterCalibration(filename)
+            except :
+                print("WARNING: failed to read master {}, ignoring ...".format(key))
+                continue
+            if kernel == "fused" :
+                # keep float32 copies of data and uncertainty for the fused kernel
+                master = _calib_masters.pop(key)
+                _calib_masters[key] = (np.asarray(master.data, dtype=np.float32),
+                                       np.asarray(master.get_uncertainty(return_none=False), dtype=np.float32),
+                                       master.unit)
+
+
+def _calibrate_frame(filename, gain, calibrate=True, cosmics=True, use_memmap=False, kernel="astropop", dtype=None, cache_dir="", cache_key="") :
+    """ Load a frame and clean cosmic rays, correct gain, subtract bias and divide by flat, or get it from the frame cache """
+    if calibrate and cache_key != "" :
+        frame = s4fc.load(cache_dir, cache_key, header=s4hc.getheader(filename), dtype=dtype)
+        if frame is not None :
+            return frame
+
+    frame = check_framedata(filename, hdu=0, unit='adu', use_memmap_backend=use_memmap)
+
+    if calibrate :
+        if cosmics :
+            processing.cosmics_lacosmic(frame, inplace=True)
+        if kernel == "fused" :
+            frame = fused_calibration(frame, gain, bias=_calib_masters.get("bias"), flat=_calib_masters.get("flat"))
+        else :
+            processing.gain_correct(frame, gain, inplace=True)
+            if "bias" in _calib_masters :
+                processing.subtract_bias(frame, _calib_masters["bias"], inplace=True)
+            if "flat" in _calib_masters :
+                processing.flat_correct(frame, _calib_masters["flat"], inplace=True)
+
+    if dtype is not None and frame.dtype != dtype :
+        frame = frame.astype(dtype)
+
+    if calibrate and cache_key != "" :
+        s4fc.save(cache_dir, cache_key, frame, dtype=frame.dtype)
+
+    return frame
+
+
+def fused_calibration(frame, gain, bias=None, flat=None) :
+
+    """ Pipeline module to correct gain, subtract bias and divide by flat in a single pass over float32 arrays
+
+        Data and uncertainties are the same as for astropop's gain_correct, subtract_bias
+        and flat_correct (within float32 precision), but the frame data is converted to
+        float32 only once and all operations are done in place, with a single temporary array.
+
+    Parameters
+    ----------
+    frame : astropop.framedata.FrameData
+        input frame in adu
+    gain : astropy.units.Quantity
+        detector gain (electron/adu)
+    bias : tuple, optional
+        master bias (data, uncertainty, unit), with float32 arrays
+    flat : tuple, optional
+        master flat (data, uncertainty, unit), with float32 arrays
+
+    Returns
+    -------
+    frame : astropop.framedata.FrameData
+        calibrated frame with float32 data and uncertainty
+    """
+
+    g = np.float32(u.Quantity(gain).value)
+    unit = frame.unit * u.Quantity(gain).unit
+
+    data = np.array(frame.data, dtype=np.float32)
+    unct = np.array(frame.get_uncertainty(return_none=False), dtype=np.float32)
+
+    # gain
+    np.multiply(data, g, out=data)
+    np.multiply(unct, np.abs(g), out=unct)
+
+    # bias: sigma = hypot(sigma, sigma_bias)
+    if bias is not None :
+        np.subtract(data, bias[0], out=data)
+        np.hypot(unct, bias[1], out=unct)
+
+    # flat: sigma = hypot(sigma, data/flat * sigma_flat) / |flat|
+    if flat is not None :
+        np.divide(data, flat[0], out=data)
+        tmp = np.multiply(data, flat[1])
+        np.hypot(unct, tmp, out=unct)
+        np.divide(unct, np.abs(flat[0]), out=unct)
+        unit = unit / flat[2]
+        del tmp
+
+    calibrated = FrameData(data, unit=unit, dtype=np.float32, uncertainty=unct, header=frame.header)
+    calibrated.header['HIERARCH astropop gain_corrected'] = True
+    calibrated.header['HIERARCH astropop gain_corrected_value'] = float(g)
+    calibrated.header['HIERARCH astropop gain_corrected_unit'] = str(u.Quantity(gain).unit)
+    if bias is not None :
+        calibrated.header['HIERARCH astropop bias_corrected'] = True
+    if flat is not None :
+        calibrated.header['HIERARCH astropop flat_corrected'] = True
+
+    return calibrated
+
+
+def get_frame_cache_dir(p, reduce_dir) :
+    """ Pipeline module to get the directory of the calibrated frame cache
+
+    Parameters
+    ----------
+    p : dict
+        dictionary with pipeline parameters
+    reduce_dir : str
+        reduced data directory
+
+    Returns
+    -------
+    cache_dir : str
+        cache directory, or an empty string if the cache is disabled (p['USE_FRAME_CACHE'])
+    """
+    if p['USE_FRAME_CACHE'] :
+        return os.path.join(reduce_dir, p['FRAME_CACHE_DIRNAME'])
+    return ""
+
+
+def calibrate_frames(p, files, gain, bias_file="", flat_file="", calibrate=None, cosmics=True, nprocesses=None, kernel=None, cache_dir="") :
+
+    """ Pipeline module to calibrate frames in parallel processes
+
+        The calibration of each frame consists of the following steps:
+         1. Clean cosmic rays, if cosmics is True
+         2. Correct gain
+         3. Subtract master bias, if bias_file is given
+         4. Divide by a master flat field, if flat_file is given
+
+        Master calibrations are loaded only once in each process, and at most
+        max(p['FRAME_LOOKAHEAD'], nprocesses) frames are calibrated ahead of the consumer.
+
+        If cache_dir is given, calibrated frames are saved there as float32 .npy files
+        keyed by the raw frame, master calibrations and calibration parameters, and later
+        calls get them from the cache instead of calibrating them again. The least recently
+        used frames are removed when the cache exceeds p['FRAME_CACHE_MAX_SIZE'] (GB).
+
+    Parameters
+    ----------
+    p : dict
+        dictionary with pipeline parameters
+    files : list
+        list of input FITS image file paths
+    gain : astropy.units.Quantity
+        detector gain (electron/adu)
+    bias_file : str, optional
+        master bias file path
+    flat_file : str, optional
+        master flat file path
+    calibrate : list of bool, optional
+        whether or not to calibrate each frame, frames not calibrated are only loaded
+    cosmics : bool, optional
+        whether or not to clean cosmic rays with lacosmic
+    nprocesses : int, optional
+        number of processes, if None uses p['NPROCESSES_FOR_CALIBRATION']. Set 1 to calibrate in the current process
+    kernel : str, optional
+        'astropop' (astropop processing functions) or 'fused' (see fused_calibration), if None uses p['CALIBRATION_KERNEL']
+    cache_dir : str, optional
+        calibrated frame cache directory (see get_frame_cache_dir), an empty string disables the cache
+
+    Yields
+    -------
+    frame : astropop.framedata.FrameData
+        calibrated frames, in the same order of the input files
+    """
+
+    if nprocesses is None :
+        nprocesses = p['NPROCESSES_FOR_CALIBRATION']
+    if calibrate is None :
+        calibrate = [True] * len(files)
+    if kernel is None :
+        kernel = p['CALIBRATION_KERNEL']
+
+    # calibrated frames are kept in float32
+    dtype = np.float32 if p['PRECISION'] == 'float32' else None
+
+    cache_keys = [""] * len(files)
+    if cache_dir != "" :
+        # the precision is part of the key, so frames are returned with the same dtype whether or not they are cached
+        cache_keys = [s4fc.get_key(f, bias_file, flat_file, gain=str(gain), cosmics=cosmics, kernel=kernel, precision=p['PRECISION']) for f in files]
+
+    args = (files, repeat(gain), calibrate, repeat(cosmics), repeat(p['USE_MEMMAP']), repeat(kernel), repeat(dtype), repeat(cache_dir), cache_keys)
+
+    try :
+        if nprocesses > 1 and len(files) > 1 :
+            with ProcessPoolExecutor(max_workers=min(nprocesses, len(files)), initializer=_init_calibration_worker, initargs=(bias_file, flat_file, kernel)) as executor :
+                for i, frame in enumerate(_bounded_map(executor, _calibrate_frame, zip(*args), max(p['FRAME_LOOKAHEAD'], nprocesses))) :
+                    print("Calibrated frame {} of {} : {} ".format(i+1, len(files), os.path.basename(files[i])))
+                    yield frame
+        else :
+            _init_calibration_worker(bias_file, flat_file, kernel)
+            for i, frame in enumerate(map(_calibrate_frame, *args)) :
+                print("Calibrated frame {} of {} : {} ".format(i+1, len(files), os.path.basename(files[i])))
+                yield frame
+    finally :
+        if cache_dir != "" :
+            s4fc.evict(cache_dir, p['FRAME_CACHE_MAX_SIZE'])
+
+
 def old_reduce_science_images(p, inputlist, data_dir="./", reduce_dir="./", force=False, match_frames=False, stack_suffix="", output_stack="", polarimetry=False) :
 
     """ Pipeline module to run the reduction of science images.
@@ -487,7 +926,7 @@ def old_reduce_science_images(p, inputlist, data_dir="./", reduce_dir="./", forc
     # set base image as the reference image, which will be replaced later if run registering
     p['REF_IMAGE_INDEX'] = 0
     p['REFERENCE_IMAGE'] = obj_fg.files[p['REF_IMAGE_INDEX']]
-    p['REF_OBJECT_HEADER'] = fits.getheader(p['REFERENCE_IMAGE'])
+    p['REF_OBJECT_HEADER'] = s4hc.getheader(p['REFERENCE_IMAGE'])
 
     # set output stack filename
     if output_stack == "" :
@@ -541,16 +980,9 @@ def old_reduce_science_images(p, inputlist, data_dir="./", reduce_dir="./", forc
 
         print('Calibrating science frames (CR, gain, bias, flat) ... ')
 
-        # Perform calibration
-        for i, frame in enumerate(frames):
-            print("Calibrating science frame {} of {} : {} ".format(i+1,len(frames),os.path.basename(obj_fg.files[i])))
-            if not obj_red_status[i] or force:
-                processing.cosmics_lacosmic(frame, inplace=True)
-                processing.gain_correct(frame, gain, inplace=True)
-                processing.subtract_bias(frame, bias, inplace=True)
-                processing.flat_correct(frame, flat, inplace=True)
-            else :
-                pass
+        # Perform calibration in parallel, frames already reduced are only loaded
+        calibrate = [not obj_red_status[i] or force for i in range(len(obj_fg.files))]
+        frames = list(calibrate_frames(p, obj_fg.files, gain, bias_file=p["master_bias"], flat_file=p["master_flat"], calibrate=calibrate))
 
         if match_frames :
             print('Calculating offsets and selecting images for stack ... ')
@@ -631,6 +1063,14 @@ def reduce_science_images(p, inputlist, data_dir="./", reduce_dir="./", match_fr
          9. Perform aperture photometry for all images on all sources in the catalog
          10. Save reduced image, catalog data, and photometry into a S4 product
 
+         Frames are streamed one at a time through all steps, with a bounded number
+         of frames in flight (p['FRAME_LOOKAHEAD']), so memory use does not depend
+         on the number of input images. Frames already reduced are not read, their
+         offsets are taken from the XSHIFT/YSHIFT keywords of their products.
+
+         With p['REGISTRATION_ENGINE'] = 'catalog', offsets are calculated while building
+         the catalog of each frame, by matching its detected sources to the stack catalog.
+
     Parameters
     ----------
     p : dict
@@ -662,19 +1102,6 @@ def reduce_science_images(p, inputlist, data_dir="./", reduce_dir="./", match_fr
         dictionary to store pipeline parameters
     """
 
-    # read master calibration files
-    try :
-        # load bias frame
-        bias = s4p.getFrameFromMasterCalibration(p["master_bias"])
-    except :
-        print("WARNING: failed to read master bias, ignoring ...")
-
-    try :
-        # load flat frame
-        flat = s4p.getFrameFromMasterCalibration(p["master_flat"])
-    except :
-        print("WARNING: failed to read master flat, ignoring ...")
-
     # save original input list of files
     p['INPUT_LIST_OF_FILES'] = deepcopy(inputlist)
     # check whether the input reference image is in the input list
@@ -696,6 +1123,15 @@ def reduce_science_images(p, inputlist, data_dir="./", reduce_dir="./", match_fr
 
     obj_red_images, obj_red_status = [], []
 
+    # stack whose catalogs are used to reduce the frames, so frames are reduced again when it is rebuilt
+    stack_file = p['OBJECT_STACK'] if 'OBJECT_STACK' in p.keys() else ""
+
+    # parameters that affect the reduced frames
+    prov_params = s4prov.get_params(p, PHOT_PROVENANCE_KEYS)
+    prov_params.update({'match_frames': match_frames, 'polarimetry': polarimetry, 'ra': ra, 'dec': dec})
+    if p['REGISTRATION_ENGINE'] != 'astropop' :
+        prov_params.update(s4prov.get_params(p, REGISTRATION_PROVENANCE_KEYS))
+
     for i in range(len(obj_fg.files)) :
         # get basename
         basename = os.path.basename(obj_fg.files[i])
@@ -705,20 +1141,17 @@ def reduce_science_images(p, inputlist, data_dir="./", reduce_dir="./", match_fr
 
         red_status = False
         if not force :
-            if os.path.exists(output) :
+            # a frame is reduced if it is up to date with the raw frame, masters, reference image, stack and parameters
+            if s4prov.is_up_to_date(output, [obj_fg.files[i], p["master_bias"], p["master_flat"], ref_img, stack_file], prov_params) :
                 red_status = True
         obj_red_status.append(red_status)
 
         print("{} of {} is reduced? {} -> {}".format(i+1, len(obj_fg.files), red_status, output))
 
     if not all(obj_red_status) or force:
-        print("Loading science frames to memory ... ")
-        # get frames
-        frames = list(obj_fg.framedata(unit='adu', use_memmap_backend=p['USE_MEMMAP']))
-
         #extract gain from the first image
-        if float(frames[0].header['GAIN']) != 0 :
-            gain = float(frames[0].header['GAIN'])*u.electron/u.adu  # using quantities is better for safety
+        if float(s4hc.getheader(obj_fg.files[0],copy=False)['GAIN']) != 0 :
+            gain = float(s4hc.getheader(obj_fg.files[0],copy=False)['GAIN'])*u.electron/u.adu  # using quantities is better for safety
         else :
             gain = 3.3*u.electron/u.adu
 
@@ -735,72 +1168,77 @@ def reduce_science_images(p, inputlist, data_dir="./", reduce_dir="./", match_fr
             'BIASSUB': (True, 'bias subtracted'),
             'BIASFILE': (p["master_bias"], 'bias file name'),
             'FLATCORR': (True, 'flat corrected'),
-            'FLATFILE': (p["master_flat"], 'flat file name')
+            'FLATFILE': (p["master_flat"], 'flat file name'),
+            'REFIMG': (p['REFERENCE_IMAGE'], "reference image")
         }
 
-        print('Calibrating science frames (CR, gain, bias, flat) ... ')
-
-        # Perform calibration
-        for i, frame in enumerate(frames):
-            print("Calibrating science frame {} of {} : {} ".format(i+1,len(frames),os.path.basename(obj_fg.files[i])))
-            if not obj_red_status[i] or force:
-                processing.cosmics_lacosmic(frame, inplace=True)
-                processing.gain_correct(frame, gain, inplace=True)
-                processing.subtract_bias(frame, bias, inplace=True)
-                processing.flat_correct(frame, flat, inplace=True)
-            else :
-                pass
+        # only frames not reduced yet are read, one at a time
+        to_reduce = [i for i in range(len(obj_fg.files)) if not obj_red_status[i] or force]
 
-        print('Calculating offsets ... ')
-        p = compute_offsets(p, frames, obj_fg.files, auto_ref_selection=False)
+        # calculate time and coordinates keywords of all frames to be saved at once
+        time_hdrs = s4utils.set_timecoords_keys_batch([s4hc.getheader(obj_fg.files[i]) for i in to_reduce], time_key=p["TIME_KEY"], ra=ra, dec=dec)
+        time_infos = {}
+        for i, hdr in zip(to_reduce, time_hdrs) :
+            time_infos[i] = s4utils.get_timecoords_info(hdr)
 
-        # write ref image to header
-        info['REFIMG'] = (p['REFERENCE_IMAGE'], "reference image")
+        # all offsets are calculated with respect to the reference frame, loaded once
+        ref_frame = None
+        if match_frames :
+            ref_index = p['REF_IMAGE_INDEX']
+            if obj_red_status[ref_index] and not force :
+                # the reduced reference holds the calibrated data, so it doesn't need to be calibrated again
+                print('Loading reference frame from its reduced product {} ... '.format(obj_red_images[ref_index]))
+                ref_frame = FrameData(s4p.getImageDataFromProduct(obj_red_images[ref_index])[0], unit=data_units)
+            else :
+                print('Calibrating reference frame {} ... '.format(p['REFERENCE_IMAGE']))
+                ref_frame = next(calibrate_frames(p, [obj_fg.files[ref_index]], gain, bias_file=p["master_bias"], flat_file=p["master_flat"], nprocesses=1, cache_dir=get_frame_cache_dir(p, reduce_dir)))
+
+        # offsets of frames already reduced are those stored in their products
+        p["XSHIFTS"] = np.full(len(obj_fg.files), np.nan)
+        p["YSHIFTS"] = np.full(len(obj_fg.files), np.nan)
+        for i in range(len(obj_fg.files)) :
+            if obj_red_status[i] and not force :
+                p["XSHIFTS"][i], p["YSHIFTS"][i] = get_stored_offset(obj_red_images[i])
+
+        print("Reducing {} of {} frames, {} are already reduced".format(len(to_reduce), len(obj_fg.files), len(obj_fg.files) - len(to_reduce)))
+
+        print('Calibrating (CR, gain, bias, flat), registering and reducing science frames one at a time ... ')
+
+        def frame_tasks() :
+            # calibrated frames are streamed from the calibration processes in order
+            frames = calibrate_frames(p, [obj_fg.files[i] for i in to_reduce], gain, bias_file=p["master_bias"], flat_file=p["master_flat"], cache_dir=get_frame_cache_dir(p, reduce_dir))
+
+            if match_frames and p['REGISTRATION_ENGINE'] == 'catalog' and "CATALOGS" in p.keys() :
+                # frames are registered to the stack catalog while their catalogs are built
+                registered = ((frame, np.nan, np.nan) for frame in frames)
+            elif match_frames :
+                # frames are registered as they are calibrated
+                registered = register_frames(p, ref_frame, frames)
+            else :
+                registered = ((frame, 0., 0.) for frame in frames)
 
-        # Perform aperture photometry and store reduced data into products
-        for i, frame in enumerate(frames):
+            for i, (frame, xshift, yshift) in zip(to_reduce, registered) :
+                p["XSHIFTS"][i], p["YSHIFTS"][i] = xshift, yshift
 
-            info['XSHIFT'] = (0.,"register x shift (pixel)")
-            info['XSHIFTST'] = ("OK","x shift status")
-            info['YSHIFT'] = (0.,"register y shift (pixel)")
-            info['YSHIFTST'] = ("OK","y shift status")
-            if match_frames :
-                if np.isfinite(p["XSHIFTS"][i]) :
-                    info['XSHIFT'] = (p["XSHIFTS"][i],"register x shift (pixel)")
-                else :
-                    info['XSHIFTST'] = ("UNDEFINED","x shift status")
+                frame_info = dict(info)
+                set_shift_info(frame_info, p["XSHIFTS"][i], p["YSHIFTS"][i])
 
-                if np.isfinite(p["YSHIFTS"][i]) :
-                    info['YSHIFT'] = (p["YSHIFTS"][i],"register y shift (pixel)")
-                else :
-                    info['YSHIFTST'] = ("UNDEFINED","y shift status")
+                # add time keywords calculated for this frame
+                frame_info.update(time_infos[i])
 
-            if not obj_red_status[i] or force:
-                # get data arrays
-                img_data=np.array(frame.data)
-                try :
-                    # make catalog
-                    if match_frames and "CATALOGS" in p.keys() :
-                        p, frame_catalogs = build_catalogs(p, img_data, deepcopy(p["CATALOGS"]), xshift=p["XSHIFTS"][i], yshift=p["YSHIFTS"][i], polarimetry=polarimetry)
-                    else :
-                        p, frame_catalogs = build_catalogs(p, img_data, polarimetry=polarimetry)
-                except :
-                    print("WARNING: could not build frame catalog.")
-                    # set local
-                    frame_catalogs = []
+                yield (i, np.array(frame.data), obj_fg.files[i], obj_red_images[i], p["XSHIFTS"][i], p["YSHIFTS"][i], frame_info)
 
-                print("Saving frame {} of {}:".format(i+1,len(frames)),obj_fg.files[i],'->',obj_red_images[i])
+        # Perform aperture photometry and store reduced data into products as frames are calibrated
+        for i, status, ncatalogs, elapsed, xshift, yshift in reduce_science_frames(p, frame_tasks(), match_frames=match_frames, polarimetry=polarimetry, ra=ra, dec=dec, ref_frame=ref_frame) :
+            # shifts may have been calculated while building the catalogs
+            p["XSHIFTS"][i], p["YSHIFTS"][i] = xshift, yshift
+            print("Saved frame {} of {} in {:.1f} s with {} catalogs: {} -> {}".format(i+1, len(obj_fg.files), elapsed, ncatalogs, obj_fg.files[i], obj_red_images[i]))
+            if status :
+                # record inputs and parameters of the reduced frame
+                s4prov.record(obj_red_images[i], [obj_fg.files[i], p["master_bias"], p["master_flat"], ref_img, stack_file], prov_params, save=False)
 
-                frame_wcs_header = deepcopy(p['WCS_HEADER'])
-
-                if np.isfinite(p["XSHIFTS"][i]) :
-                    frame_wcs_header['CRPIX1'] = frame_wcs_header['CRPIX1'] + p["XSHIFTS"][i]
-                if np.isfinite(p["YSHIFTS"][i]) :
-                    frame_wcs_header['CRPIX2'] = frame_wcs_header['CRPIX2'] + p["YSHIFTS"][i]
-
-                # call function to generate final product
-                # for light products
-                s4p.scienceImageLightProduct(obj_fg.files[i], img_data=img_data, info=info, catalogs=frame_catalogs, polarimetry=polarimetry, filename=obj_red_images[i], catalog_beam_ids=p['CATALOG_BEAM_IDS'], wcs_header=frame_wcs_header, time_key=p["TIME_KEY"], ra=ra, dec=dec)
+        # write the provenance of all reduced frames at once
+        s4prov.save_manifests()
 
     if 'OBJECT_REDUCED_IMAGES' not in p.keys() :
         p['OBJECT_REDUCED_IMAGES'] = obj_red_images
@@ -811,7 +1249,127 @@ def reduce_science_images(p, inputlist, data_dir="./", reduce_dir="./", match_fr
     return p
 
 
-def stack_science_images(p, inputlist, reduce_dir="./", force=False, stack_suffix="", output_stack="", polarimetry=False) :
+# pipeline parameters shared read-only by all frames reduced in a process
+_reduction_state = {}
+
+
+def _init_reduction_worker(p, match_frames=True, polarimetry=False, ra="", dec="", ref_frame=None) :
+    """ Set pipeline parameters (and the reference frame for image registration) once per reduction process """
+    _reduction_state.clear()
+    _reduction_state.update({"p": p, "match_frames": match_frames, "polarimetry": polarimetry, "ra": ra, "dec": dec, "ref_frame": ref_frame})
+
+
+def _reduce_science_frame(i, img_data, filename, output, xshift, yshift, info) :
+    """ Build catalogs of a calibrated frame and save it into a science image product
+
+    Returns
+    -------
+    i : int
+        frame index
+    status : bool
+        whether or not the product was saved
+    ncatalogs : int
+        number of catalogs in the product
+    elapsed : float
+        time (s) to reduce the frame
+    xshift, yshift : float, float
+        x and y shifts (pixel) of the frame
+    """
+    tini = time.time()
+
+    # shallow copy, so parameters set while building catalogs are not shared between frames
+    p = dict(_reduction_state["p"])
+    polarimetry = _reduction_state["polarimetry"]
+
+    try :
+        # make catalog
+        if _reduction_state["match_frames"] and "CATALOGS" in p.keys() :
+            sources = None
+            if p['REGISTRATION_ENGINE'] == 'catalog' :
+                # detect sources once, to register the frame and to build its catalogs
+                sources = detect_sources(p, img_data)
+                xshift, yshift, nmatches = estimate_catalog_shift(p, p["CATALOGS"], sources)
+                if (not np.isfinite(xshift) or not np.isfinite(yshift)) and _reduction_state["ref_frame"] is not None :
+                    print("WARNING: only {} sources matched the stack catalog, registering frame {} by image ... ".format(nmatches, filename))
+                    xshift, yshift = compute_frame_offset(p, _reduction_state["ref_frame"], FrameData(img_data))
+                set_shift_info(info, xshift, yshift)
+
+            p, frame_catalogs = build_catalogs(p, img_data, deepcopy(p["CATALOGS"]), xshift=xshift, yshift=yshift, polarimetry=polarimetry, sources=sources)
+        else :
+            p, frame_catalogs = build_catalogs(p, img_data, polarimetry=polarimetry)
+    except :
+        print("WARNING: could not build frame catalog.")
+        # set local
+        frame_catalogs = []
+
+    frame_wcs_header = deepcopy(p['WCS_HEADER'])
+
+    if np.isfinite(xshift) :
+        frame_wcs_header['CRPIX1'] = frame_wcs_header['CRPIX1'] + xshift
+    if np.isfinite(yshift) :
+        frame_wcs_header['CRPIX2'] = frame_wcs_header['CRPIX2'] + yshift
+
+    try :
+        # call function to generate final product
+        # for light products
+        s4p.scienceImageLightProduct(filename, img_data=img_data, info=info, catalogs=frame_catalogs, polarimetry=polarimetry, filename=output, catalog_beam_ids=p['CATALOG_BEAM_IDS'], wcs_header=frame_wcs_header, time_key=p["TIME_KEY"], ra=_reduction_state["ra"], dec=_reduction_state["dec"], set_timecoords=False, precision=p['PRECISION'])
+        status = True
+    except Exception as e :
+        print("WARNING: could not save reduced frame {}: {}".format(output, e))
+        status = False
+
+    return i, status, len(frame_catalogs), time.time() - tini, xshift, yshift
+
+
+def reduce_science_frames(p, tasks, match_frames=True, polarimetry=False, ra="", dec="", nprocesses=None, ref_frame=None) :
+
+    """ Pipeline module to build catalogs and save science image products of calibrated frames in parallel processes
+
+        Pipeline parameters (including the stack catalogs) are sent once to each process,
+        then each process receives only the data, shifts and header information of a frame,
+        writes the product and returns its status. At most max(p['FRAME_LOOKAHEAD'], nprocesses)
+        frames are in flight.
+
+    Parameters
+    ----------
+    p : dict
+        dictionary with pipeline parameters
+    tasks : iterable of tuples
+        (index, image data, original file path, output file path, x shift, y shift, info dict) of each frame,
+        e.g. a generator, so frames are reduced as they are calibrated
+    match_frames : bool, optional
+        Boolean to run photometry on the stack catalogs, shifted to each frame
+    polarimetry : bool, optional
+        whether or not input data is a dual beam polarimetric image with duplicated sources
+    ra, dec : str, optional
+        strings to overwrite header RA and DEC keywords
+    nprocesses : int, optional
+        number of processes, if None uses p['NPROCESSES_FOR_REDUCTION']. Set 1 to reduce in the current process
+    ref_frame : astropop.framedata.FrameData, optional
+        reference frame, to register by image the frames that could not be matched to the stack
+        catalog with p['REGISTRATION_ENGINE'] = 'catalog'
+
+    Yields
+    -------
+    i, status, ncatalogs, elapsed, xshift, yshift : int, bool, int, float, float, float
+        frame index, whether or not the product was saved, number of catalogs, time (s) to reduce the frame,
+        and x and y shifts of the frame, in the same order of the tasks
+    """
+
+    if nprocesses is None :
+        nprocesses = p['NPROCESSES_FOR_REDUCTION']
+
+    if nprocesses > 1 :
+        with ProcessPoolExecutor(max_workers=nprocesses, initializer=_init_reduction_worker, initargs=(p, match_frames, polarimetry, ra, dec, ref_frame)) as executor :
+            for result in _bounded_map(executor, _reduce_science_frame, tasks, max(p['FRAME_LOOKAHEAD'], nprocesses)) :
+                yield result
+    else :
+        _init_reduction_worker(p, match_frames, polarimetry, ra, dec, ref_frame)
+        for task in tasks :
+            yield _reduce_science_frame(*task)
+
+
+def stack_science_images(p, inputlist, reduce_dir="./", force=False, stack_suffix="", output_stack="", polarimetry=False, quality=None) :
 
     """ Pipeline module to run the stack of science images.
 
@@ -840,6 +1398,9 @@ def stack_science_images(p, inputlist, reduce_dir="./", force=False, stack_suffi
         String to define the directory path to the output stack file
     polarimetry : bool, default=False
         whether or not input data is a dual beam polarimetric image with duplicated sources
+    quality : dict, optional
+        quality statistics of the input frames from the database (see s4db.get_frame_quality),
+        to select frames for the stack without reading them
 
     Returns
     -------
@@ -852,7 +1413,12 @@ def stack_science_images(p, inputlist, reduce_dir="./", force=False, stack_suffi
         output_stack = os.path.join(reduce_dir, '{}_stack.fits'.format(stack_suffix))
     p['OBJECT_STACK'] = output_stack
 
-    if os.path.exists(p['OBJECT_STACK']) and not force :
+    # inputs and parameters that affect the stack
+    prov_inputs = list(inputlist) + [p["master_bias"], p["master_flat"]]
+    prov_params = s4prov.get_params(p, STACK_PROVENANCE_KEYS)
+    prov_params.update({'polarimetry': polarimetry})
+
+    if s4prov.is_up_to_date(p['OBJECT_STACK'], prov_inputs, prov_params) and not force :
         print("There is already a stack image :", p['OBJECT_STACK'])
 
         stack_hdulist = fits.open(p['OBJECT_STACK'])
@@ -862,33 +1428,20 @@ def stack_science_images(p, inputlist, reduce_dir="./", force=False, stack_suffi
         for i in range(len(inputlist)) :
             if inputlist[i] == p['REFERENCE_IMAGE'] :
                 p['REF_IMAGE_INDEX'] = i
-        p['REF_OBJECT_HEADER'] = fits.getheader(p['REFERENCE_IMAGE'])
+        p['REF_OBJECT_HEADER'] = s4hc.getheader(p['REFERENCE_IMAGE'])
 
         p["CATALOGS"] = s4p.readScienceImagCatalogs(p['OBJECT_STACK'])
 
         return p
 
-    # read master calibration files
-    try :
-        # load bias frame
-        bias = s4p.getFrameFromMasterCalibration(p["master_bias"])
-    except :
-        print("WARNING: failed to read master bias, ignoring ...")
-
-    try :
-        # load flat frame
-        flat = s4p.getFrameFromMasterCalibration(p["master_flat"])
-    except :
-        print("WARNING: failed to read master flat, ignoring ...")
-
     # set base image as the reference image, which will be replaced
     # later if run "select_files_for_stack"
     p['REF_IMAGE_INDEX'] = 0
     p['REFERENCE_IMAGE'] = inputlist[p['REF_IMAGE_INDEX']]
-    p['REF_OBJECT_HEADER'] = fits.getheader(p['REFERENCE_IMAGE'])
+    p['REF_OBJECT_HEADER'] = s4hc.getheader(p['REFERENCE_IMAGE'])
 
     # first select best files for stack
-    p = select_files_for_stack(p, inputlist, saturation_limit=p['SATURATION_LIMIT'], imagehdu=0)
+    p = select_files_for_stack(p, inputlist, saturation_limit=p['SATURATION_LIMIT'], imagehdu=0, quality=quality)
 
     # select FITS files in the minidata directory and build database
     obj_fg = FitsFileGroup(files=p['SELECTED_FILES_FOR_STACK'])
@@ -896,13 +1449,9 @@ def stack_science_images(p, inputlist, reduce_dir="./", force=False, stack_suffi
     # print total number of object files selected
     print(f'OBJECT files: {len(obj_fg)}')
 
-    print("Loading science frames to memory ... ")
-    # get frames
-    frames = list(obj_fg.framedata(unit='adu', use_memmap_backend=p['USE_MEMMAP']))
-
     #extract gain from the first image
-    if float(frames[0].header['GAIN']) != 0 :
-        gain = float(frames[0].header['GAIN'])*u.electron/u.adu  # using quantities is better for safety
+    if float(s4hc.getheader(obj_fg.files[0],copy=False)['GAIN']) != 0 :
+        gain = float(s4hc.getheader(obj_fg.files[0],copy=False)['GAIN'])*u.electron/u.adu  # using quantities is better for safety
     else :
         gain = 3.3*u.electron/u.adu
 
@@ -925,27 +1474,29 @@ def stack_science_images(p, inputlist, reduce_dir="./", force=False, stack_suffi
 
     print('Calibrating science frames (CR, gain, bias, flat) ... ')
 
-    # Perform calibration
-    for i, frame in enumerate(frames):
-        print("Calibrating science frame {} of {} : {} ".format(i+1,len(frames),os.path.basename(obj_fg.files[i])))
-        processing.cosmics_lacosmic(frame, inplace=True)
-        processing.gain_correct(frame, gain, inplace=True)
-        processing.subtract_bias(frame, bias, inplace=True)
-        processing.flat_correct(frame, flat, inplace=True)
+    # Perform calibration in parallel, calibrated frames are cached to be reused by the reduction
+    frames = list(calibrate_frames(p, obj_fg.files, gain, bias_file=p["master_bias"], flat_file=p["master_flat"], cache_dir=get_frame_cache_dir(p, reduce_dir)))
 
     print('Registering science frames and stacking them ... ')
 
     p['SELECTED_FILE_INDICES_FOR_STACK'] = np.arange(p['FINAL_NFILES_FOR_STACK'])
 
-    # Register images, generate global catalog and generate stack image
-    p = run_register_frames(p, frames, obj_fg.files, info, output_stack=output_stack, force=force, polarimetry=polarimetry)
+    # Register images, generate global catalog and generate stack image, overwriting any outdated stack
+    p = run_register_frames(p, frames, obj_fg.files, info, output_stack=output_stack, force=True, polarimetry=polarimetry)
+
+    # record inputs and parameters of the new stack
+    s4prov.record(output_stack, prov_inputs, prov_params)
 
     return p
 
 
-def select_files_for_stack(p, inputlist, saturation_limit=32768, imagehdu=0) :
+def select_files_for_stack(p, inputlist, saturation_limit=32768, imagehdu=0, quality=None) :
     """ Pipeline module to select a sub-set of frames for stack
 
+    Frames are ranked by peak flux (max of unsaturated pixels minus the median), or by
+    FWHM if p['STACK_SELECTION_METRIC'] is 'fwhm'. If quality statistics from the database
+    are given, the ranking is a sort of the stored statistics and no image is read.
+
     Parameters
     ----------
     p : dict
@@ -956,35 +1507,50 @@ def select_files_for_stack(p, inputlist, saturation_limit=32768, imagehdu=0) :
         saturation flux limit, images with any max value above or equal this value will be ignored
     imagehdu : int or string, optional
         HDU index/name containing the image data
+    quality : dict, optional
+        quality statistics of the input frames from the database, see s4db.get_frame_quality
 
     Returns
     -------
     p : dict
         dictionary to store pipeline parameters
     """
-    peaks = []
-    maxflux, ref_img_idx = 0, 0
-    for i in range(len(inputlist)) :
-        img = fits.getdata(inputlist[i],imagehdu)
-        keep = img < saturation_limit
-        bkg = np.nanmedian(img[keep])
-        maximgflux = np.nanmax(img[keep]) - bkg
-        if maximgflux > maxflux :
-            maxflux = maximgflux
-            ref_img_idx = i
-        peaks.append(maximgflux)
-        #print(i, inputlist[i], '-> ', bkg, (maximgflux - bkg))
-    peaks = np.array(peaks)
+    if quality is not None :
+        print("Selecting frames for stack from the quality statistics in the database ... ")
+        peaks = np.array(quality["PEAK"], dtype=float)
+    else :
+        peaks = []
+        for i in range(len(inputlist)) :
+            img = fits.getdata(inputlist[i],imagehdu)
+            keep = img < saturation_limit
+            bkg = np.nanmedian(img[keep])
+            maximgflux = np.nanmax(img[keep]) - bkg
+            peaks.append(maximgflux)
+            #print(i, inputlist[i], '-> ', bkg, (maximgflux - bkg))
+        peaks = np.array(peaks, dtype=float)
+
+    # frames without a valid peak go last
+    score = np.where(np.isfinite(peaks), peaks, -np.inf)
+
+    if p['STACK_SELECTION_METRIC'] == 'fwhm' :
+        if quality is not None and np.any(np.isfinite(quality["FWHM"])) :
+            # sharpest frames first, frames without FWHM go last
+            fwhm = np.array(quality["FWHM"], dtype=float)
+            score = np.where(np.isfinite(fwhm), -fwhm, -np.inf)
+        else :
+            print("WARNING: no FWHM in the database, selecting frames for stack by peak flux ...")
+
+    ref_img_idx = int(np.argmax(score))
 
     p['REF_IMAGE_INDEX'] = ref_img_idx
     p['REFERENCE_IMAGE'] = inputlist[p['REF_IMAGE_INDEX']]
-    p['REF_OBJECT_HEADER'] = fits.getheader(p['REFERENCE_IMAGE'])
+    p['REF_OBJECT_HEADER'] = s4hc.getheader(p['REFERENCE_IMAGE'])
 
     #plt.plot(peaks)
     #plt.show()
     print(p['REF_IMAGE_INDEX'], "Reference image: {}".format(p['REFERENCE_IMAGE']))
 
-    sort = np.flip(np.argsort(peaks))
+    sort = np.argsort(-score, kind='stable')
 
     sorted_files = []
     newsort = []
@@ -1043,12 +1609,15 @@ def compute_offsets(p, frames, obj_files, auto_ref_selection=False) :
 
         p['REF_IMAGE_INDEX'] = np.argmax(peaksnr)
         p['REFERENCE_IMAGE'] = obj_files[p['REF_IMAGE_INDEX']]
-        p['REF_OBJECT_HEADER'] = fits.getheader(p['REFERENCE_IMAGE'])
+        p['REF_OBJECT_HEADER'] = s4hc.getheader(p['REFERENCE_IMAGE'])
 
     print("Computing offsets with respect to the reference image: index={} -> {}".format(p['REF_IMAGE_INDEX'], obj_files[p['REF_IMAGE_INDEX']]))
 
     # get x and y shifts of all images with respect to the first image
-    shift_list = compute_shift_list(frames, algorithm=p['SHIFT_ALGORITHM'], ref_image=p['REF_IMAGE_INDEX'], skip_failure=True)
+    if p['REGISTRATION_ENGINE'] == 'fft' :
+        shift_list = [shifts for frame, *shifts in register_frames(p, frames[p['REF_IMAGE_INDEX']], frames)]
+    else :
+        shift_list = compute_shift_list(frames, algorithm=p['SHIFT_ALGORITHM'], ref_image=p['REF_IMAGE_INDEX'], skip_failure=True)
 
     # store shifts in x and y np arrays
     x, y = np.array([]), np.array([])
@@ -1064,6 +1633,219 @@ def compute_offsets(p, frames, obj_files, auto_ref_selection=False) :
     return p
 
 
+def compute_frame_offset(p, ref_frame, frame, registration=None) :
+    """ Pipeline module to compute the offset of a frame with respect to a reference frame
+
+    Parameters
+    ----------
+    p : dict
+        dictionary with pipeline parameters
+    ref_frame : astropop.framedata.FrameData
+        reference frame
+    frame : astropop.framedata.FrameData
+        frame to register
+    registration : s4reg.FFTRegistration, optional
+        registration engine with the cached reference spectrum, see get_registration.
+        If None, the shift is computed by astropop with p['SHIFT_ALGORITHM']
+
+    Returns
+    -------
+    xshift, yshift : float, float
+        x and y shifts (pixel), NaN if registration failed
+    """
+
+    if registration is not None :
+        return registration.shift(frame.data)
+
+    # same as the shift of the frame in compute_offsets, which registers each frame to the reference independently
+    shift_list = compute_shift_list([ref_frame, frame], algorithm=p['SHIFT_ALGORITHM'], ref_image=0, skip_failure=True)
+
+    return shift_list[1][0], shift_list[1][1]
+
+
+def get_registration(p, ref_frame) :
+    """ Pipeline module to get the FFT registration engine for a reference frame
+
+    Parameters
+    ----------
+    p : dict
+        dictionary with pipeline parameters
+    ref_frame : astropop.framedata.FrameData
+        reference frame
+
+    Returns
+    -------
+    registration : s4reg.FFTRegistration
+        registration engine with the reference spectrum computed once, or None if p['REGISTRATION_ENGINE'] is not 'fft'
+    """
+    if p['REGISTRATION_ENGINE'] != 'fft' :
+        return None
+    return s4reg.FFTRegistration(ref_frame.data, binning=p['REGISTRATION_BINNING'], upsample_factor=p['REGISTRATION_UPSAMPLE_FACTOR'])
+
+
+def register_frames(p, ref_frame, frames, nthreads=None) :
+    """ Pipeline module to compute the offsets of frames with respect to a reference frame, in parallel threads
+
+    Parameters
+    ----------
+    p : dict
+        dictionary with pipeline parameters
+    ref_frame : astropop.framedata.FrameData
+        reference frame
+    frames : iterable of astropop.framedata.FrameData
+        frames to register, e.g. a generator of calibrated frames
+    nthreads : int, optional
+        number of threads, if None uses p['REGISTRATION_NTHREADS']
+
+    Yields
+    -------
+    frame, xshift, yshift : astropop.framedata.FrameData, float, float
+        each frame and its x and y shifts (pixel), in the same order of the input frames
+    """
+    if nthreads is None :
+        nthreads = p['REGISTRATION_NTHREADS']
+
+    # the reference spectrum is computed once and shared by all threads
+    registration = get_registration(p, ref_frame)
+
+    def register(frame) :
+        return (frame,) + tuple(compute_frame_offset(p, ref_frame, frame, registration=registration))
+
+    if nthreads > 1 :
+        # FFTs release the GIL, so frames are registered in parallel without copying the reference
+        with ThreadPoolExecutor(max_workers=nthreads) as executor :
+            for result in _bounded_map(executor, register, ((frame,) for frame in frames), max(p['FRAME_LOOKAHEAD'], nthreads)) :
+                yield result
+    else :
+        for frame in frames :
+            yield register(frame)
+
+
+def set_shift_info(info, xshift, yshift) :
+    """ Pipeline module to set the shift keywords of a frame in an info dict
+
+    Parameters
+    ----------
+    info : dict
+        dictionary with header cards of the product, updated in place
+    xshift, yshift : float, float
+        x and y shifts (pixel), NaN if undefined
+
+    Returns
+    -------
+    info : dict
+        dictionary with header cards of the product
+    """
+    info['XSHIFT'] = (0.,"register x shift (pixel)")
+    info['XSHIFTST'] = ("OK","x shift status")
+    info['YSHIFT'] = (0.,"register y shift (pixel)")
+    info['YSHIFTST'] = ("OK","y shift status")
+
+    if np.isfinite(xshift) :
+        info['XSHIFT'] = (xshift,"register x shift (pixel)")
+    else :
+        info['XSHIFTST'] = ("UNDEFINED","x shift status")
+
+    if np.isfinite(yshift) :
+        info['YSHIFT'] = (yshift,"register y shift (pixel)")
+    else :
+        info['YSHIFTST'] = ("UNDEFINED","y shift status")
+
+    return info
+
+
+def detect_sources(p, data) :
+    """ Pipeline module to detect sources in an image
+
+    Parameters
+    ----------
+    p : dict
+        dictionary with pipeline parameters
+    data : numpy.ndarray (n x m)
+        float array containing the image data
+
+    Returns
+    -------
+    sources : astropy.table.Table
+        sources detected by starfind
+    """
+    # calculate background
+    bkg, rms = background(data, global_bkg=False)
+
+    # detect sources
+    return starfind(data, threshold=p["PHOT_THRESHOLD"], background=bkg, noise=rms)
+
+
+def estimate_catalog_shift(p, catalogs, sources) :
+    """ Pipeline module to compute the shift of a frame by matching its detected sources to the stack catalogs
+
+    Parameters
+    ----------
+    p : dict
+        dictionary with pipeline parameters
+    catalogs : list of dicts
+        stack catalogs, all their sources (e.g. both beams in polarimetry) are matched
+    sources : astropy.table.Table
+        sources detected in the frame, see detect_sources
+
+    Returns
+    -------
+    xshift, yshift : float, float
+        x and y shifts (pixel) to add to the catalog positions, NaN if the sources could not be matched
+    nmatches : int
+        number of matched sources
+    """
+    # unique positions of all catalogs, brightest first
+    ref_x, ref_y, ref_mag = np.array([]), np.array([]), np.array([])
+    for catalog in catalogs :
+        ras, decs, x, y = read_catalog_coords(catalog)
+        ref_x, ref_y = np.append(ref_x, x), np.append(ref_y, y)
+        ref_mag = np.append(ref_mag, [catalog[star][7] for star in catalog.keys()])
+    positions, first = np.unique(np.round(np.column_stack([ref_x, ref_y]), 3), axis=0, return_index=True)
+    ref_mag = np.where(np.isfinite(ref_mag[first]), ref_mag[first], np.inf)
+    ref = positions[np.argsort(ref_mag, kind='stable')]
+
+    x, y = np.array(sources['x'], dtype=float), np.array(sources['y'], dtype=float)
+    if 'flux' in sources.colnames :
+        order = np.argsort(-np.nan_to_num(np.array(sources['flux'], dtype=float), nan=-np.inf), kind='stable')
+        x, y = x[order], y[order]
+
+    return s4reg.match_catalog_shift(ref[:,0], ref[:,1], x, y,
+                                     max_shift=p['CATALOG_MATCH_MAX_SHIFT'],
+                                     tolerance=p['CATALOG_MATCH_TOLERANCE'],
+                                     min_matches=p['CATALOG_MATCH_MIN_SOURCES'])
+
+
+def get_stored_offset(filename) :
+    """ Pipeline module to get the offset of a frame stored in the header of its reduced product
+
+    Parameters
+    ----------
+    filename : str
+        reduced science image product file path
+
+    Returns
+    -------
+    xshift, yshift : float, float
+        x and y shifts (pixel), NaN if undefined or not stored
+    """
+
+    try :
+        hdr = fits.getheader(filename)
+    except :
+        print("WARNING: could not read offsets from {}".format(filename))
+        return np.nan, np.nan
+
+    shifts = []
+    for key in ['XSHIFT', 'YSHIFT'] :
+        if key in hdr and hdr.get(key + 'ST', "OK") == "OK" :
+            shifts.append(float(hdr[key]))
+        else :
+            shifts.append(np.nan)
+
+    return shifts[0], shifts[1]
+
+
 def select_files_for_stack_and_get_shifts(p, frames, obj_files, sort_method='MAX_FLUXES', correct_shifts=False, plot=False) :
     """ Pipeline module to compute offset between all science images and
         select a sub-set of frames for stack
@@ -1110,12 +1892,15 @@ def select_files_for_stack_and_get_shifts(p, frames, obj_files, sort_method='MAX
 
     p['REF_IMAGE_INDEX'] = np.argmax(peaksnr)
     p['REFERENCE_IMAGE'] = obj_files[p['REF_IMAGE_INDEX']]
-    p['REF_OBJECT_HEADER'] = fits.getheader(p['REFERENCE_IMAGE'])
+    p['REF_OBJECT_HEADER'] = s4hc.getheader(p['REFERENCE_IMAGE'])
 
     print(p['REF_IMAGE_INDEX'], "Reference image: {}".format(p['REFERENCE_IMAGE']))
 
     # get x and y shifts of all images with respect to the first image
-    shift_list = compute_shift_list(frames, algorithm=p['SHIFT_ALGORITHM'], ref_image=p['REF_IMAGE_INDEX'], skip_failure=True)
+    if p['REGISTRATION_ENGINE'] == 'fft' :
+        shift_list = [shifts for frame, *shifts in register_frames(p, frames[p['REF_IMAGE_INDEX']], frames)]
+    else :
+        shift_list = compute_shift_list(frames, algorithm=p['SHIFT_ALGORITHM'], ref_image=p['REF_IMAGE_INDEX'], skip_failure=True)
 
     # store shifts in x and y np arrays
     x, y = np.array([]), np.array([])
@@ -1254,9 +2039,9 @@ def run_register_frames(p, inframes, inobj_files, info, output_stack="", force=F
     if output_stack != "" :
         if not os.path.exists(output_stack) or force:
             # for light products
-            s4p.scienceImageLightProduct(obj_files[0], img_data=img_data, info=info, catalogs=p["CATALOGS"], polarimetry=polarimetry, filename=output_stack, catalog_beam_ids=p['CATALOG_BEAM_IDS'], wcs_header=p['WCS_HEADER'], time_key=p["TIME_KEY"])
+            s4p.scienceImageLightProduct(obj_files[0], img_data=img_data, info=info, catalogs=p["CATALOGS"], polarimetry=polarimetry, filename=output_stack, catalog_beam_ids=p['CATALOG_BEAM_IDS'], wcs_header=p['WCS_HEADER'], time_key=p["TIME_KEY"], precision=p['PRECISION'])
             # for more complete products with an error and mask extensions
-            #s4p.scienceImageProduct(obj_files[0], img_data=img_data, err_data=err_data, mask_data=mask_data, info=info, catalogs=p["CATALOGS"], polarimetry=polarimetry, filename=output_stack, catalog_beam_ids=p['CATALOG_BEAM_IDS'], wcs_header=p['WCS_HEADER'], time_key=p["TIME_KEY"])
+            #s4p.scienceImageProduct(obj_files[0], img_data=img_data, err_data=err_data, mask_data=mask_data, info=info, catalogs=p["CATALOGS"], polarimetry=polarimetry, filename=output_stack, catalog_beam_ids=p['CATALOG_BEAM_IDS'], wcs_header=p['WCS_HEADER'], time_key=p["TIME_KEY"], precision=p['PRECISION'], mask_format=p['MASK_FORMAT'])
     return p
 
 
@@ -1444,7 +2229,7 @@ def set_wcs(p) :
     coord = SkyCoord(ra_str, dec_str, frame='icrs')
     ra_deg, dec_deg = coord.ra.degree, coord.dec.degree
     p['RA_DEG'], p['DEC_DEG'] = ra_deg, dec_deg
-    p['WCS'] = WCS(fits.getheader(p["ASTROM_REF_IMG"],0),naxis=2)
+    p['WCS'] = WCS(s4hc.getheader(p["ASTROM_REF_IMG"],0,copy=False),naxis=2)
     p['WCS_HEADER'] = p['WCS'].to_header(relax=True)
     p['WCS_HEADER']['CRVAL1'] = ra_deg
     p['WCS_HEADER']['CRVAL2'] = dec_deg
@@ -1613,7 +2398,7 @@ def set_sky_aperture(p, aperture_radius) :
     return r_ann
 
 
-def build_catalogs(p, data, catalogs=[], xshift=0., yshift=0., solve_astrometry=True, maxnsources=0, polarimetry=False, stackmode=False) :
+def build_catalogs(p, data, catalogs=[], xshift=0., yshift=0., solve_astrometry=True, maxnsources=0, polarimetry=False, stackmode=False, sources=None) :
     """ Pipeline module to generate the catalogs of sources from an image
         This module will perform the following tasks:
         1. Calculate background in the input image
@@ -1639,6 +2424,8 @@ def build_catalogs(p, data, catalogs=[], xshift=0., yshift=0., solve_astrometry=
         for maxnsources=0 it will include all detected sources
     polarimetry : bool, default=False
         whether or not input data is a dual beam polarimetric image with duplicated sources
+    sources : astropy.table.Table, optional
+        sources already detected in the image (see detect_sources). If not provided, they are detected here
     Returns
     -------
     p : dict
@@ -1650,11 +2437,9 @@ def build_catalogs(p, data, catalogs=[], xshift=0., yshift=0., solve_astrometry=
     #hdul = fits.open(image_name, mode = "readonly")
     #data = np.array(hdul[0].data, dtype=float)
 
-    # calculate background
-    bkg, rms = background(data, global_bkg=False)
-
-    # detect sources
-    sources = starfind(data, threshold=p["PHOT_THRESHOLD"], background=bkg, noise=rms)
+    if sources is None :
+        # calculate background and detect sources
+        sources = detect_sources(p, data)
 
     # get fwhm
     fwhm = sources.meta['astropop fwhm']
@@ -1771,7 +2556,13 @@ def phot_time_series(sci_list,
 
     # set output light curve product file name
     output = os.path.join(reduce_dir, "{}_lc.fits".format(ts_suffix))
-    if os.path.exists(output) and not force:
+
+    # parameters that affect the time series
+    prov_params = {'time_key': time_key, 'time_format': time_format, 'time_scale': time_scale,
+                   'longitude': longitude, 'latitude': latitude, 'altitude': altitude,
+                   'catalog_names': catalog_names, 'time_span_for_rms': time_span_for_rms, 'best_apertures': best_apertures}
+
+    if s4prov.is_up_to_date(output, sci_list, prov_params) and not force:
         return output
 
     # initialize data container as dict
@@ -1783,7 +2574,7 @@ def phot_time_series(sci_list,
 
     if catalog_names == [] :
         for hdu in hdul :
-            if hdu.name != "PRIMARY" :
+            if hdu.name not in s4p.IMAGE_EXTENSIONS :
                 catalog_names.append(hdu.name)
 
     # get number of exposures in time series
@@ -1810,7 +2601,7 @@ def phot_time_series(sci_list,
                                 time_scale=time_scale,
                                 time_span_for_rms=5)
         
-        apertures[key] = fits.getheader(sci_list[0],key)['APRADIUS']
+        apertures[key] = s4hc.getheader(sci_list[0],key,copy=False)['APRADIUS']
         
         if not has_time_info :
             # get time array
@@ -1821,7 +2612,7 @@ def phot_time_series(sci_list,
             tstop = Time(times[-1], format='jd', scale='utc')
             
             # get number of sources
-            nsources = fits.getheader(sci_list[0],key)['NOBJCAT']
+            nsources = s4hc.getheader(sci_list[0],key,copy=False)['NOBJCAT']
     
             has_time_info = True
         
@@ -1888,6 +2679,9 @@ def phot_time_series(sci_list,
     # generate the photometric time series product
     s4p.photTimeSeriesProduct(tsdata, apertures, info=info, filename=output)
 
+    # record inputs and parameters of the time series
+    s4prov.record(output, sci_list, prov_params)
+
     return output
 
 
@@ -1958,16 +2752,17 @@ def load_list_of_sci_image_catalogs(sci_list, wppos_key="WPPOS", polarimetry=Fal
 
             phot1data, phot2data = [], []
 
-            for ext in range(1,len(hdulist)) :
-                if (ext % 2) != 0 :
-                    if i == 0 :
-                        apertures = np.append(apertures,hdulist[ext].data[0][11])
-                        nsources = len(hdulist[ext].data)
+            # catalog extensions come in pairs of beams, after any image extensions
+            cat_exts = [ext for ext in range(1,len(hdulist)) if hdulist[ext].name not in s4p.IMAGE_EXTENSIONS]
 
-                    phot1data.append(Table(hdulist[ext].data))
-                    phot2data.append(Table(hdulist[ext+1].data))
-                else :
-                    continue
+            for k in range(0,len(cat_exts),2) :
+                ext = cat_exts[k]
+                if i == 0 :
+                    apertures = np.append(apertures,hdulist[ext].data[0][11])
+                    nsources = len(hdulist[ext].data)
+
+                phot1data.append(Table(hdulist[ext].data))
+                phot2data.append(Table(hdulist[cat_exts[k+1]].data))
             beam1[sci_list[i]] = phot1data
             beam2[sci_list[i]] = phot2data
 
@@ -1986,6 +2781,8 @@ def load_list_of_sci_image_catalogs(sci_list, wppos_key="WPPOS", polarimetry=Fal
             photdata = []
 
             for ext in range(1,len(hdulist)) :
+                if hdulist[ext].name in s4p.IMAGE_EXTENSIONS :
+                    continue
                 if i == 0 :
                     apertures = np.append(apertures,hdulist[ext].data[0][11])
                     nsources = len(hdulist[ext].data)
@@ -2164,7 +2961,10 @@ def compute_polarimetry(sci_list, output_filename="", wppos_key='WPPOS', save_ou
             print("ERROR: wave plate mode not supported, exiting ...")
             exit()
 
-    if os.path.exists(output_filename) and not force :
+    # parameters that affect the polarimetry
+    prov_params = {'wppos_key': wppos_key, 'wave_plate': wave_plate, 'compute_k': compute_k, 'fit_zero': fit_zero, 'zero': zero, 'base_aperture': base_aperture}
+
+    if s4prov.is_up_to_date(output_filename, sci_list, prov_params) and not force :
         print("There is already a polarimetry product :", output_filename)
         return output_filename
 
@@ -2331,8 +3131,8 @@ def compute_polarimetry(sci_list, output_filename="", wppos_key='WPPOS', save_ou
     if save_output :
         info = {}
 
-        hdr_start = fits.getheader(sci_list[0])
-        hdr_end = fits.getheader(sci_list[-1])
+        hdr_start = s4hc.getheader(sci_list[0],copy=False)
+        hdr_end = s4hc.getheader(sci_list[-1],copy=False)
         if "OBJECT" in hdr_start.keys() :
             info['OBJECT'] = (hdr_start["OBJECT"], 'ID of object of interest')
         if "OBSLAT" in hdr_start.keys() :
@@ -2370,7 +3170,7 @@ def compute_polarimetry(sci_list, output_filename="", wppos_key='WPPOS', save_ou
         info['NEXPS'] = (len(sci_list), 'number of exposures in sequence')
 
         for k in range(len(sci_list)) :
-            hdr = fits.getheader(sci_list[k])
+            hdr = s4hc.getheader(sci_list[k],copy=False)
             info["FILE{:04d}".format(k)] = (os.path.basename(sci_list[k]), 'file name of exposure')
             info["EXPT{:04d}".format(k)] = (exptime, 'exposure time (s)')
             info["BJD{:04d}".format(k)] = (hdr["BJD"], 'start time of exposure (BJD)')
@@ -2380,6 +3180,9 @@ def compute_polarimetry(sci_list, output_filename="", wppos_key='WPPOS', save_ou
         print("Saving output {} polarimetry product: {}".format(wave_plate, output_filename))
         output_hdul = s4p.polarProduct(polar_catalogs, info=info, filename=output_filename)
 
+        # record inputs and parameters of the polarimetry product
+        s4prov.record(output_filename, sci_list, prov_params)
+
     return output_filename
 
 
@@ -2610,12 +3413,11 @@ def psf_analysis(filename, aperture=10, half_windowsize=15, nsources=0, percenti
     loc["PSF_PRODUCT"] = filename
 
     # open science image product FITS file
-    hdulist = fits.open(filename)
-    img_data = hdulist[0].data[0]
+    img_data, err_data, mask_data, header = s4p.getImageDataFromProduct(filename)
     indices = np.indices(img_data.shape)
 
     # get pixel scale from the WCS and convert it to arcsec
-    wcs_obj = WCS(hdulist[0].header,naxis=2)
+    wcs_obj = WCS(header,naxis=2)
     pixel_scale = proj_plane_pixel_scales(wcs_obj)
     pixel_scale *= 3600
     print("Pixel scale: x: {:.3f} arcsec/pix y: {:.3f} arcsec/pix".format(pixel_scale[0],pixel_scale[1]))
@@ -2748,7 +3550,7 @@ def psf_analysis(filename, aperture=10, half_windowsize=15, nsources=0, percenti
     return loc
 
 
-def stack_and_reduce_sci_images(p, sci_list, reduce_dir, ref_img="", stack_suffix="", force=True, match_frames=True, polarimetry=False, verbose=False, plot=False) :
+def stack_and_reduce_sci_images(p, sci_list, reduce_dir, ref_img="", stack_suffix="", force=True, match_frames=True, polarimetry=False, verbose=False, plot=False, quality=None) :
     """ Pipeline module to run stack and reduction of science images
 
     Parameters
@@ -2773,6 +3575,8 @@ def stack_and_reduce_sci_images(p, sci_list, reduce_dir, ref_img="", stack_suffi
         print verbose messages
     plot : bool
         do plots
+    quality : dict, optional
+        quality statistics of the science frames from the database, see s4db.get_frame_quality
 
     Returns
     -------
@@ -2790,32 +3594,21 @@ def stack_and_reduce_sci_images(p, sci_list, reduce_dir, ref_img="", stack_suffi
                              reduce_dir=reduce_dir,
                              force=force,
                              stack_suffix=stack_suffix,
-                             polarimetry=polarimetry)
-
-    # set numbe of science reduction loops to avoid memory issues.
-    nloops = int(np.ceil(len(sci_list) / p['MAX_NUMBER_OF_SCI_FRAMES_PER_LOOP']))
+                             polarimetry=polarimetry,
+                             quality=quality)
 
     # set reference image
     if ref_img == "" :
         ref_img = p['REFERENCE_IMAGE']
 
-    for loop in range(nloops) :
-        first = p['MAX_NUMBER_OF_SCI_FRAMES_PER_LOOP'] * loop
-        last = p['MAX_NUMBER_OF_SCI_FRAMES_PER_LOOP'] * (loop+1)
-        if last > len(sci_list) :
-            last = len(sci_list)
-
-        if verbose :
-            print("Running loop {} of {} -> images in loop: {} to {} ... ".format(loop,nloops,first,last))
-
-        # reduce science data and calculate stack
-        p = reduce_science_images(p,
-                                  sci_list[first:last],
-                                  reduce_dir=reduce_dir,
-                                  ref_img=ref_img,
-                                  force=force,
-                                  match_frames=match_frames,
-                                  polarimetry=polarimetry)
+    # reduce science data, frames are streamed one at a time so memory use does not depend on the number of images
+    p = reduce_science_images(p,
+                              sci_list,
+                              reduce_dir=reduce_dir,
+                              ref_img=ref_img,
+                              force=force,
+                              match_frames=match_frames,
+                              polarimetry=polarimetry)
 
     # reduce science data and calculate stack
     #p = old_reduce_science_images(p, p['objsInPolarL2data'][j][object], data_dir=data_dir, reduce_dir=reduce_dir, force=options.force, match_frames=match_frames, stack_suffix=stack_suffix, polarimetry=True)
@@ -2862,7 +3655,11 @@ def polar_time_series(sci_pol_list,
 
     # set output light curve product file name
     output = os.path.join(reduce_dir, "{}_ts.fits".format(ts_suffix))
-    if os.path.exists(output) and not force:
+
+    # parameters that affect the time series
+    prov_params = {'aperture_radius': aperture_radius, 'min_aperture': min_aperture, 'max_aperture': max_aperture}
+
+    if s4prov.is_up_to_date(output, sci_pol_list, prov_params) and not force:
         return output
 
     # get information from the first image in the time series
@@ -2994,6 +3791,9 @@ def polar_time_series(sci_pol_list,
     # generate the photometric time series product
     s4p.polarTimeSeriesProduct(tsdata, info=info, filename=output)
 
+    # record inputs and parameters of the time series
+    s4prov.record(output, sci_pol_list, prov_params)
+
     return output
 
 
@@ -25,6 +25,7 @@ from astropy.wcs.utils import proj_plane_pixel_scales
 from astropy import units as u
 
 import warnings
+import sparc4_products as s4p
 from copy import deepcopy
 
 from astropop.math.physical import QFloat
@@ -50,11 +51,7 @@ def plot_cal_frame(filename, output="", percentile=99.5, xcut=512, ycut=512, com
     None
     """
 
-    hdul = fits.open(filename)
-
-    img_data = hdul["PRIMARY"].data[0]
-    err_data = hdul["PRIMARY"].data[1]
-    #mask_data = hdul["PRIMARY"].data[2]
+    img_data, err_data, mask_data, header = s4p.getImageDataFromProduct(filename)
 
     img_mean = QFloat(np.mean(img_data),np.std(img_data))
     noise_mean = QFloat(np.mean(err_data),np.std(err_data))
@@ -27,6 +27,7 @@ from astropy.time import Time
 from uncertainties import ufloat, umath
 
 import sparc4_utils as s4utils
+import sparc4_header_cache as s4hc
 
 from copy import deepcopy
 
@@ -52,7 +53,98 @@ def create_hdu_list(hdus: Collection[HDU]) -> fits.HDUList:
 
 
 
-def masterCalibration(list_of_imgs, img_data=[], err_data=[], mask_data=[], info={}, filename="") :
+# names of the image extensions in products with separate image, error and mask HDUs
+IMAGE_EXTENSIONS = ['PRIMARY', 'ERR', 'MASK']
+
+
+def image_data_hdus(primary_hdu, img_data, err_data, mask_data, precision="float64", mask_format="uint8") :
+    """ Set image, error and mask data into product HDUs
+
+    With precision='float64' data are stored as a single float64 cube in the primary HDU,
+    with slices 0, 1 and 2 for image, error and mask. With precision='float32' the image
+    is stored in the primary HDU and error and mask in separate 'ERR' and 'MASK' HDUs,
+    with float32 image and error, and with the mask as uint8 or bit-packed (mask_format='packed').
+
+    Parameters
+    ----------
+    primary_hdu : astropy.io.fits.PrimaryHDU
+        primary hdu, with the header already set
+    img_data, err_data, mask_data : numpy.ndarray (n x m)
+        image, error and mask data
+    precision : str, optional
+        'float64' or 'float32'
+    mask_format : str, optional
+        'uint8' or 'packed', only used with precision='float32'
+
+    Returns
+    -------
+    hdus : list
+        list of image HDUs, starting with primary_hdu
+    """
+
+    if precision != "float32" :
+        primary_hdu.header.set('DATA0', 'IMG DATA', 'content of slice 0 in cube')
+        primary_hdu.header.set('DATA1', 'ERR DATA', 'content of slice 1 in cube')
+        primary_hdu.header.set('DATA2', 'MASK DATA', 'content of slice 2 in cube')
+        primary_hdu.data = np.array([img_data,err_data,mask_data])
+        return [primary_hdu]
+
+    primary_hdu.header.set('DATA0', 'IMG DATA', 'content of PRIMARY extension')
+    primary_hdu.header.set('DATA1', 'ERR DATA', 'content of ERR extension')
+    primary_hdu.header.set('DATA2', 'MASK DATA', 'content of MASK extension')
+    primary_hdu.data = np.asarray(img_data, dtype=np.float32)
+
+    err_hdu = fits.ImageHDU(data=np.asarray(err_data, dtype=np.float32), name='ERR')
+
+    mask = np.asarray(mask_data) != 0
+    if mask_format == "packed" :
+        mask_hdu = fits.ImageHDU(data=np.packbits(mask, axis=-1), name='MASK')
+        mask_hdu.header.set('MASKPACK', True, 'mask bit-packed along rows with numpy.packbits')
+        mask_hdu.header.set('MASKNX', mask.shape[-1], 'number of columns of unpacked mask')
+    else :
+        mask_hdu = fits.ImageHDU(data=mask.astype(np.uint8), name='MASK')
+
+    return [primary_hdu, err_hdu, mask_hdu]
+
+
+def getImageDataFromProduct(filename) :
+    """ Get image, error and mask data from a product with either the cube or the separate HDUs layout
+
+    Parameters
+    ----------
+    filename : str
+        product file path
+
+    Returns
+    -------
+    img_data, err_data, mask_data : numpy.ndarray (n x m)
+        image, error and mask data, error and mask are None if the product has only the image
+    header : astropy.io.fits.Header
+        primary header
+    """
+
+    with fits.open(filename) as hdu_list :
+        header = hdu_list[0].header
+        data = hdu_list[0].data
+
+        if data.ndim == 3 :
+            return np.array(data[0]), np.array(data[1]), np.array(data[2]), header
+
+        img_data, err_data, mask_data = np.array(data), None, None
+        names = [hdu.name for hdu in hdu_list]
+        if 'ERR' in names :
+            err_data = np.array(hdu_list['ERR'].data)
+        if 'MASK' in names :
+            mask_hdu = hdu_list['MASK']
+            if mask_hdu.header.get('MASKPACK', False) :
+                mask_data = np.unpackbits(mask_hdu.data, axis=-1, count=mask_hdu.header['MASKNX']).astype(bool)
+            else :
+                mask_data = np.array(mask_hdu.data, dtype=bool)
+
+    return img_data, err_data, mask_data, header
+
+
+def masterCalibration(list_of_imgs, img_data=[], err_data=[], mask_data=[], info={}, filename="", precision="float64", mask_format="uint8") :
     """ Create a master calibration FITS image product (BIAS, DARK, FLAT, etc)
 
     Parameters
@@ -71,6 +163,10 @@ def masterCalibration(list_of_imgs, img_data=[], err_data=[], mask_data=[], info
             info = {key1: (value1, comment1), key2: (value2, comment2), ... }
     filename : str, optional
         The output file name to save product. If empty, file won't be saved.
+    precision : str, optional
+        'float64' (single float64 cube) or 'float32' (float32 image and error and compact mask in separate HDUs)
+    mask_format : str, optional
+        'uint8' or 'packed' (bit-packed), for precision='float32'
 
     Returns
     -------
@@ -79,12 +175,7 @@ def masterCalibration(list_of_imgs, img_data=[], err_data=[], mask_data=[], info
     """
 
     # get header from base image
-    baseheader = fits.getheader(list_of_imgs[0])
-
-    # add information about data in the product
-    info['DATA0'] = ('IMG DATA', 'content of slice 0 in cube')
-    info['DATA1'] = ('ERR DATA', 'content of slice 1 in cube')
-    info['DATA2'] = ('MASK DATA', 'content of slice 2 in cube')
+    baseheader = s4hc.getheader(list_of_imgs[0])
 
     # get number of images in the list
     ninimgs = len(list_of_imgs)
@@ -113,11 +204,11 @@ def masterCalibration(list_of_imgs, img_data=[], err_data=[], mask_data=[], info
     if len(mask_data) == 0:
         mask_data = np.zeros_like(img_data)
 
-    # set data cube into primary extension
-    primary_hdu.data = np.array([img_data,err_data,mask_data])
+    # set image, error and mask data
+    hdus = image_data_hdus(primary_hdu, img_data, err_data, mask_data, precision=precision, mask_format=mask_format)
 
     # create hdu list
-    hdu_list = create_hdu_list([primary_hdu])
+    hdu_list = create_hdu_list(hdus)
 
     # write FITS file if filename is given
     if filename != "" :
@@ -129,25 +220,22 @@ def masterCalibration(list_of_imgs, img_data=[], err_data=[], mask_data=[], info
 
 def getFrameFromMasterCalibration(filename) :
 
-    hdu_list = fits.open(filename)
-
-    img_data = hdu_list[0].data[0]
-    err_data = hdu_list[0].data[1]
-    mask_data = hdu_list[0].data[2]
-
-    header = hdu_list[0].header
+    img_data, err_data, mask_data, header = getImageDataFromProduct(filename)
 
     unit=None
     if header['BUNIT'] == 'electron' :
         unit=u.electron
 
-    frame = FrameData(data=img_data, unit=unit, uncertainty=err_data, mask=mask_data, header=header)
+    # keep float32 products in float32
+    dtype = np.float32 if img_data.dtype.itemsize == 4 else None
+
+    frame = FrameData(data=img_data, unit=unit, dtype=dtype, uncertainty=err_data, mask=mask_data, header=header)
 
     return frame
 
 
 
-def scienceImageProduct(original_image, img_data=[], err_data=[], mask_data=[], info={}, catalogs=[], polarimetry=False,  skip_ref_catalogs=True, filename="", catalog_beam_ids=["S","N"], wcs_header=None, time_key="DATE-OBS", ra="", dec="") :
+def scienceImageProduct(original_image, img_data=[], err_data=[], mask_data=[], info={}, catalogs=[], polarimetry=False,  skip_ref_catalogs=True, filename="", catalog_beam_ids=["S","N"], wcs_header=None, time_key="DATE-OBS", ra="", dec="", set_timecoords=True, precision="float64", mask_format="uint8") :
     """ Create a Science FITS image product
 
     Parameters
@@ -196,6 +284,13 @@ def scienceImageProduct(original_image, img_data=[], err_data=[], mask_data=[],
         string to overwrite header RA (Right Ascension) keyword
     dec : str, optional
         string to overwrite header DEC (Declination) keyword
+    set_timecoords : bool, optional
+        to calculate time and coordinates keywords. Set to False if they were already
+        calculated (e.g. with s4utils.set_timecoords_keys_batch) and are given in info
+    precision : str, optional
+        'float64' (single float64 cube) or 'float32' (float32 image and error and compact mask in separate HDUs)
+    mask_format : str, optional
+        'uint8' or 'packed' (bit-packed), for precision='float32'
 
     Returns
     -------
@@ -204,12 +299,7 @@ def scienceImageProduct(original_image, img_data=[], err_data=[], mask_data=[],
     """
 
     # get header from base image
-    baseheader = fits.getheader(original_image)
-
-    # add information about data in the product
-    info['DATA0'] = ('IMG DATA', 'content of slice 0 in cube')
-    info['DATA1'] = ('ERR DATA', 'content of slice 1 in cube')
-    info['DATA2'] = ('MASK DATA', 'content of slice 2 in cube')
+    baseheader = s4hc.getheader(original_image)
 
     # get file basename and add it to the info dict
     basename = os.path.basename(original_image)
@@ -219,7 +309,8 @@ def scienceImageProduct(original_image, img_data=[], err_data=[], mask_data=[],
     if wcs_header :
         baseheader += wcs_header
 
-    baseheader = s4utils.set_timecoords_keys(baseheader, time_key=time_key, ra=ra, dec=dec)
+    if set_timecoords :
+        baseheader = s4utils.set_timecoords_keys(baseheader, time_key=time_key, ra=ra, dec=dec)
 
     # create primary hdu with header of base image
     primary_hdu = fits.PrimaryHDU(header=baseheader)
@@ -236,10 +327,8 @@ def scienceImageProduct(original_image, img_data=[], err_data=[], mask_data=[],
     if len(mask_data) == 0:
         mask_data = np.zeros_like(img_data)
 
-    # set data cube into primary extension
-    primary_hdu.data = np.array([img_data,err_data,mask_data])
-
-    hdus = [primary_hdu]
+    # set image, error and mask data
+    hdus = image_data_hdus(primary_hdu, img_data, err_data, mask_data, precision=precision, mask_format=mask_format)
 
     ini_catalog = 0
     if skip_ref_catalogs and polarimetry :
@@ -341,7 +430,7 @@ def readScienceImagCatalogs(input) :
     catalogs = []
 
     for hdu in hdu_list :
-        if hdu.name != 'PRIMARY' :
+        if hdu.name not in IMAGE_EXTENSIONS :
             catdata = hdu.data
             apercat = {}
             for i in range(len(catdata)) :
@@ -351,7 +440,7 @@ def readScienceImagCatalogs(input) :
     return catalogs
 
 
-def scienceImageLightProduct(original_image, img_data=[], info={}, catalogs=[], polarimetry=False,  skip_ref_catalogs=True, filename="", catalog_beam_ids=["S","N"], wcs_header=None, time_key="DATE-OBS", ra="", dec="") :
+def scienceImageLightProduct(original_image, img_data=[], info={}, catalogs=[], polarimetry=False,  skip_ref_catalogs=True, filename="", catalog_beam_ids=["S","N"], wcs_header=None, time_key="DATE-OBS", ra="", dec="", set_timecoords=True, precision="float64") :
     """ Create a Science FITS image product
 
     Parameters
@@ -396,6 +485,11 @@ def scienceImageLightProduct(original_image, img_data=[], info={}, catalogs=[],
         string to overwrite header RA (Right Ascension) keyword
     dec : str, optional
         string to overwrite header DEC (Declination) keyword
+    set_timecoords : bool, optional
+        to calculate time and coordinates keywords. Set to False if they were already
+        calculated (e.g. with s4utils.set_timecoords_keys_batch) and are given in info
+    precision : str, optional
+        'float64' or 'float32', data type of the image
 
     Returns
     -------
@@ -404,7 +498,7 @@ def scienceImageLightProduct(original_image, img_data=[], info={}, catalogs=[],
     """
 
     # get header from base image
-    baseheader = fits.getheader(original_image)
+    baseheader = s4hc.getheader(original_image)
 
     # add information about data in the product
     info['DATA0'] = ('IMG DATA', 'content of slice 0 in cube')
@@ -417,7 +511,8 @@ def scienceImageLightProduct(original_image, img_data=[], info={}, catalogs=[],
     if wcs_header :
         baseheader += wcs_header
 
-    baseheader = s4utils.set_timecoords_keys(baseheader, time_key=time_key, ra=ra, dec=dec)
+    if set_timecoords :
+        baseheader = s4utils.set_timecoords_keys(baseheader, time_key=time_key, ra=ra, dec=dec)
 
     # create primary hdu with header of base image
     primary_hdu = fits.PrimaryHDU(header=baseheader)
@@ -431,7 +526,7 @@ def scienceImageLightProduct(original_image, img_data=[], info={}, catalogs=[],
         img_data = np.empty((1024,1024), dtype=float) * np.nan
 
     # set data cube into primary extension
-    primary_hdu.data = np.array(img_data)
+    primary_hdu.data = np.array(img_data, dtype=np.float32 if precision == "float32" else None)
 
     hdus = [primary_hdu]
 
@@ -708,6 +803,7 @@ def readPhotTimeSeriesData(sci_list,
     mags, emags = np.array([]), np.array([])
     smags, esmags = np.array([]), np.array([])
     flags = np.array([])
+    frame_times, frame_nsources = [], []
 
     for i in range(len(sci_list)) :
         #print("image {} of {} -> {}".format(i+1,len(sci_list),sci_list[i]))
@@ -725,10 +821,9 @@ def readPhotTimeSeriesData(sci_list,
         # append source index information
         srcindex = np.append(srcindex,catalog['SRCINDEX'])
 
-        # set obstime
-        obstime=Time(hdr[time_keyword], format=time_format, scale=time_scale, location=observ_location)
-        # append JD  to time series
-        times = np.append(times, np.full_like(catalog['SRCINDEX'], obstime.jd, dtype=float))
+        # save obstime to convert times of all frames at once
+        frame_times.append(hdr[time_keyword])
+        frame_nsources.append(len(catalog['SRCINDEX']))
 
         # append coordinates information
         ras = np.append(ras, catalog['RA'])
@@ -750,6 +845,11 @@ def readPhotTimeSeriesData(sci_list,
         del catalog
         del hdu_list
 
+    if len(frame_times) :
+        # set obstimes and repeat JD for all sources in each frame
+        obstimes = Time(frame_times, format=time_format, scale=time_scale, location=observ_location)
+        times = np.repeat(np.atleast_1d(obstimes.jd), frame_nsources).astype(float)
+
     tsdata = {}
     
     tsdata["TIME"] = times
@@ -768,7 +868,7 @@ def readPhotTimeSeriesData(sci_list,
     
     # Below we calculate a running rms for each source's data
     # get number of targets from header of first image
-    nsrc = fits.getheader(sci_list[0],1)['NOBJCAT']
+    nsrc = s4hc.getheader(sci_list[0],1,copy=False)['NOBJCAT']
 
     # convert time span from minutes to days
     time_span_for_rms_d = time_span_for_rms/(60*24)
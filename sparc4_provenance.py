@@ -0,0 +1,162 @@
+"""
+    Created on Oct 18 2026
+
+    Description: Provenance manifest of the SPARC4 pipeline products
+
+    Laboratório Nacional de Astrofísica - LNA/MCTI
+    """
+
+__version__ = "1.0"
+
+__copyright__ = """
+    Copyright (c) ...  All rights reserved.
+    """
+
+import os
+import json
+import hashlib
+import threading
+
+# manifest file name, one manifest per product directory
+MANIFEST_FILENAME = "sparc4_provenance.json"
+
+# loaded manifests by directory, and directories with unsaved changes
+_manifests = {}
+_dirty = set()
+_lock = threading.RLock()
+
+
+def get_params(p, keys) :
+    """ SPARC4 pipeline module to get the subset of pipeline parameters that affects a product
+    Parameters
+    ----------
+    p : dict
+        dictionary with pipeline parameters
+    keys : list
+        list of parameter keys
+
+    Returns
+    -------
+    params : dict
+        parameters with the given keys that exist in p
+    """
+    return {key: p[key] for key in keys if key in p}
+
+
+def get_hash(inputs, params={}) :
+    """ SPARC4 pipeline module to get the provenance hash of a product
+
+    Input files are identified by their base name, size and modification time, so
+    the hash changes whenever an input is replaced or regenerated.
+
+    Parameters
+    ----------
+    inputs : list
+        list of input file paths, empty strings and missing files are identified by name only
+    params : dict, optional
+        parameters used to build the product
+
+    Returns
+    -------
+    hash : str
+        hex digest
+    """
+    identities = []
+    for filename in inputs :
+        if filename != "" and os.path.exists(filename) :
+            st = os.stat(filename)
+            identities.append([os.path.basename(filename), st.st_size, st.st_mtime_ns])
+        else :
+            identities.append([os.path.basename(filename), None, None])
+    content = json.dumps({"inputs": identities, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def _get_manifest(dirname) :
+    """ Get the manifest of a directory, loading it on first use """
+    dirname = os.path.abspath(dirname)
+    if dirname not in _manifests :
+        manifest = {}
+        filename = os.path.join(dirname, MANIFEST_FILENAME)
+        if os.path.exists(filename) :
+            try :
+                with open(filename, "r") as f :
+                    manifest = json.load(f)
+            except :
+                print("WARNING: could not read provenance manifest {}, starting a new one ...".format(filename))
+        _manifests[dirname] = manifest
+    return dirname, _manifests[dirname]
+
+
+def is_up_to_date(output, inputs, params={}) :
+    """ SPARC4 pipeline module to check whether a product is up to date with its inputs and parameters
+
+    Existing products without a provenance record (e.g. made by previous versions
+    of the pipeline or copied by hand) are not trusted, so they are built again.
+
+    Parameters
+    ----------
+    output : str
+        product file path
+    inputs : list
+        list of input file paths
+    params : dict, optional
+        parameters used to build the product
+
+    Returns
+    -------
+    up_to_date : bool
+        True if the product exists and its inputs and parameters are unchanged
+    """
+    if not os.path.exists(output) :
+        return False
+
+    with _lock :
+        dirname, manifest = _get_manifest(os.path.dirname(output))
+        entry = manifest.get(os.path.basename(output))
+
+        if entry is None :
+            print("No provenance record of {}, it will be built again".format(output))
+            return False
+
+        if entry != get_hash(inputs, params) :
+            print("Inputs or parameters of {} changed since it was built".format(output))
+            return False
+
+    return True
+
+
+def record(output, inputs, params={}, save=True) :
+    """ SPARC4 pipeline module to record the provenance of a product
+    Parameters
+    ----------
+    output : str
+        product file path
+    inputs : list
+        list of input file paths
+    params : dict, optional
+        parameters used to build the product
+    save : bool, optional
+        to write the manifest now, set to False to record many products and call save_manifests once
+    """
+    with _lock :
+        dirname, manifest = _get_manifest(os.path.dirname(output))
+        manifest[os.path.basename(output)] = get_hash(inputs, params)
+        _dirty.add(dirname)
+        if save :
+            save_manifests()
+
+
+def save_manifests() :
+    """ SPARC4 pipeline module to write all manifests with unsaved changes """
+    with _lock :
+        for dirname in sorted(_dirty) :
+            filename = os.path.join(dirname, MANIFEST_FILENAME)
+            tmp_filename = filename + ".tmp"
+            try :
+                with open(tmp_filename, "w") as f :
+                    json.dump(_manifests[dirname], f, indent=1, sort_keys=True)
+                os.replace(tmp_filename, filename)
+            except :
+                print("WARNING: could not save provenance manifest {}".format(filename))
+        _dirty.clear()
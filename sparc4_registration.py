@@ -0,0 +1,215 @@
+"""
+    Created on Oct 18 2026
+
+    Description: FFT and catalog registration engines of the SPARC4 pipeline
+
+    Laboratório Nacional de Astrofísica - LNA/MCTI
+    """
+
+__version__ = "1.0"
+
+__copyright__ = """
+    Copyright (c) ...  All rights reserved.
+    """
+
+import numpy as np
+from scipy import fft
+from scipy.spatial import cKDTree
+
+
+def _prepare(data, binning=1) :
+    """ Get a float32 copy of an image without NaNs and with zero median, optionally binned """
+    img = np.array(data, dtype=np.float32)
+    bad = ~np.isfinite(img)
+    median = np.nanmedian(img) if np.any(~bad) else 0.
+    img -= median
+    img[bad] = 0.
+
+    if binning > 1 :
+        ny, nx = (img.shape[0] // binning) * binning, (img.shape[1] // binning) * binning
+        img = img[:ny, :nx].reshape(ny // binning, binning, nx // binning, binning).mean(axis=(1, 3))
+
+    return img
+
+
+def _upsampled_dft(data, region_size, upsample_factor, offsets) :
+    """ Inverse DFT of data sampled on a small region of the upsampled grid, by matrix multiplication
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        2D spectrum
+    region_size : int
+        size of the output region along both axes
+    upsample_factor : int
+        upsampling factor
+    offsets : tuple
+        (y, x) offsets of the region in the upsampled grid
+
+    Returns
+    -------
+    region : numpy.ndarray
+        inverse DFT on the region (region_size x region_size)
+    """
+    # same as skimage.registration phase_cross_correlation, after Guizar-Sicairos et al. (2008)
+    for n_items, ax_offset in reversed(list(zip(data.shape, offsets))) :
+        kernel = (np.arange(region_size) - ax_offset)[:, None] * fft.fftfreq(n_items, upsample_factor)
+        kernel = np.exp(-2j * np.pi * kernel)
+        data = np.tensordot(kernel, data, axes=(1, -1))
+    return data
+
+
+def _wrapped_peak(correlation) :
+    """ Get the (y, x) location of the maximum of a circular correlation, wrapped to [-n/2, n/2) """
+    # images have zero median, so the maximum of the real part is taken instead of the maximum of the modulus,
+    # which may be an anti-correlation
+    peak = np.array(np.unravel_index(np.argmax(correlation.real), correlation.shape), dtype=float)
+    shape = np.array(correlation.shape)
+    peak[peak > shape // 2] -= shape[peak > shape // 2]
+    return peak
+
+
+class FFTRegistration :
+    """ SPARC4 pipeline class to compute translations of frames with respect to a reference frame
+    by phase correlation
+
+    The FFT of the reference frame is computed only once, so the shift of each frame
+    costs one forward FFT and does not depend on any other frame. Shifts are the same
+    as those of astropop's cross-correlation register (translation to apply to a frame
+    to match the reference), but refined to 1/upsample_factor of a pixel.
+
+    With binning > 1, an integer shift is first found on binned images, then refined on
+    the full resolution cross-power spectrum within +/- binning pixels, with no inverse
+    FFT of the full frame.
+
+    Parameters
+    ----------
+    ref_data : numpy.ndarray
+        reference image
+    binning : int, optional
+        binning factor to find a coarse shift, 1 to search at full resolution
+    upsample_factor : int, optional
+        shifts are refined to 1/upsample_factor of a pixel, 1 for integer shifts
+    nthreads : int, optional
+        number of threads of each FFT
+    """
+
+    def __init__(self, ref_data, binning=1, upsample_factor=10, nthreads=1) :
+        self.binning = int(binning)
+        self.upsample_factor = int(upsample_factor)
+        self.nthreads = nthreads
+        self.shape = np.shape(ref_data)
+
+        # spectra of the reference, computed once
+        self.ref_spectrum = fft.fft2(_prepare(ref_data), workers=nthreads)
+        self.ref_binned_spectrum = None
+        if self.binning > 1 :
+            self.ref_binned_spectrum = fft.fft2(_prepare(ref_data, self.binning), workers=nthreads)
+
+    def _refine(self, cross_power, shift, region_size, upsample_factor) :
+        """ Refine a (y, x) shift on a region of the upsampled cross-correlation around it """
+        shift = np.round(shift * upsample_factor) / upsample_factor
+        dftshift = np.fix(region_size / 2.)
+        offsets = dftshift - shift * upsample_factor
+        correlation = _upsampled_dft(cross_power.conj(), region_size, upsample_factor, offsets).conj()
+        peak = np.array(np.unravel_index(np.argmax(correlation.real), correlation.shape), dtype=float)
+        return shift + (peak - dftshift) / upsample_factor
+
+    def shift(self, data) :
+        """ SPARC4 pipeline module to compute the shift of a frame with respect to the reference
+        Parameters
+        ----------
+        data : numpy.ndarray
+            image, with the same shape as the reference
+
+        Returns
+        -------
+        xshift, yshift : float, float
+            x and y shifts (pixel), NaN if the shift could not be computed
+        """
+        if np.shape(data) != self.shape :
+            print("WARNING: frame shape {} differs from reference shape {}, shift undefined".format(np.shape(data), self.shape))
+            return np.nan, np.nan
+
+        spectrum = fft.fft2(_prepare(data), workers=self.nthreads)
+        cross_power = self.ref_spectrum * spectrum.conj()
+
+        if self.binning > 1 :
+            # coarse integer shift on binned images, refined at full resolution within the binning box
+            binned_spectrum = fft.fft2(_prepare(data, self.binning), workers=self.nthreads)
+            coarse = _wrapped_peak(fft.ifft2(self.ref_binned_spectrum * binned_spectrum.conj(), workers=self.nthreads))
+            shift = self._refine(cross_power, coarse * self.binning, 2 * self.binning + 1, 1)
+        else :
+            shift = _wrapped_peak(fft.ifft2(cross_power, workers=self.nthreads))
+
+        if self.upsample_factor > 1 :
+            shift = self._refine(cross_power, shift, np.ceil(self.upsample_factor * 1.5), self.upsample_factor)
+
+        if not np.all(np.isfinite(shift)) :
+            return np.nan, np.nan
+
+        # translation to apply to the frame, as in astropop
+        return -shift[1], -shift[0]
+
+
+def match_catalog_shift(ref_x, ref_y, x, y, max_shift=100., tolerance=2., min_matches=3, nbright=50) :
+    """ SPARC4 pipeline module to compute the shift of a list of detected sources with respect to a reference catalog
+
+    Candidate shifts between the brightest sources of both lists within max_shift are found
+    with a KD-tree, and the shift with the most candidates within tolerance wins the vote.
+    The shift is then refined as the median offset of all sources matched within tolerance.
+
+    Parameters
+    ----------
+    ref_x, ref_y : numpy.ndarray
+        reference catalog positions (pixel), sorted by brightness (brightest first)
+    x, y : numpy.ndarray
+        detected source positions (pixel), sorted by brightness (brightest first)
+    max_shift : float, optional
+        maximum shift (pixel)
+    tolerance : float, optional
+        maximum distance (pixel) between matched sources
+    min_matches : int, optional
+        minimum number of matched sources
+    nbright : int, optional
+        number of brightest sources of each list used to find candidate shifts
+
+    Returns
+    -------
+    xshift, yshift : float, float
+        shift to add to reference positions to get the positions of the detected sources (pixel), NaN if not found
+    nmatches : int
+        number of matched sources
+    """
+    ref = np.column_stack([np.asarray(ref_x, dtype=float), np.asarray(ref_y, dtype=float)])
+    xy = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+    ref, xy = ref[np.all(np.isfinite(ref), axis=1)], xy[np.all(np.isfinite(xy), axis=1)]
+
+    if len(ref) < min_matches or len(xy) < min_matches :
+        return np.nan, np.nan, 0
+
+    # candidate shifts between pairs of bright sources
+    ref_bright, xy_bright = ref[:nbright], xy[:nbright]
+    neighbours = cKDTree(ref_bright).query_ball_point(xy_bright, r=max_shift)
+    i = np.repeat(np.arange(len(xy_bright)), [len(js) for js in neighbours])
+    j = np.concatenate([np.asarray(js, dtype=int) for js in neighbours])
+    if len(i) == 0 :
+        return np.nan, np.nan, 0
+    candidates = xy_bright[i] - ref_bright[j]
+
+    # vote for the shift shared by most pairs
+    votes = cKDTree(candidates).query_ball_point(candidates, r=tolerance, return_length=True)
+    shift = candidates[np.argmax(votes)]
+
+    # refine with all sources, twice so matches are made with the refined shift
+    tree = cKDTree(ref)
+    nmatches = 0
+    for k in range(2) :
+        distance, index = tree.query(xy - shift, distance_upper_bound=tolerance)
+        matched = np.isfinite(distance)
+        nmatches = int(np.count_nonzero(matched))
+        if nmatches < min_matches :
+            return np.nan, np.nan, nmatches
+        shift = np.median(xy[matched] - ref[index[matched]], axis=0)
+
+    return shift[0], shift[1], nmatches
@@ -27,6 +27,10 @@ import matplotlib.pyplot as plt
 from copy import deepcopy
 import glob
 
+import sparc4_db as s4db
+import sparc4_header_cache as s4hc
+import sparc4_ephemeris as s4eph
+
 def set_timecoords_keys(hdr, timezone=-3, timetype="", ra="", dec="", set_airmass=True, time_key='DATE-OBS') :
 
     """ Pipeline module to set time and coordinates keywords
@@ -110,33 +114,183 @@ def set_timecoords_keys(hdr, timezone=-3, timetype="", ra="", dec="", set_airmas
     jd = obstime.jd
     mjd = obstime.mjd
 
-    # Set light travel time for source observed
-    ltt_bary = obstime.light_travel_time(source)
-    bjd = obstime.tdb.jd + ltt_bary
-
-    #### HJD
-    ltt_helio = obstime.light_travel_time(source, 'heliocentric') ### para o HJD
-    hjd = obstime.tdb.jd + ltt_helio
+    airmass = None
+    if s4eph.is_enabled() :
+        # interpolate light travel times and airmass from the ephemeris cache
+        ltt_bary, ltt_helio, airmass = s4eph.get_time_corrections(obstime.utc.jd, source, observatory_location)
+        bjd = obstime.tdb.jd + ltt_bary[0]
+        hjd = obstime.tdb.jd + ltt_helio[0]
+        airmass = airmass[0]
+    else :
+        # Set light travel time for source observed
+        ltt_bary = obstime.light_travel_time(source)
+        bjd = (obstime.tdb.jd + ltt_bary).value
+
+        #### HJD
+        ltt_helio = obstime.light_travel_time(source, 'heliocentric') ### para o HJD
+        hjd = (obstime.tdb.jd + ltt_helio).value
 
     hdr.set("UTDATE",obstime.isot,"UT date at start of exposure ISOT")
     hdr.set("LTDATE",(obstime+timeZone).isot,"LT date at start of exposure ISOT")
     hdr.set("JD",jd,"Julian date at start of exposure")
     hdr.set("MJD",mjd,"Modified Julian date at start of exposure")
-    hdr.set("BJD",bjd.value,"Barycentric Julian date at start of exposure")
-    hdr.set("HJD",hjd.value,"Heliocentric Julian date at start of exposure")
+    hdr.set("BJD",bjd,"Barycentric Julian date at start of exposure")
+    hdr.set("HJD",hjd,"Heliocentric Julian date at start of exposure")
 
     #sidereal = obstime.sidereal_time('apparent')
     #hdr.set("ST",sidereal,"Sidereal time")
     #hdr.set("SD",sidereal,"Sidereal time")
 
     if set_airmass :
-        # calculate airmass
-        airmass = source.transform_to(AltAz(obstime=obstime,location=observatory_location)).secz
-        hdr.set("AIRMASS",airmass.value,"Airmass at start of exposure")
+        if airmass is None :
+            # calculate airmass
+            airmass = source.transform_to(AltAz(obstime=obstime,location=observatory_location)).secz.value
+        hdr.set("AIRMASS",airmass,"Airmass at start of exposure")
 
     return hdr
 
 
+def _get_observatory_and_source(hdr, ra="", dec="") :
+    """ Get observatory geodetic coordinates and source coordinates (as strings) from a header """
+    # set OPD geographic coordinates or get them from header if they exist
+    longitude = hdr.get('OBSLONG', -(45 + (34 + (57/60))/60))
+    latitude = hdr.get('OBSLAT', -(22 + (32 + (4/60))/60))
+    altitude = hdr.get('OBSALT', 1864)
+
+    # set equinox to 2000 or get it from header if it exists
+    equinox = "J{:.1f}".format(hdr.get('EQUINOX', 2000.))
+
+    if ra == "" :
+        ra = hdr.get('RA', "")
+    if dec == "" :
+        dec = hdr.get('DEC', "")
+
+    return (longitude, latitude, altitude), (str(ra), str(dec), equinox)
+
+
+def set_timecoords_keys_batch(hdrs, timezone=-3, timetype="", ra="", dec="", set_airmass=True, time_key='DATE-OBS') :
+
+    """ Pipeline module to set time and coordinates keywords in a list of headers
+
+    Same as set_timecoords_keys, but the times of all headers observed from the same
+    location and pointing to the same coordinates are computed at once with an
+    array-valued astropy Time.
+
+    Parameters
+    ----------
+    hdrs : list of astropy.io.fits.Header
+        FITS header units to be updated
+    timezone : int, optional
+        Time zone of observations with respect to Greenwich.
+        Default value is OPD's time zone of -3h
+    timetype : str, optional
+        if timetype=="LT" it will adopt time in the header as local time
+    ra : str, optional
+        string to overwrite header RA (Right Ascension) keyword
+    dec : str, optional
+        string to overwrite header DEC (Declination) keyword
+    set_airmass : bool
+        Calculate airmass and write it to the header
+    time_key : str, optional
+        string to point to the main date keyword in FITS header
+
+    Returns
+    -------
+    hdrs : list of astropy.io.fits.Header
+        FITS header units updated
+    """
+
+    # set time zone
+    timeZone = TimeDelta(timezone*u.hour,scale='tai')
+
+    # group headers by observatory location and source coordinates
+    groups = {}
+    for i in range(len(hdrs)) :
+        key = _get_observatory_and_source(hdrs[i], ra=ra, dec=dec)
+        groups.setdefault(key, []).append(i)
+
+    for (location, coords), indices in groups.items() :
+
+        longitude, latitude, altitude = location
+        observatory_location = EarthLocation.from_geodetic(lat=latitude, lon=longitude, height=altitude*u.m)
+
+        try :
+            # set source observed
+            source = SkyCoord(coords[0], coords[1], unit=(u.hourangle, u.deg), frame='icrs', equinox=coords[2])
+        except :
+            print("WARNING: could not set coordinates RA: {}  DEC: {}. Setting RA=0 Dec=0.".format(coords[0], coords[1]))
+            source = SkyCoord(0, 0, unit="deg")
+
+        # get time strings, with patch for non-standard time format --> change back when headers generated by ACS is fixed
+        timestrs = []
+        for i in indices :
+            timestr = hdrs[i][time_key]
+            try :
+                Time(timestr, format='isot', scale='utc')
+            except :
+                timestr = "{}-{}-{}".format(hdrs[i][time_key][:4],hdrs[i][time_key][4:6],hdrs[i][time_key][6:])
+            timestrs.append(timestr)
+
+        obstime = Time(timestrs, format='isot', scale='utc', location=observatory_location)
+
+        if timetype == "LT" :
+            obstime = obstime - timeZone
+
+        tdb = obstime.tdb.jd
+        airmass = None
+        if s4eph.is_enabled() :
+            # interpolate light travel times and airmass from the ephemeris cache
+            ltt_bary, ltt_helio, airmass = s4eph.get_time_corrections(obstime.utc.jd, source, observatory_location)
+            bjd, hjd = tdb + ltt_bary, tdb + ltt_helio
+        else :
+            # Set light travel times for source observed
+            bjd = tdb + obstime.light_travel_time(source).value
+            hjd = tdb + obstime.light_travel_time(source, 'heliocentric').value
+
+        utdates = obstime.isot
+        ltdates = (obstime + timeZone).isot
+        jd, mjd = obstime.jd, obstime.mjd
+
+        if set_airmass and airmass is None :
+            # calculate airmass
+            airmass = source.transform_to(AltAz(obstime=obstime,location=observatory_location)).secz.value
+
+        for k, i in enumerate(indices) :
+            hdrs[i].set("DATE-OBS",timestrs[k],"UT date at start of exposure ISOT")
+            hdrs[i].set("UTDATE",utdates[k],"UT date at start of exposure ISOT")
+            hdrs[i].set("LTDATE",ltdates[k],"LT date at start of exposure ISOT")
+            hdrs[i].set("JD",jd[k],"Julian date at start of exposure")
+            hdrs[i].set("MJD",mjd[k],"Modified Julian date at start of exposure")
+            hdrs[i].set("BJD",bjd[k],"Barycentric Julian date at start of exposure")
+            hdrs[i].set("HJD",hjd[k],"Heliocentric Julian date at start of exposure")
+            if set_airmass :
+                hdrs[i].set("AIRMASS",airmass[k],"Airmass at start of exposure")
+
+    return hdrs
+
+
+def get_timecoords_info(hdr) :
+
+    """ Pipeline module to get the time and coordinates keywords of a header as an info dict
+    Parameters
+    ----------
+    hdr : astropy.io.fits.Header
+        FITS header with keywords set by set_timecoords_keys or set_timecoords_keys_batch
+
+    Returns
+    -------
+    info : dict
+        dictionary of header cards, in the format info = {key1: (value1, comment1), ... }
+    """
+
+    info = {}
+    for key in ["DATE-OBS", "UTDATE", "LTDATE", "JD", "MJD", "BJD", "HJD", "AIRMASS"] :
+        if key in hdr.keys() :
+            info[key] = (hdr[key], hdr.comments[key])
+
+    return info
+
+
 
 def identify_files (p, night, print_report=True) :
 
@@ -214,7 +368,7 @@ def identify_files (p, night, print_report=True) :
         objsInPolarL4data.append({})
 
         for i in range(len(inputdata[j])) :
-            header = fits.getheader(inputdata[j][i])
+            header = s4hc.getheader(inputdata[j][i],copy=False)
             if header["OBSTYPE"] == p['OBJECT_OBSTYPE_KEYVALUE'] :
                 if "INSTMODE" in header.keys() :
                     #print(j,i,inputdata[j][i]," has INSTMODE")
@@ -392,7 +546,7 @@ def identify_files (p, night, print_report=True) :
 
 
 
-def select_polar_sequences(list_of_files, sortlist=True, verbose=False) :
+def select_polar_sequences(list_of_files, sortlist=True, npositions=None, drop_incomplete=False, verbose=False) :
 
     """ Pipeline module to select polarimetric sequences
     Parameters
@@ -401,6 +555,10 @@ def select_polar_sequences(list_of_files, sortlist=True, verbose=False) :
         list of files
     sortlist : bool
         sort input list of files
+    npositions : int, optional
+        number of waveplate positions of a complete sequence, to validate sequences
+    drop_incomplete : bool, optional
+        to drop incomplete sequences
     verbose : bool
         turn on verbose
 
@@ -414,41 +572,17 @@ def select_polar_sequences(list_of_files, sortlist=True, verbose=False) :
     if sortlist :
         # make sure the input list is sorted
         sortedlist = sorted(sortedlist)
-    
-    # initialize list of sequences
+
+    # get WPPOS from the header of each file, only once
+    wppos = [s4hc.getheader(sortedlist[i],copy=False)["WPPOS"] for i in range(len(sortedlist))]
+
+    # split list where WPPOS decreases
+    seqs, complete = s4db.segment_polar_sequences(wppos, npositions=npositions, drop_incomplete=drop_incomplete, verbose=verbose)
+
     sequences = []
-    
-    # run only for a non-empty list
-    if len(sortedlist) :
-    
-        # save WPPOS of first image
-        prev_pos = fits.getheader(sortedlist[0])['WPPOS']
-        # init current sequence list
-        seq = []
-
-        for i in range(len(sortedlist)) :
-
-            # get current WPPOS from header
-            current_pos = fits.getheader(sortedlist[i])["WPPOS"]
-            
-            # if current pos is lower than previous it means a new
-            # sequence started -> increment sequences and reset seq
-            if current_pos < prev_pos :
-                sequences.append(seq)
-                if verbose :
-                    print("Adding seq {} of {} files".format(len(sequences),len(seq)))
-
-                seq = []
-
-            # append file to current seq
-            seq.append(sortedlist[i])
-            # save current position as previous position
-            prev_pos = current_pos
-            
-            # Reached last file, add seq to sequences
-            if i == len(sortedlist) - 1 :
-                sequences.append(seq)
-                if verbose :
-                    print("Adding seq {} of {} files".format(len(sequences),len(seq)))
+    for seq in seqs :
+        sequences.append([sortedlist[i] for i in seq])
+        if verbose :
+            print("Adding seq {} of {} files".format(len(sequences),len(seq)))
 
     return sequences
@@ -0,0 +1,79 @@
+"""
+    Created on Oct 18 2026
+
+    Description: Benchmark of the science frame calibration kernels of the SPARC4 pipeline
+
+    Laboratório Nacional de Astrofísica - LNA/MCTI
+
+    Simple usage example:
+
+    python sparc4_calibration_benchmark.py --input="/Volumes/Samsung_T5/Data/SPARC4/minidata/sparc4acs1/20230503/*.fits" --bias=/Volumes/Samsung_T5/Data/SPARC4/minidata/reduced/sparc4acs1/20230503/20230503_s4c1_MasterZero.fits --flat=/Volumes/Samsung_T5/Data/SPARC4/minidata/reduced/sparc4acs1/20230503/20230503_s4c1_MasterDomeFlat.fits --nframes=20
+    """
+
+__version__ = "1.0"
+
+__copyright__ = """
+    Copyright (c) ...  All rights reserved.
+    """
+
+import os,sys
+from optparse import OptionParser
+sys.path.append(os.path.dirname(os.getcwd()))
+import sparc4_pipeline_lib as s4pipelib
+
+import glob
+import time
+import numpy as np
+import astropy.units as u
+
+parser = OptionParser()
+parser.add_option("-i", "--input", dest="input", help="wild card to select input raw images",type='string',default="*.fits")
+parser.add_option("-b", "--bias", dest="bias", help="master bias file",type='string',default="")
+parser.add_option("-f", "--flat", dest="flat", help="master flat file",type='string',default="")
+parser.add_option("-n", "--nframes", dest="nframes", help="maximum number of frames",type='int',default=10)
+parser.add_option("-g", "--gain", dest="gain", help="gain (electron/adu)",type='float',default=3.3)
+parser.add_option("-c", action="store_true", dest="cosmics", help="include cosmic ray cleaning in the benchmark", default=False)
+parser.add_option("-v", action="store_true", dest="verbose", help="verbose", default=False)
+
+try:
+    options,args = parser.parse_args(sys.argv[1:])
+except:
+    print("Error: check usage with  -h sparc4_calibration_benchmark.py")
+    sys.exit(1)
+
+inputfiles = sorted(glob.glob(options.input))[:options.nframes]
+if len(inputfiles) == 0 :
+    print("Error: no input images selected with {}".format(options.input))
+    sys.exit(1)
+
+gain = options.gain*u.electron/u.adu
+
+# calibrate all frames in the current process with both kernels
+results = {}
+for kernel in ['astropop', 'fused'] :
+    s4pipelib._init_calibration_worker(options.bias, options.flat, kernel)
+
+    tini = time.time()
+    frames = [s4pipelib._calibrate_frame(f, gain, calibrate=True, cosmics=options.cosmics, kernel=kernel) for f in inputfiles]
+    elapsed = time.time() - tini
+
+    results[kernel] = frames
+    print("{:>9} kernel: {} frames in {:.3f} s -> {:.2f} frames/s".format(kernel, len(frames), elapsed, len(frames) / elapsed))
+
+# compare outputs of the fused kernel with those of astropop
+max_data_diff, max_unct_diff = 0., 0.
+for i in range(len(inputfiles)) :
+    ref, new = results['astropop'][i], results['fused'][i]
+
+    if ref.unit != new.unit :
+        print("WARNING: units differ for {}: {} != {}".format(inputfiles[i], ref.unit, new.unit))
+
+    scale = np.nanmax(np.abs(ref.data))
+    data_diff = np.nanmax(np.abs(ref.data - new.data)) / scale
+    unct_diff = np.nanmax(np.abs(ref.get_uncertainty(return_none=False) - new.get_uncertainty(return_none=False))) / scale
+    max_data_diff, max_unct_diff = max(max_data_diff, data_diff), max(max_unct_diff, unct_diff)
+
+    if options.verbose :
+        print("{} : max relative difference data={:.3e} uncertainty={:.3e}".format(os.path.basename(inputfiles[i]), data_diff, unct_diff))
+
+print("Maximum difference relative to the data range: data={:.3e} uncertainty={:.3e}".format(max_data_diff, max_unct_diff))
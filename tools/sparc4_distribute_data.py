@@ -97,11 +97,14 @@ if options.checkdata :
         print("Directory: {}".format(data_dir))
 
         # if db doesn't exist create one
-        if not os.path.exists(p['s4db_files'][j]) :
-            db = s4db.create_db_from_observations(p['filelists'][j], p['DB_KEYS'], include_img_statistics=p["INCLUDE_IMG_STATISTICS"], include_only_fullframe=p["FULL_FRAMES_ONLY"], output=p['s4db_files'][j])
+        if not os.path.exists(p['s4db_files'][j]) or p["DB_INCREMENTAL"] :
+            db = s4db.create_db_from_observations(p['filelists'][j], p['DB_KEYS'], include_img_statistics=p["INCLUDE_IMG_STATISTICS"], include_only_fullframe=p["FULL_FRAMES_ONLY"], output=p['s4db_files'][j], nthreads=p["DB_NTHREADS"], nprocesses=p["DB_NPROCESSES"], saturation_limit=p["SATURATION_LIMIT"], fwhm_binning=p["DB_FWHM_BINNING"], incremental=p["DB_INCREMENTAL"])
         else :
             db = s4db.create_db_from_file(p['s4db_files'][j])
 
+        # index database once for all selections below
+        db = s4db.NightIndex(db)
+
         # get list of objects observed in photometric mode
         objs = s4db.get_targets_observed(db)
     
@@ -109,7 +112,7 @@ if options.checkdata :
         for k in range(len(objs)) :
             obj = objs[k][0]
 
-            objdb = db[db["OBJECT"]==obj]
+            objdb = db.subset(object_id=obj)
 
             print("Object: {}".format(obj))
             # detect all detector modes
@@ -153,11 +156,14 @@ for channel in p['SELECTED_CHANNELS'] :
     dest_dir = '{}/sparc4acs{}/{}/'.format(options.destdir, p['CHANNELS'][j], options.nightdir)
     
     # if db doesn't exist create one
-    if not os.path.exists(p['s4db_files'][j]) :
-        db = s4db.create_db_from_observations(p['filelists'][j], p['DB_KEYS'], include_img_statistics=p["INCLUDE_IMG_STATISTICS"], include_only_fullframe=p["FULL_FRAMES_ONLY"], output=p['s4db_files'][j])
+    if not os.path.exists(p['s4db_files'][j]) or p["DB_INCREMENTAL"] :
+        db = s4db.create_db_from_observations(p['filelists'][j], p['DB_KEYS'], include_img_statistics=p["INCLUDE_IMG_STATISTICS"], include_only_fullframe=p["FULL_FRAMES_ONLY"], output=p['s4db_files'][j], nthreads=p["DB_NTHREADS"], nprocesses=p["DB_NPROCESSES"], saturation_limit=p["SATURATION_LIMIT"], fwhm_binning=p["DB_FWHM_BINNING"], incremental=p["DB_INCREMENTAL"])
     else :
         db = s4db.create_db_from_file(p['s4db_files'][j])
-    
+
+    # index database once for all selections below
+    db = s4db.NightIndex(db)
+
     # loop over each object
     for k in range(len(in_objs)) :
         obj = in_objs[k]
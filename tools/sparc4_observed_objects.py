@@ -13,6 +13,9 @@
     
     python sparc4_observed_objects.py --nightdir=20230604 --datadir=/Volumes/Samsung_T5/Data/SPARC4/comissioning_jun23/ --reducedir=/Volumes/Samsung_T5/Data/SPARC4/comissioning_jun23/reduced --wildcard="*.fits"
 
+    # query all nights where an object was observed (requires DB_BACKEND: 'sqlite')
+    python sparc4_observed_objects.py --reducedir=/Volumes/Samsung_T5/Data/SPARC4/comissioning_jun23/reduced --object="HD111579" --instmode=POLAR --polarmode=L4
+
     """
 
 __version__ = "1.0"
@@ -40,6 +43,9 @@ parser.add_option("-d", "--datadir", dest="datadir", help="data directory",type=
 parser.add_option("-r", "--reducedir", dest="reducedir", help="Reduced data directory",type='string',default="")
 parser.add_option("-c", "--channels", dest="channels", help="SPARC4 channels: e.g '1,3,4' ",type='string',default="1,2,3,4")
 parser.add_option("-a", "--nightdir", dest="nightdir", help="Name of night directory common to all channels",type='string',default="")
+parser.add_option("-o", "--object", dest="object", help="Object ID to search for in all nights of the SQLite database",type='string',default="")
+parser.add_option("-i", "--instmode", dest="instmode", help="Instrument mode to search for, e.g. PHOT or POLAR",type='string',default="")
+parser.add_option("-l", "--polarmode", dest="polarmode", help="Polarimetric mode to search for, e.g. L2 or L4",type='string',default="")
 parser.add_option("-v", action="store_true", dest="verbose", help="verbose", default=False)
 
 try:
@@ -57,6 +63,23 @@ p = s4pipelib.init_s4_p(options.nightdir,
                         options.channels,
                         print_report=False)
 
+if options.object != "" :
+    # query the database of all nights and channels, without reading any raw data
+    if not os.path.exists(p['s4db_sqlite']) :
+        print("ERROR: SQLite database {} not found. Set DB_BACKEND: 'sqlite' and run the pipeline to create it".format(p['s4db_sqlite']))
+        sys.exit(1)
+
+    sqldb = s4db.SQLiteDB(p['s4db_sqlite'])
+    for channel in p['SELECTED_CHANNELS'] :
+        nights = s4db.get_nights_observed(sqldb,
+                                          object_id=options.object,
+                                          inst_mode=options.instmode if options.instmode != "" else None,
+                                          polar_mode=options.polarmode if options.polarmode != "" else None,
+                                          channel=channel)
+        print("Object {} observed in channel {}:".format(options.object, channel))
+        nights.pprint_all()
+    sys.exit(0)
+
 
 # loop over selected channels
 for channel in p['SELECTED_CHANNELS'] :
@@ -69,8 +92,12 @@ for channel in p['SELECTED_CHANNELS'] :
         
     # if db doesn't exist create one
     dbfile = p['s4db_files'][j].replace(".fits","_tmp.fits")
-    db = s4db.create_db_from_observations(filelist, p['DB_KEYS'], include_img_statistics=p["INCLUDE_IMG_STATISTICS"], include_only_fullframe=p["FULL_FRAMES_ONLY"], output=dbfile)
+    db = s4db.create_db_from_observations(filelist, p['DB_KEYS'], include_img_statistics=p["INCLUDE_IMG_STATISTICS"], include_only_fullframe=p["FULL_FRAMES_ONLY"], output=dbfile, nthreads=p["DB_NTHREADS"], nprocesses=p["DB_NPROCESSES"], saturation_limit=p["SATURATION_LIMIT"], fwhm_binning=p["DB_FWHM_BINNING"], incremental=p["DB_INCREMENTAL"])
         
+    # store night database for queries across nights, only if it contains all data in the night
+    if p["DB_BACKEND"] == 'sqlite' and sorted(filelist) == p['filelists'][j] :
+        s4db.SQLiteDB(p['s4db_sqlite']).ingest(db, channel, options.nightdir, index_keys=p['DB_KEYS'])
+
     # get list of objects observed in photometric mode
     objs = s4db.get_targets_observed(db)
     